@@ -12,15 +12,38 @@ from routes.inventory_dashboard_routes import inventory_dashboard_bp
 from routes.services_routes import services_bp
 from routes.debug_routes import debug_bp
 from routes.customers_routes import customers_bp
+from routes.dimension_routes import dimension_bp
 from database import init_bigquery_client
+from response_cache import enable_response_cache
+from request_timing import init_request_timing
+from data_versions import start_version_watcher, POS_ORDER_LINES, HISTORICAL_INVENTORY
+from product_facts_source import PRODUCT_FACTS_SOURCES
+from local_mirror import start_mirror_sync
+from dimensions import start_dimension_refresh
 
 app = Flask(__name__)
 
-# Initialize BigQuery client
-init_bigquery_client()
+# Time every request (performance report + Server-Timing header)
+init_request_timing(app)
+
+# Initialize BigQuery client and watch table metadata for new data
+if init_bigquery_client():
+    start_version_watcher()
+    start_mirror_sync()  # Only when LOCAL_MIRROR_ENABLED
+    start_dimension_refresh()
 
 # Register blueprints with descriptive names and /api prefix
 
+# Cache JSON responses per blueprint (TTL in seconds). Entries are also
+# invalidated as soon as one of the listed tables is modified.
+enable_response_cache(kpi_bp, ttl=1800, tables=(POS_ORDER_LINES,))
+enable_response_cache(analytics_bp, ttl=1800, tables=(POS_ORDER_LINES,))
+enable_response_cache(seller_bp, ttl=1800, tables=(POS_ORDER_LINES,))
+enable_response_cache(returns_bp, ttl=1800, tables=(POS_ORDER_LINES,))
+enable_response_cache(services_bp, ttl=1800, tables=(POS_ORDER_LINES,))
+enable_response_cache(customers_bp, ttl=3600, tables=(POS_ORDER_LINES,))
+enable_response_cache(inventory_dashboard_bp, ttl=1800, tables=PRODUCT_FACTS_SOURCES + (HISTORICAL_INVENTORY,))
+
 app.register_blueprint(dashboard_bp)
 app.register_blueprint(kpi_bp, url_prefix='/api')
 app.register_blueprint(analytics_bp, url_prefix='/api')
@@ -34,6 +57,7 @@ app.register_blueprint(admin_bp, url_prefix='/admin')
 app.register_blueprint(services_bp)
 app.register_blueprint(debug_bp, url_prefix='/debug')
 app.register_blueprint(customers_bp)
+app.register_blueprint(dimension_bp)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
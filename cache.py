@@ -1,47 +1,201 @@
 # cache.py
-# Simple caching mechanism for database queries
+# Bounded, thread-safe caching mechanism for database queries
 
-import time
-from functools import wraps
+import hashlib
 import json
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from config import Config
+from cache_backends import create_backend
+from data_versions import versions_for
+from request_timing import span
+from query_budget import is_estimating
 
-# Simple in-memory cache
-_cache = {}
 DEFAULT_CACHE_TIME = 300  # 5 minutes
 
-def cache_query(cache_time=DEFAULT_CACHE_TIME):
-    """Cache decorator for database queries"""
+def _key_default(obj):
+    """JSON fallback used to build canonical cache keys."""
+    if hasattr(obj, 'cache_key'):
+        return obj.cache_key()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return repr(obj)
+
+def make_cache_key(func, args, kwargs, tables=()):
+    """
+    Build a cache key that is stable across processes and restarts.
+
+    Unlike hash(), which is salted per process, this hashes a canonical JSON
+    encoding of the arguments. The current data versions of `tables` are part
+    of the key, so bumping a table's version invalidates its entries.
+    """
+    payload = json.dumps([list(args), kwargs, versions_for(tables)], sort_keys=True, default=_key_default, ensure_ascii=False)
+    digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return f"{func.__module__}.{func.__qualname__}:{digest}"
+
+class _Flight:
+    """A computation in progress that concurrent callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Cache shared by all decorated functions (per process, or per host/cluster
+# with the sqlite/redis backends -- see CACHE_BACKEND in config.py)
+_cache = create_backend(Config)
+
+# Single-flight registry: cache key -> _Flight of the caller currently running the query
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# Bounded worker pool for stale-while-revalidate refreshes
+_refresh_executor = ThreadPoolExecutor(max_workers=Config.CACHE_REFRESH_WORKERS, thread_name_prefix='cache-refresh')
+_refresh_pending = set()
+_refresh_lock = threading.Lock()
+MAX_PENDING_REFRESHES = Config.CACHE_REFRESH_WORKERS * 8
+
+def _single_flight(cache_key, owner, compute):
+    """
+    Run `compute` once per key across concurrent callers.
+
+    The first caller for a key becomes the leader and executes the query;
+    callers arriving while it runs wait for the leader's result (or error)
+    instead of launching an identical BigQuery job.
+    """
+    with _in_flight_lock:
+        flight = _in_flight.get(cache_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _Flight()
+            _in_flight[cache_key] = flight
+
+    if not is_leader:
+        _cache.record(owner, 'coalesced')
+        print(f"⏳ Waiting for in-flight query of {owner}")
+        with span('cache'):
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = compute()
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(cache_key, None)
+        flight.done.set()
+
+def _schedule_refresh(cache_key, owner, refresh):
+    """Queue a background refresh unless one is already pending or the pool is saturated."""
+    with _refresh_lock:
+        if cache_key in _refresh_pending or len(_refresh_pending) >= MAX_PENDING_REFRESHES:
+            return
+        _refresh_pending.add(cache_key)
+
+    def task():
+        try:
+            _single_flight(cache_key, owner, refresh)
+            _cache.record(owner, 'refreshes')
+        except Exception as e:
+            # The stale value stays in place until its hard TTL runs out
+            print(f"❌ Background refresh failed for {owner}: {e}")
+        finally:
+            with _refresh_lock:
+                _refresh_pending.discard(cache_key)
+
+    try:
+        _refresh_executor.submit(task)
+    except RuntimeError:
+        # Executor already shut down (interpreter exit)
+        with _refresh_lock:
+            _refresh_pending.discard(cache_key)
+
+def cache_query(cache_time=DEFAULT_CACHE_TIME, stale_time=0, tables=()):
+    """
+    Cache decorator for database queries.
+
+    Results are fresh for `cache_time` seconds. With `stale_time`, they keep
+    being served for that many extra seconds while a background worker
+    refreshes them; only after both run out does a caller wait on BigQuery.
+    `tables` lists the tables the query reads (see data_versions.py); a new
+    version of any of them invalidates the cached result immediately.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Create cache key from function name and arguments
-            cache_key = f"{func.__name__}_{hash(str(args) + str(kwargs))}"
-            
+            if is_estimating():
+                # Dry-run estimates return empty results that must not be cached
+                return func(*args, **kwargs)
+
+            cache_key = make_cache_key(func, args, kwargs, tables)
+
+            def execute():
+                result = func(*args, **kwargs)
+                _cache.set(cache_key, result, cache_time, func.__name__, stale_time)
+                return result
+
             # Check if cached result exists and is still valid
-            if cache_key in _cache:
-                cached_result, timestamp = _cache[cache_key]
-                if time.time() - timestamp < cache_time:
+            with span('cache'):
+                found, cached_result, is_fresh = _cache.get(cache_key, func.__name__)
+            if found:
+                if is_fresh:
                     print(f"✅ Cache hit for {func.__name__}")
+                else:
+                    print(f"♻️ Stale cache hit for {func.__name__}, refreshing in background...")
+                    _schedule_refresh(cache_key, func.__name__, execute)
+                return cached_result
+
+            def compute():
+                # Another caller may have filled the cache while we were queued
+                found, cached_result = _cache.peek(cache_key)
+                if found:
                     return cached_result
-            
-            # Execute function and cache result
-            print(f"🔄 Cache miss for {func.__name__}, executing query...")
-            result = func(*args, **kwargs)
-            _cache[cache_key] = (result, time.time())
-            
-            return result
+                print(f"🔄 Cache miss for {func.__name__}, executing query...")
+                return execute()
+
+            # Execute function once for all concurrent callers and cache result
+            return _single_flight(cache_key, func.__name__, compute)
         return wrapper
     return decorator
 
+def get_cache_backend():
+    """Backend instance shared by cache_query and the response cache"""
+    return _cache
+
 def clear_cache():
     """Clear all cached data"""
-    global _cache
-    _cache = {}
+    _cache.clear()
     print("🗑️ Cache cleared")
 
 def get_cache_info():
     """Get cache statistics"""
+    functions = {}
+    for name, counters in _cache.stats_snapshot().items():
+        lookups = counters['hits'] + counters['stale_hits'] + counters['misses']
+        served = counters['hits'] + counters['stale_hits']
+        functions[name] = dict(counters, hit_rate=round(served / lookups * 100, 2) if lookups else 0)
+
+    cache_keys = _cache.keys()
     return {
-        'cached_queries': len(_cache),
-        'cache_keys': list(_cache.keys())
+        'backend': _cache.name,
+        'cached_queries': len(cache_keys),
+        'cache_keys': cache_keys,
+        'total_bytes': _cache.total_bytes(),
+        'max_entries': _cache.max_entries,
+        'max_bytes': _cache.max_bytes,
+        'in_flight': len(_in_flight),
+        'pending_refreshes': len(_refresh_pending),
+        'functions': functions
     }
@@ -0,0 +1,534 @@
+# cache_backends.py
+# Storage backends for the query cache (in-process, shared on-disk, Redis)
+
+import base64
+import heapq
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from urllib.parse import urlparse, unquote
+
+# --- SERIALIZATION ---
+
+def _encode_value(obj):
+    """JSON hook for the types BigQuery rows contain."""
+    if isinstance(obj, Decimal):
+        return {'__type__': 'decimal', 'value': str(obj)}
+    if isinstance(obj, datetime):
+        return {'__type__': 'datetime', 'value': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__type__': 'date', 'value': obj.isoformat()}
+    if isinstance(obj, dt_time):
+        return {'__type__': 'time', 'value': obj.isoformat()}
+    if isinstance(obj, bytes):
+        return {'__type__': 'bytes', 'value': base64.b64encode(obj).decode('ascii')}
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Cannot serialize {type(obj).__name__} for the query cache")
+
+def _decode_value(obj):
+    kind = obj.get('__type__')
+    if kind is None or len(obj) != 2:
+        return obj
+    value = obj['value']
+    if kind == 'decimal':
+        return Decimal(value)
+    if kind == 'datetime':
+        return datetime.fromisoformat(value)
+    if kind == 'date':
+        return date.fromisoformat(value)
+    if kind == 'time':
+        return dt_time.fromisoformat(value)
+    if kind == 'bytes':
+        return base64.b64decode(value)
+    return obj
+
+def dumps(value):
+    """Serialize a query result to bytes, preserving Decimal/date/datetime values."""
+    return json.dumps(value, default=_encode_value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def loads(data):
+    """Inverse of dumps()."""
+    return json.loads(data, object_hook=_decode_value)
+
+# What dumps() raises for values it can't encode and loads() for corrupt entries
+CODEC_ERRORS = (TypeError, ValueError, KeyError)
+
+def approximate_size(value, _depth=0):
+    """Rough in-memory size of a query result (rows of dicts, lists and scalars)."""
+    size = sys.getsizeof(value)
+    if _depth > 4:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += approximate_size(k, _depth + 1) + approximate_size(v, _depth + 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += approximate_size(item, _depth + 1)
+    return size
+
+# --- BACKEND INTERFACE ---
+
+class CacheBackend:
+    """
+    Interface shared by all cache backends.
+
+    Entries have a soft TTL (fresh_until) and a hard TTL (expires_at); between
+    the two the value is still returned but reported as stale. Counters are
+    kept per process and per cached function.
+    """
+
+    name = 'base'
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._stats_lock = threading.Lock()
+        self.stats = defaultdict(lambda: {
+            'hits': 0, 'misses': 0, 'stale_hits': 0, 'refreshes': 0,
+            'evictions': 0, 'expirations': 0, 'coalesced': 0
+        })
+
+    def record(self, owner, counter, amount=1):
+        with self._stats_lock:
+            self.stats[owner][counter] += amount
+
+    def stats_snapshot(self):
+        with self._stats_lock:
+            return {owner: dict(counters) for owner, counters in self.stats.items()}
+
+    def get(self, key, owner):
+        """Return (found, value, is_fresh) for a key."""
+        raise NotImplementedError
+
+    def peek(self, key):
+        """Return (True, value) for a fresh entry without touching the hit/miss counters."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, owner, stale_ttl=0):
+        """Store a value fresh for `ttl` seconds and servable stale for another `stale_ttl`."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def total_bytes(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self.keys())
+
+    def _lookup(self, found, value, fresh_until, owner):
+        if not found:
+            self.record(owner, 'misses')
+            return False, None, False
+        is_fresh = time.time() < fresh_until
+        self.record(owner, 'hits' if is_fresh else 'stale_hits')
+        return True, value, is_fresh
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process LRU cache, bounded by entry count and approximate byte size.
+
+    Expired entries are removed eagerly (via an expiry heap) instead of
+    lingering until they happen to be read again.
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_entries, max_bytes):
+        super().__init__(max_entries, max_bytes)
+        self._bytes = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at, size, owner, fresh_until)
+        self._expiry_heap = []  # (expires_at, key), may hold stale items
+        self._lock = threading.RLock()
+
+    def get(self, key, owner):
+        with self._lock:
+            self._purge_expired()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            return self._lookup(False, None, 0, owner)
+        return self._lookup(True, entry[0], entry[4], owner)
+
+    def peek(self, key):
+        with self._lock:
+            self._purge_expired()
+            entry = self._entries.get(key)
+            if entry is None or time.time() >= entry[4]:
+                return False, None
+            return True, entry[0]
+
+    def set(self, key, value, ttl, owner, stale_ttl=0):
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return  # Never let one result flush the whole cache
+
+        fresh_until = time.time() + ttl
+        expires_at = fresh_until + stale_ttl
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires_at, size, owner, fresh_until)
+            self._bytes += size
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+
+            self._purge_expired()
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[2]
+                self.record(entry[3], 'evictions')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry_heap = []
+            self._bytes = 0
+
+    def keys(self):
+        with self._lock:
+            self._purge_expired()
+            return list(self._entries.keys())
+
+    def total_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _purge_expired(self):
+        now = time.time()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(key)
+            # Skip heap items left behind by an overwrite of the same key
+            if entry is not None and entry[1] == expires_at:
+                self._remove(key)
+                self.record(entry[3], 'expirations')
+        # Rebuild when overwrites have left the heap much larger than the cache
+        if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(entry[1], key) for key, entry in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+class SQLiteBackend(CacheBackend):
+    """
+    On-disk cache in a SQLite file, shared by every worker process on the host.
+
+    Uses WAL mode so readers in one worker never block writers in another.
+    LRU order is tracked with a last_access column.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, max_entries, max_bytes):
+        super().__init__(max_entries, max_bytes)
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    fresh_until REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache_entries (expires_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_access ON cache_entries (last_access)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, owner):
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT value, fresh_until FROM cache_entries WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute('UPDATE cache_entries SET last_access = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite cache unavailable: {e}")
+            row = None
+        if row is None:
+            return self._lookup(False, None, 0, owner)
+        value = self._decode(key, row[0])
+        if value is None:
+            return self._lookup(False, None, 0, owner)
+        return self._lookup(True, value[0], row[1], owner)
+
+    def peek(self, key):
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM cache_entries WHERE key = ? AND fresh_until > ?', (key, time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        value = None if row is None else self._decode(key, row[0])
+        return (False, None) if value is None else (True, value[0])
+
+    def _decode(self, key, data):
+        """(value,) of a stored entry, or None (after dropping it) when it can't be decoded."""
+        try:
+            return (loads(data),)
+        except CODEC_ERRORS as e:
+            print(f"⚠️ Dropping unreadable SQLite cache entry: {e}")
+            try:
+                self._connection().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            except sqlite3.Error:
+                pass
+            return None
+
+    def set(self, key, value, ttl, owner, stale_ttl=0):
+        try:
+            data = dumps(value)
+        except CODEC_ERRORS as e:
+            print(f"⚠️ Not caching {owner}: {e}")
+            return
+        if len(data) > self.max_bytes:
+            return
+        try:
+            self._store(key, data, ttl, owner, stale_ttl)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite cache unavailable: {e}")
+
+    def _store(self, key, data, ttl, owner, stale_ttl):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, owner, data, len(data), now + ttl, now + ttl + stale_ttl, now)
+            )
+            for (expired_owner,) in conn.execute('SELECT owner FROM cache_entries WHERE expires_at <= ?', (now,)).fetchall():
+                self.record(expired_owner, 'expirations')
+            conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (now,))
+
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries').fetchone()
+            if count > self.max_entries or total > self.max_bytes:
+                victims = []
+                for victim_key, victim_owner, size in conn.execute(
+                    'SELECT key, owner, size FROM cache_entries ORDER BY last_access'
+                ):
+                    if count <= self.max_entries and total <= self.max_bytes:
+                        break
+                    victims.append((victim_key,))
+                    count -= 1
+                    total -= size
+                    self.record(victim_owner, 'evictions')
+                conn.executemany('DELETE FROM cache_entries WHERE key = ?', victims)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache_entries')
+
+    def keys(self):
+        rows = self._connection().execute(
+            'SELECT key FROM cache_entries WHERE expires_at > ? ORDER BY last_access', (time.time(),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def total_bytes(self):
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+
+class RedisError(Exception):
+    """Error reply or protocol failure from a Redis server."""
+
+class RedisConnection:
+    """Minimal RESP2 client: just enough of the protocol for the cache."""
+
+    def __init__(self, host, port, db=0, password=None, timeout=2.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise RedisError('Connection closed by server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            return self.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+class RedisBackend(CacheBackend):
+    """
+    Cache stored in Redis (or any server speaking the Redis protocol).
+
+    The hard TTL is enforced by Redis key expiry. Entry and memory limits are
+    left to the server's maxmemory / maxmemory-policy (use allkeys-lru).
+    Connection failures degrade to cache misses instead of failing requests.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url, max_entries, max_bytes, prefix='qc:'):
+        super().__init__(max_entries, max_bytes)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _execute(self, *args):
+        conn = getattr(self._local, 'conn', None)
+        try:
+            if conn is None:
+                conn = RedisConnection(self.host, self.port, self.db, self.password)
+                self._local.conn = conn
+            return conn.execute(*args)
+        except (OSError, RedisError):
+            if conn is not None:
+                conn.close()
+            self._local.conn = None
+            raise
+
+    def _load(self, key):
+        try:
+            data = self._execute('GET', self.prefix + key)
+        except (OSError, RedisError) as e:
+            print(f"⚠️ Redis cache unavailable: {e}")
+            return None
+        if data is None:
+            return None
+        try:
+            envelope = loads(data)
+        except CODEC_ERRORS as e:
+            print(f"⚠️ Ignoring unreadable Redis cache entry: {e}")
+            return None
+        if not isinstance(envelope, dict) or 'fresh_until' not in envelope or 'value' not in envelope:
+            print(f"⚠️ Ignoring unreadable Redis cache entry: {key}")
+            return None
+        return envelope
+
+    def get(self, key, owner):
+        envelope = self._load(key)
+        if envelope is None:
+            return self._lookup(False, None, 0, owner)
+        return self._lookup(True, envelope['value'], envelope['fresh_until'], owner)
+
+    def peek(self, key):
+        envelope = self._load(key)
+        if envelope is None or time.time() >= envelope['fresh_until']:
+            return False, None
+        return True, envelope['value']
+
+    def set(self, key, value, ttl, owner, stale_ttl=0):
+        try:
+            data = dumps({'owner': owner, 'fresh_until': time.time() + ttl, 'value': value})
+        except CODEC_ERRORS as e:
+            print(f"⚠️ Not caching {owner}: {e}")
+            return
+        if len(data) > self.max_bytes:
+            return
+        try:
+            self._execute('SET', self.prefix + key, data, 'PX', max(1, int((ttl + stale_ttl) * 1000)))
+        except (OSError, RedisError) as e:
+            print(f"⚠️ Redis cache unavailable: {e}")
+
+    def _scan(self):
+        cursor = b'0'
+        while True:
+            cursor, batch = self._execute('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 500)
+            yield from batch
+            if cursor in (b'0', '0'):
+                break
+
+    def clear(self):
+        try:
+            keys = list(self._scan())
+            for i in range(0, len(keys), 500):
+                self._execute('DEL', *keys[i:i + 500])
+        except (OSError, RedisError) as e:
+            print(f"⚠️ Redis cache unavailable: {e}")
+
+    def keys(self):
+        try:
+            return [key.decode('utf-8')[len(self.prefix):] for key in self._scan()]
+        except (OSError, RedisError) as e:
+            print(f"⚠️ Redis cache unavailable: {e}")
+            return []
+
+    def total_bytes(self):
+        return None  # Tracked by the Redis server (INFO memory)
+
+def create_backend(config):
+    """Build the backend selected by config.CACHE_BACKEND, falling back to memory."""
+    kind = (config.CACHE_BACKEND or 'memory').lower()
+    try:
+        if kind == 'sqlite':
+            directory = os.path.dirname(config.CACHE_SQLITE_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            return SQLiteBackend(config.CACHE_SQLITE_PATH, config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES)
+        if kind == 'redis':
+            return RedisBackend(config.CACHE_REDIS_URL, config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES,
+                                prefix=config.CACHE_KEY_PREFIX)
+        if kind != 'memory':
+            print(f"⚠️ Unknown CACHE_BACKEND '{kind}', using in-process memory cache")
+    except Exception as e:
+        print(f"❌ Could not initialize '{kind}' cache backend, using in-process memory cache: {e}")
+    return MemoryBackend(config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES)
@@ -0,0 +1,99 @@
+# category_rules.py
+# The product-category derived columns (main category, purchase source, service and service-adjustment flags)
+#
+# Product categories look like "<main category> / <purchase source>". These
+# rules are the only definition of the derived columns: the ETL materializes
+# them in pos_order_lines and stock_data, and queries read the materialized
+# column when the table has it (computing it from the category otherwise).
+
+from data_versions import POS_ORDER_LINES, STOCK_DATA, table_columns
+
+SERVICE_CATEGORY = 'خدمات'  # Also matches 'خدمات وخصومات'
+POS_CATEGORY = 'pos'
+
+# Three product-name rules, kept apart because each one decides different numbers:
+# Services-category lines that aren't services sold: the services KPI and the services breakdown leave them out
+SERVICE_ADJUSTMENT_PRODUCTS = ('عربون طلب بضاعة', 'دفع مسبق منتجات البدائع', 'قسيمة التخفيض', 'نقاط المكافآت')
+# Deposits and prepayments, which the services pages leave out
+DEPOSIT_PRODUCT_WORDS = ('عربون', 'دفع مسبق')
+# Names the top-products lists leave out (with the services main category)
+EXCLUDED_PRODUCT_WORDS = ('خدمات', 'خصومات', 'خدمة', 'خصم')
+
+def _name_matches_sql(name, words):
+    return "(" + " OR ".join(f"{name} LIKE '%{word}%'" for word in words) + ")"
+
+# --- SQL ---
+
+def main_category_sql(category='product_category'):
+    return f"TRIM(SPLIT({category}, ' / ')[SAFE_OFFSET(0)])"
+
+def purchase_source_sql(category='product_category'):
+    return f"TRIM(SPLIT({category}, ' / ')[SAFE_OFFSET(1)])"
+
+def is_service_sql(category='product_category'):
+    return f"({category} LIKE '%{SERVICE_CATEGORY}%')"
+
+def is_service_adjustment_sql(name='product_name'):
+    return _name_matches_sql(name, SERVICE_ADJUSTMENT_PRODUCTS)
+
+def is_deposit_sql(name='product_name'):
+    return _name_matches_sql(name, DEPOSIT_PRODUCT_WORDS)
+
+def excluded_product_sql(category='product_category', name='product_name'):
+    """Lines the top-products lists leave out: excluded words in the name, or the services main category."""
+    return f"({_name_matches_sql(name, EXCLUDED_PRODUCT_WORDS)} OR SPLIT({category}, '/')[SAFE_OFFSET(0)] = '{SERVICE_CATEGORY}')"
+
+DERIVED_COLUMNS = {
+    'main_category': main_category_sql,
+    'purchase_source': purchase_source_sql,
+    'is_service': is_service_sql,
+    'is_service_adjustment': is_service_adjustment_sql,
+}
+
+# Whether each derived column is computed from the category or from the product name
+DERIVED_FROM_NAME = frozenset({'is_service_adjustment'})
+
+# stock_data names its columns like the Odoo export ("Category", "Product_Name")
+STOCK_COLUMN_NAMES = {
+    'main_category': 'Main_Category',
+    'purchase_source': 'Purchase_Source',
+    'is_service': 'Is_Service',
+    'is_service_adjustment': 'Is_Service_Adjustment',
+}
+
+def _column(table, column, expression):
+    # Rows loaded before the column was filled in fall back to the expression
+    if column.split('.')[-1] in table_columns(table):
+        return f"COALESCE({column}, {expression})"
+    return expression
+
+def line_column(name, alias=''):
+    """SQL for a derived column of pos_order_lines (`alias` qualifies the columns)."""
+    prefix = f"{alias}." if alias else ""
+    source = f"{prefix}product_name" if name in DERIVED_FROM_NAME else f"{prefix}product_category"
+    return _column(POS_ORDER_LINES, f"{prefix}{name}", DERIVED_COLUMNS[name](source))
+
+def stock_column(name, alias=''):
+    """SQL for a derived column of stock_data (`alias` qualifies the columns)."""
+    prefix = f"{alias}." if alias else ""
+    source = f"{prefix}Product_Name" if name in DERIVED_FROM_NAME else f"{prefix}Category"
+    return _column(STOCK_DATA, f"{prefix}{STOCK_COLUMN_NAMES[name]}", DERIVED_COLUMNS[name](source))
+
+def non_merchandise_sql(category='product_category', is_service='is_service'):
+    """Lines that aren't goods: the services category and the POS pseudo-category."""
+    return f"({is_service} OR {category} LIKE '%{POS_CATEGORY}%')"
+
+# --- Python (for ETL scripts that build the rows themselves) ---
+
+def main_category(category):
+    return category.split(' / ')[0].strip() if category is not None else None
+
+def purchase_source(category):
+    parts = (category or '').split(' / ')
+    return parts[1].strip() if len(parts) > 1 else None
+
+def is_service(category):
+    return SERVICE_CATEGORY in category if category is not None else None
+
+def is_service_adjustment(product_name):
+    return any(word in product_name for word in SERVICE_ADJUSTMENT_PRODUCTS) if product_name is not None else None
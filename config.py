@@ -2,6 +2,7 @@
 # Configuration settings for the Flask application
 
 import os
+import tempfile
 
 class Config:
     """Application configuration class."""
@@ -12,6 +13,66 @@ class Config:
     DATASET_ID = "Orders"
     TABLE_ID = "pos_order_lines"
     
+    # Business-day rollup of TABLE_ID maintained by data-push/daily_rollup.py (see rollup.py)
+    ROLLUP_TABLE_ID = os.environ.get('ROLLUP_TABLE_ID', 'pos_daily_rollup')
+    ROLLUP_ENABLED = os.environ.get('ROLLUP_ENABLED', 'true').lower() == 'true'
+    
+    # Per-barcode stock and sales facts maintained by data-push/product_facts.py
+    PRODUCT_FACTS_TABLE_ID = os.environ.get('PRODUCT_FACTS_TABLE_ID', 'product_facts')
+    
+    # Query Cache Configuration
+    # CACHE_BACKEND: 'memory' (per process), 'sqlite' (shared by workers on a host) or 'redis'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+    CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH') or os.path.join(tempfile.gettempdir(), 'last_flask_query_cache.sqlite3')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'qc:')
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256 MB
+    CACHE_REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', 4))
+    
+    # Seconds between checks of the tables' last_modified metadata (0 disables the watcher)
+    DATA_VERSION_POLL_SECONDS = int(os.environ.get('DATA_VERSION_POLL_SECONDS', 60))
+    
+    # BigQuery cost guardrails
+    # Hard cap (maximum_bytes_billed) on every other query job; off (0) unless set,
+    # since the routes without a budget report a capped query as a plain error
+    QUERY_MAX_BYTES_BILLED = int(os.environ.get('QUERY_MAX_BYTES_BILLED', 0))
+    # Heavy endpoints get their own budget and a dry-run check before running
+    QUERY_BYTE_BUDGETS = {
+        '/api/top-15-customers': 2 * 1024 ** 3,
+        '/api/customer-invoices/<phone_number>': 2 * 1024 ** 3,
+        '/api/customers-overview': 2 * 1024 ** 3,
+        '/api/top-customers-by-revenue': 2 * 1024 ** 3,
+        '/api/top-customers-by-frequency': 2 * 1024 ** 3,
+        '/api/customers-by-city': 2 * 1024 ** 3,
+        '/api/monthly-customer-trends': 2 * 1024 ** 3,
+        '/debug/debug/customer-sample': 1024 ** 3,  # debug_bp prefix + its /debug/... route
+    }
+    
+    # HTTP Response Cache Configuration (TTLs are set per blueprint in app.py)
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+    RESPONSE_CACHE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_CACHE_COMPRESS_MIN_BYTES', 1024))
+    
+    # Local DuckDB/Parquet mirror of pos_order_lines and stock_data (needs duckdb and pyarrow)
+    # Queries on mirrored tables run locally while the mirror is fresh, and on BigQuery otherwise
+    LOCAL_MIRROR_ENABLED = os.environ.get('LOCAL_MIRROR_ENABLED', 'false').lower() == 'true'
+    LOCAL_MIRROR_DIR = os.environ.get('LOCAL_MIRROR_DIR') or os.path.join(tempfile.gettempdir(), 'last_flask_mirror')
+    LOCAL_MIRROR_MAX_AGE_SECONDS = int(os.environ.get('LOCAL_MIRROR_MAX_AGE_SECONDS', 900))
+    LOCAL_MIRROR_SYNC_SECONDS = int(os.environ.get('LOCAL_MIRROR_SYNC_SECONDS', 300))  # 0: sync from cron only
+    LOCAL_MIRROR_FULL_SYNC_HOURS = int(os.environ.get('LOCAL_MIRROR_FULL_SYNC_HOURS', 24))  # Picks up late/corrected rows
+    LOCAL_MIRROR_MAX_PARTS = int(os.environ.get('LOCAL_MIRROR_MAX_PARTS', 48))
+    
+    # In-process copy of stock_data the inventory dashboard is computed from (see stock_replica.py)
+    # Reloaded when the table changes; this age limit only applies while its version is unknown
+    STOCK_REPLICA_MAX_AGE_SECONDS = int(os.environ.get('STOCK_REPLICA_MAX_AGE_SECONDS', 900))
+    
+    # Distinct branches, employees, categories, products and locations behind the dropdowns and suggestions (see dimensions.py)
+    DIMENSION_REFRESH_SECONDS = int(os.environ.get('DIMENSION_REFRESH_SECONDS', 3600))  # 0: load on first use only
+    DIMENSION_FULL_REFRESH_HOURS = int(os.environ.get('DIMENSION_FULL_REFRESH_HOURS', 24))  # Incremental in between
+    
+    # Threads running the widgets of /api/dashboard-bundle (shared by all requests)
+    DASHBOARD_BUNDLE_WORKERS = int(os.environ.get('DASHBOARD_BUNDLE_WORKERS', 8))
+    
     # Flask Configuration
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
     DEBUG = True
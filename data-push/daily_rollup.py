@@ -0,0 +1,141 @@
+# daily_rollup.py
+# This script maintains the business-day rollup of pos_order_lines in BigQuery.
+# The dashboard reads closed business days from it instead of scanning every
+# order line (see rollup.py in the application for the table's columns).
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from google.cloud import bigquery
+
+# The rollup's SQL is shared with the application
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rollup import business_date_of, business_day_start, rollup_rows_sql, ROLLUP_COLUMNS  # noqa: E402
+
+# ==============================================================================
+# الإعدادات الرئيسية
+# ==============================================================================
+
+# --- Google BigQuery Settings ---
+PROJECT_ID = "spartan-cedar-467808-p9"
+DATASET_ID = "Orders"
+SOURCE_TABLE_ID = "pos_order_lines"
+ROLLUP_TABLE_ID = os.environ.get('ROLLUP_TABLE_ID', 'pos_daily_rollup')
+
+# Closed business days rebuilt on every run, so late edits to recent orders are picked up
+LOOKBACK_DAYS = 3
+
+# ==============================================================================
+# إعدادات إضافية (لا تحتاج للتعديل)
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+SOURCE_TABLE = f"`{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_ID}`"
+ROLLUP_TABLE = f"`{PROJECT_ID}.{DATASET_ID}.{ROLLUP_TABLE_ID}`"
+
+# ==============================================================================
+# الدوال الأساسية
+# ==============================================================================
+
+def ensure_rollup_table_exists(client):
+    """
+    Create the rollup table (partitioned by business day) if it is missing, or
+    recreate it when its columns differ from ROLLUP_COLUMNS. Returns True when
+    it was (re)created and needs a full rebuild.
+    """
+    try:
+        table = client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{ROLLUP_TABLE_ID}")
+    except Exception:
+        table = None
+    if table is not None:
+        if [field.name for field in table.schema] == ROLLUP_COLUMNS:
+            logging.info(f"Table {ROLLUP_TABLE_ID} already exists.")
+            return False
+        logging.info(f"Table {ROLLUP_TABLE_ID} has outdated columns. Recreating it...")
+
+    create_query = f"""
+        CREATE OR REPLACE TABLE {ROLLUP_TABLE}
+        PARTITION BY business_date
+        CLUSTER BY branch, employee_name, main_category
+        AS
+        {rollup_rows_sql(SOURCE_TABLE, ["FALSE"])}
+    """
+    client.query(create_query).result()
+    logging.info(f"Created table {ROLLUP_TABLE_ID} in dataset {DATASET_ID}.")
+    return True
+
+def get_first_business_date(client):
+    """Business date of the oldest order line."""
+    rows = list(client.query(f"SELECT MIN(order_date) AS first_order FROM {SOURCE_TABLE}").result())
+    first_order = rows[0]['first_order'] if rows else None
+    return business_date_of(first_order) if first_order else None
+
+def source_partitioned(client):
+    """True when pos_order_lines is partitioned on business_date (see partition_order_lines.py)."""
+    partitioning = client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_ID}").time_partitioning
+    return partitioning is not None and partitioning.field == "business_date"
+
+def rebuild_business_days(client, start_date, end_date):
+    """Replace the rollup rows of business days start_date..end_date in one transaction."""
+    columns = ", ".join(ROLLUP_COLUMNS)
+    source_conditions = ["order_date BETWEEN @start_datetime AND @end_datetime"]
+    if source_partitioned(client):
+        # Only read the partitions of those days (and lines not given a business_date yet)
+        source_conditions.append("(business_date BETWEEN @start_date AND @end_date OR business_date IS NULL)")
+    script = f"""
+        BEGIN TRANSACTION;
+
+        DELETE FROM {ROLLUP_TABLE}
+        WHERE business_date BETWEEN @start_date AND @end_date;
+
+        INSERT INTO {ROLLUP_TABLE} ({columns})
+        {rollup_rows_sql(SOURCE_TABLE, source_conditions)};
+
+        COMMIT TRANSACTION;
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+        bigquery.ScalarQueryParameter("start_datetime", "DATETIME", business_day_start(start_date)),
+        bigquery.ScalarQueryParameter("end_datetime", "DATETIME",
+                                      business_day_start(end_date + timedelta(days=1)) - timedelta(seconds=1)),
+    ])
+    logging.info(f"Rebuilding business days {start_date} .. {end_date}...")
+    job = client.query(script, job_config=job_config)
+    job.result()
+    logging.info(f"✅ Rebuild successful ({job.total_bytes_processed or 0:,} bytes processed).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the business-day rollup of pos_order_lines")
+    parser.add_argument('--full', action='store_true', help="Rebuild every business day instead of the last few")
+    parser.add_argument('--days', type=int, default=LOOKBACK_DAYS, help="Closed business days to rebuild")
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    created = ensure_rollup_table_exists(client)
+
+    # Only closed business days go into the rollup; the open one is read from the order lines
+    end_date = business_date_of(datetime.utcnow()) - timedelta(days=1)
+    if args.full or created:
+        start_date = get_first_business_date(client)
+        if start_date is None:
+            logging.warning("No order lines found. Nothing to roll up.")
+            return
+    else:
+        start_date = end_date - timedelta(days=args.days - 1)
+
+    if start_date > end_date:
+        logging.info("No closed business days to rebuild.")
+        return
+    rebuild_business_days(client, start_date, end_date)
+
+# --- Main execution block ---
+if __name__ == "__main__":
+    logging.info("--- Starting Daily Rollup Process ---")
+    try:
+        main()
+        logging.info("--- Rollup Process Completed Successfully ---")
+    except Exception as e:
+        logging.critical(f"--- Rollup Process Failed ---", exc_info=True)
+        sys.exit(1)
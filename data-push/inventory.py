@@ -1,6 +1,8 @@
 # inventory_etl.py
 # This script fetches the latest inventory snapshot from Odoo and uploads it to BigQuery.
 
+import os
+import sys
 import requests
 import pandas as pd
 import logging
@@ -8,6 +10,10 @@ from google.cloud import bigquery
 from google.oauth2 import service_account
 from google.cloud.exceptions import NotFound
 
+# The category rules are shared with the application
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import category_rules  # noqa: E402
+
 # --- Odoo Connection Settings ---
 ODOO_URL = "https://rahatystore.odoo.com"
 ODOO_DB = "rahatystore-live-12723857"
@@ -91,6 +97,10 @@ def ensure_stock_table_exists(client, dataset_id, table_id):
             bigquery.SchemaField("Available Qty", "FLOAT"),
             bigquery.SchemaField("Unit Cost", "FLOAT"),
             bigquery.SchemaField("Total Cost", "FLOAT"),
+            bigquery.SchemaField("Main Category", "STRING"),
+            bigquery.SchemaField("Purchase Source", "STRING"),
+            bigquery.SchemaField("Is Service", "BOOLEAN"),
+            bigquery.SchemaField("Is Service Adjustment", "BOOLEAN"),
         ]
         table = bigquery.Table(table_ref, schema=schema)
         client.create_table(table)
@@ -156,16 +166,24 @@ def main():
     df["standard_price"].fillna(0, inplace=True)
     df["total_cost"] = df["on_hand_quantity"] * df["standard_price"]
 
+    # Category-derived columns, so the dashboard doesn't split the category string on every query
+    df["main_category"] = df["category"].apply(category_rules.main_category)
+    df["purchase_source"] = df["category"].apply(category_rules.purchase_source)
+    df["is_service"] = df["category"].apply(category_rules.is_service)
+    df["is_service_adjustment"] = df["display_name"].apply(category_rules.is_service_adjustment)
+
     # Define the final structure of the stock table
     final_df = df[[
         "display_name", "barcode", "category",
         "on_hand_quantity", "reserved_quantity", "available_quantity",
-        "standard_price", "total_cost"
+        "standard_price", "total_cost",
+        "main_category", "purchase_source", "is_service", "is_service_adjustment"
     ]]
     final_df.columns = [
         "Product Name", "Barcode", "Category",
         "Qty On Hand", "Reserved Qty", "Available Qty",
-        "Unit Cost", "Total Cost"
+        "Unit Cost", "Total Cost",
+        "Main Category", "Purchase Source", "Is Service", "Is Service Adjustment"
     ]
 
     # Upload to BigQuery
@@ -0,0 +1,150 @@
+# partition_order_lines.py
+# This script gives pos_order_lines a materialized business_date column and
+# rebuilds the table partitioned on it and clustered on the columns the
+# dashboard filters by, so a one-day view reads one partition. It also
+# materializes the category-derived columns (main_category, purchase_source,
+# is_service, is_service_adjustment) defined in category_rules.py.
+#
+# business_date is the business day of the line: the calendar day of
+# order_date + 3 hours (a business day runs from 21:00 to 20:59:59).
+# Loaders appending to pos_order_lines should write it directly; rows they
+# append without it are filled in by the next run of this script, and the
+# dashboard keeps reading them meanwhile (its filters include the NULL partition;
+# its category columns fall back to the category rules when NULL).
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+from google.cloud import bigquery
+
+# The category rules are shared with the application
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from category_rules import DERIVED_COLUMNS  # noqa: E402
+
+# ==============================================================================
+# الإعدادات الرئيسية
+# ==============================================================================
+
+# --- Google BigQuery Settings ---
+PROJECT_ID = "spartan-cedar-467808-p9"
+DATASET_ID = "Orders"
+TABLE_ID = "pos_order_lines"
+
+PARTITION_COLUMN = "business_date"
+CLUSTER_COLUMNS = ["branch", "employee_name", "product_category"]
+BUSINESS_DATE_SQL = "DATE(DATETIME_ADD(order_date, INTERVAL 3 HOUR))"
+DERIVED_COLUMN_TYPES = {
+    'main_category': "STRING",
+    'purchase_source': "STRING",
+    'is_service': "BOOL",
+    'is_service_adjustment': "BOOL",
+}
+
+# Days of business_date re-checked for lines appended without the category columns
+FILL_LOOKBACK_DAYS = 7
+
+# ==============================================================================
+# إعدادات إضافية (لا تحتاج للتعديل)
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+TABLE_REF = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+
+# ==============================================================================
+# الدوال الأساسية
+# ==============================================================================
+
+def is_partitioned(table):
+    partitioning = table.time_partitioning
+    return partitioning is not None and partitioning.field == PARTITION_COLUMN
+
+def rebuild_partitioned(client, table):
+    """
+    Copy the table aside, then recreate it partitioned on business_date.
+
+    The table is rebuilt from itself in one statement (the backup is only
+    kept for recovery), so nothing appended after the backup is lost. Lines
+    a loader appends while the rebuild statement itself runs can still be
+    overwritten: stop the loaders for the few minutes it takes.
+    """
+    # A new backup every run; CREATE TABLE fails instead of reusing an older copy
+    backup_ref = f"{TABLE_REF}_backup_{datetime.utcnow():%Y%m%d_%H%M%S}"
+    logging.info(f"Backing up {TABLE_ID} to {backup_ref}...")
+    client.query(f"CREATE TABLE `{backup_ref}` COPY `{TABLE_REF}`").result()
+
+    computed = {PARTITION_COLUMN: BUSINESS_DATE_SQL}
+    computed.update((name, DERIVED_COLUMNS[name]()) for name in DERIVED_COLUMN_TYPES)
+    existing = [field.name for field in table.schema if field.name in computed]
+    columns = f"* EXCEPT ({', '.join(existing)})" if existing else "*"
+    computed_sql = ", ".join(f"{sql} AS {name}" for name, sql in computed.items())
+    rebuild_query = f"""
+        CREATE OR REPLACE TABLE `{TABLE_REF}`
+        PARTITION BY {PARTITION_COLUMN}
+        CLUSTER BY {', '.join(CLUSTER_COLUMNS)}
+        AS
+        SELECT {columns}, {computed_sql}
+        FROM `{TABLE_REF}`
+    """
+    logging.info(f"Rebuilding {TABLE_ID} partitioned by {PARTITION_COLUMN}...")
+    client.query(rebuild_query).result()
+    logging.info(f"✅ {TABLE_ID} is partitioned by {PARTITION_COLUMN} and clustered by {', '.join(CLUSTER_COLUMNS)}.")
+
+def add_derived_columns(client, table):
+    """Add the category columns the table doesn't have yet. Returns True when any was added."""
+    existing = {field.name for field in table.schema}
+    missing = [name for name in DERIVED_COLUMN_TYPES if name not in existing]
+    if not missing:
+        return False
+    additions = ", ".join(f"ADD COLUMN IF NOT EXISTS {name} {DERIVED_COLUMN_TYPES[name]}" for name in missing)
+    client.query(f"ALTER TABLE `{TABLE_REF}` {additions}").result()
+    logging.info(f"Added columns {', '.join(missing)} to {TABLE_ID}.")
+    return True
+
+def fill_missing_columns(client, all_rows=False):
+    """
+    Set business_date and the category columns on rows appended without them.
+    Only the NULL partition and the last FILL_LOOKBACK_DAYS business days are
+    scanned, unless all_rows (the category columns were just added).
+    """
+    assignments = [f"{PARTITION_COLUMN} = COALESCE({PARTITION_COLUMN}, {BUSINESS_DATE_SQL})"]
+    assignments += [f"{name} = {DERIVED_COLUMNS[name]()}" for name in DERIVED_COLUMN_TYPES]
+    if all_rows:
+        condition = "TRUE"
+    else:
+        condition = f"""{PARTITION_COLUMN} IS NULL
+            OR ({PARTITION_COLUMN} >= DATE_SUB(CURRENT_DATE(), INTERVAL {FILL_LOOKBACK_DAYS} DAY)
+                AND is_service IS NULL AND product_category IS NOT NULL)"""
+    job = client.query(f"""
+        UPDATE `{TABLE_REF}`
+        SET {', '.join(assignments)}
+        WHERE {condition}
+    """)
+    job.result()
+    logging.info(f"✅ Filled {PARTITION_COLUMN} and the category columns on {job.num_dml_affected_rows or 0} rows.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition pos_order_lines by business_date")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the table even if it is already partitioned (stop the loaders first)")
+    parser.add_argument('--fill-only', action='store_true', help="Only fill missing business dates and category columns, never rebuild")
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    table = client.get_table(TABLE_REF)
+    if is_partitioned(table) and not args.rebuild:
+        logging.info(f"{TABLE_ID} is already partitioned by {PARTITION_COLUMN}.")
+        fill_missing_columns(client, all_rows=add_derived_columns(client, table))
+    elif args.fill_only:
+        logging.info(f"{TABLE_ID} is not partitioned by {PARTITION_COLUMN} yet. Nothing to fill.")
+    else:
+        rebuild_partitioned(client, table)
+
+# --- Main execution block ---
+if __name__ == "__main__":
+    logging.info("--- Starting pos_order_lines Partitioning Process ---")
+    try:
+        main()
+        logging.info("--- Partitioning Process Completed Successfully ---")
+    except Exception as e:
+        logging.critical(f"--- Partitioning Process Failed ---", exc_info=True)
+        sys.exit(1)
@@ -0,0 +1,66 @@
+# product_facts.py
+# This script rebuilds the per-barcode product facts table in BigQuery: the
+# current stock of each product joined with its last sale date and its sales
+# over the last 7/30/90 days. The inventory and stock endpoints read it instead
+# of joining stock_data with a fresh scan of pos_order_lines on every request.
+#
+# Run it nightly and after every stock_data update (inventory.py).
+
+import logging
+import os
+import sys
+from google.cloud import bigquery
+
+# The facts SQL is shared with the application, which computes it on the fly until the table exists
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from product_facts_source import product_facts_sql  # noqa: E402
+
+# ==============================================================================
+# الإعدادات الرئيسية
+# ==============================================================================
+
+# --- Google BigQuery Settings ---
+PROJECT_ID = "spartan-cedar-467808-p9"
+DATASET_ID = "Orders"
+ORDERS_TABLE_ID = "pos_order_lines"
+STOCK_TABLE_ID = "stock_data"
+FACTS_TABLE_ID = os.environ.get('PRODUCT_FACTS_TABLE_ID', 'product_facts')
+
+# ==============================================================================
+# إعدادات إضافية (لا تحتاج للتعديل)
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+ORDERS_TABLE = f"`{PROJECT_ID}.{DATASET_ID}.{ORDERS_TABLE_ID}`"
+STOCK_TABLE = f"`{PROJECT_ID}.{DATASET_ID}.{STOCK_TABLE_ID}`"
+FACTS_TABLE = f"`{PROJECT_ID}.{DATASET_ID}.{FACTS_TABLE_ID}`"
+
+# ==============================================================================
+# الدوال الأساسية
+# ==============================================================================
+
+def rebuild_product_facts(client):
+    """Replace the product facts table with a fresh build."""
+    query = f"""
+        CREATE OR REPLACE TABLE {FACTS_TABLE}
+        CLUSTER BY barcode
+        AS
+        {product_facts_sql(ORDERS_TABLE, STOCK_TABLE)}
+    """
+    logging.info(f"Rebuilding {FACTS_TABLE_ID}...")
+    job = client.query(query)
+    job.result()
+    logging.info(f"✅ Rebuild successful ({job.total_bytes_processed or 0:,} bytes processed).")
+
+def main():
+    client = bigquery.Client(project=PROJECT_ID)
+    rebuild_product_facts(client)
+
+# --- Main execution block ---
+if __name__ == "__main__":
+    logging.info("--- Starting Product Facts Process ---")
+    try:
+        main()
+        logging.info("--- Product Facts Process Completed Successfully ---")
+    except Exception as e:
+        logging.critical(f"--- Product Facts Process Failed ---", exc_info=True)
+        sys.exit(1)
@@ -0,0 +1,124 @@
+# data_versions.py
+# Per-table data versions used to invalidate cached results when the data changes
+
+import threading
+import time
+from config import Config
+
+# Tables the dashboards read; cache entries are tagged with a subset of these
+POS_ORDER_LINES = Config.TABLE_ID
+STOCK_DATA = "stock_data"
+INVENTORY_LEVELS_HISTORY = "inventory_levels_history"
+HISTORICAL_INVENTORY = "historical_inventory"
+DAILY_ROLLUP = Config.ROLLUP_TABLE_ID
+PRODUCT_FACTS = Config.PRODUCT_FACTS_TABLE_ID
+WATCHED_TABLES = (POS_ORDER_LINES, STOCK_DATA, INVENTORY_LEVELS_HISTORY, HISTORICAL_INVENTORY, DAILY_ROLLUP, PRODUCT_FACTS)
+
+_versions = {}
+_versions_lock = threading.Lock()
+_partition_fields = {}
+_table_columns = {}
+_unreadable_tables = set()
+_watcher_thread = None
+
+def get_version(table):
+    """Current version token of a table ('0' until the first metadata read)."""
+    with _versions_lock:
+        return _versions.get(table, '0')
+
+def versions_for(tables):
+    """Version tokens of the given tables, folded into cache keys."""
+    with _versions_lock:
+        return {table: _versions.get(table, '0') for table in sorted(tables)}
+
+def get_all_versions():
+    with _versions_lock:
+        return dict(_versions)
+
+def bump_version(table, version=None):
+    """
+    Set a new version for `table`, which makes every cache entry tagged with it unreachable.
+
+    Returns True when the version actually changed.
+    """
+    version = str(version) if version is not None else f"local-{time.time_ns()}"
+    with _versions_lock:
+        changed = _versions.get(table) != version
+        _versions[table] = version
+    if changed:
+        print(f"🔁 Data version of {table} is now {version}")
+    return changed
+
+def partition_field(table):
+    """Column a table is time-partitioned on, as of its last metadata read (None if unknown or unpartitioned)."""
+    return _partition_fields.get(table)
+
+def table_columns(table):
+    """Column names of a table as of its last metadata read (empty until then)."""
+    return _table_columns.get(table, frozenset())
+
+def table_modified(table):
+    """last_modified of a table from BigQuery metadata (no query job, no bytes scanned)."""
+    import database
+    if database.client is None:
+        return None
+    table_ref = f"{database.get_project_id()}.{database.get_dataset_id()}.{table}"
+    metadata = database.client.get_table(table_ref)
+    partitioning = getattr(metadata, 'time_partitioning', None)
+    _partition_fields[table] = partitioning.field if partitioning else None
+    _table_columns[table] = frozenset(field.name for field in metadata.schema or ())
+    modified = metadata.modified
+    return modified.isoformat() if modified else None
+
+def refresh_table_version(table):
+    """
+    Re-read a table's metadata and bump its version if it changed.
+
+    Uses the table's last_modified timestamp as the version so every worker
+    process (and a shared cache backend) agrees on the same key. Falls back to
+    a local token when the metadata cannot be read.
+    """
+    try:
+        modified = table_modified(table)
+    except Exception as e:
+        print(f"⚠️ Could not read metadata of {table}: {e}")
+        modified = None
+    if modified is None:
+        return bump_version(table)
+    return bump_version(table, modified)
+
+def poll_table_versions():
+    """Check every watched table once; returns the tables whose version changed."""
+    changed = []
+    for table in WATCHED_TABLES:
+        try:
+            modified = table_modified(table)
+        except Exception as e:
+            # Logged once per outage, not on every poll (e.g. a table the ETL hasn't built yet)
+            if table not in _unreadable_tables:
+                _unreadable_tables.add(table)
+                print(f"⚠️ Could not read metadata of {table}: {e}")
+            continue
+        if table in _unreadable_tables:
+            _unreadable_tables.discard(table)
+            print(f"✅ Metadata of {table} is readable again")
+        if modified is not None and bump_version(table, modified):
+            changed.append(table)
+    return changed
+
+def start_version_watcher(interval=None):
+    """Start the background thread that polls table metadata every `interval` seconds."""
+    global _watcher_thread
+    interval = interval or Config.DATA_VERSION_POLL_SECONDS
+    if _watcher_thread is not None or interval <= 0:
+        return _watcher_thread
+
+    def watch():
+        while True:
+            poll_table_versions()
+            time.sleep(interval)
+
+    _watcher_thread = threading.Thread(target=watch, name='data-version-watcher', daemon=True)
+    _watcher_thread.start()
+    print(f"✅ Data version watcher started (every {interval}s)")
+    return _watcher_thread
@@ -1,19 +1,41 @@
 
 # database.py
 # Database connection and query utilities
+import time
+from datetime import date, datetime
+from decimal import Decimal
 from cache import cache_query
+from data_versions import POS_ORDER_LINES, STOCK_DATA, INVENTORY_LEVELS_HISTORY, HISTORICAL_INVENTORY
 from google.cloud import bigquery
 from google.oauth2 import service_account
 from config import Config
 from performance_monitor import performance_monitor
+from request_timing import span, timed_rows
+from query_stats import record_job
+import local_mirror
+from utils import order_date_days_sql
+from category_rules import excluded_product_sql
+from query_budget import QueryTooLargeError, EmptyRows, current_budget, is_bytes_limit_error, is_estimating, record_estimate
+
+# Optional: Arrow results, downloaded through the BigQuery Storage Read API when available
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
 
 # Global variables for BigQuery client
 client = None
+bqstorage_client = None
 PROJECT_ID = None
 
 def init_bigquery_client():
     """Initialize the BigQuery client with credentials."""
-    global client, PROJECT_ID
+    global client, bqstorage_client, PROJECT_ID
     
     try:
         # Load credentials from file
@@ -21,6 +43,9 @@ def init_bigquery_client():
         client = bigquery.Client(credentials=credentials, project=credentials.project_id)
         PROJECT_ID = credentials.project_id
         
+        if bigquery_storage is not None and pyarrow is not None:
+            bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+        
         print(f"✅ BigQuery client initialized successfully for project: {PROJECT_ID}")
         return True
         
@@ -35,13 +60,250 @@ def init_bigquery_client():
         client = None
         return False
 
+def _to_query_parameter(name, value):
+    """Map a Python value to the matching BigQuery query parameter."""
+    if isinstance(value, (list, tuple, set)):
+        values = list(value)
+        element_type = _parameter_type(values[0]) if values else "STRING"
+        return bigquery.ArrayQueryParameter(name, element_type, values)
+    return bigquery.ScalarQueryParameter(name, _parameter_type(value), value)
+
+def _parameter_type(value):
+    """BigQuery type name for a Python value."""
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    if isinstance(value, Decimal):
+        return "NUMERIC"
+    if isinstance(value, datetime):
+        return "TIMESTAMP" if value.tzinfo else "DATETIME"
+    if isinstance(value, date):
+        return "DATE"
+    return "STRING"
+
+def _job_config(params=None, **options):
+    """Build the QueryJobConfig for a query with optional named parameters and job options."""
+    options = {name: value for name, value in options.items() if value is not None}
+    if not params and not options:
+        return None
+    return bigquery.QueryJobConfig(
+        query_parameters=[_to_query_parameter(name, value) for name, value in sorted((params or {}).items())],
+        **options
+    )
+
+def estimate_query_bytes(sql_query, params=None):
+    """Bytes a query would process, from a dry run (free, and no slots used)."""
+    if not client:
+        raise Exception("BigQuery client is not available. Check credential setup.")
+    return _dry_run_bytes(sql_query, params)
+
+@cache_query(cache_time=600)  # Table sizes change slowly
+def _dry_run_bytes(sql_query, params=None):
+    with span('bq'):
+        job = client.query(sql_query, job_config=_job_config(params, dry_run=True, use_query_cache=False))
+    return job.total_bytes_processed or 0
+
+def _check_budget(queries, max_bytes):
+    """
+    Resolve the byte budget for a set of (sql, params) queries.
+
+    Endpoints with their own budget are dry-run first and rejected with
+    QueryTooLargeError when any query would exceed it.
+    """
+    budget, dry_run = (max_bytes, True) if max_bytes else current_budget()
+    if budget and dry_run:
+        for sql_query, params in queries:
+            estimated = estimate_query_bytes(sql_query, params)
+            if estimated > budget:
+                raise QueryTooLargeError(budget, estimated)
+    return budget
+
+def _run_job(sql_query, params=None, max_bytes=None, page_size=None):
+    """Run one query job within its byte budget and return the raw RowIterator."""
+    budget = _check_budget([(sql_query, params)], max_bytes)
+    start = time.perf_counter()
+    job = None
+    try:
+        with span('bq'):
+            job = client.query(sql_query, job_config=_job_config(params, maximum_bytes_billed=budget))
+            results = job.result(page_size=page_size)
+    except Exception as e:
+        record_job(sql_query, job, time.perf_counter() - start, error=True)
+        if budget and is_bytes_limit_error(e):
+            raise QueryTooLargeError(budget) from e
+        raise
+    record_job(sql_query, job, time.perf_counter() - start)
+    return results
+
 @performance_monitor('bigquery_query')
-def run_query(sql_query):
-    """Execute a BigQuery query and return the results."""
+def run_query(sql_query, params=None, max_bytes=None, page_size=None):
+    """
+    Execute a BigQuery query (with optional @named parameters) and return the results.
+
+    `max_bytes` overrides the byte budget of the current endpoint (see query_budget.py).
+    `page_size` bounds how many rows are fetched per page while iterating.
+    """
     if not client:
         raise Exception("BigQuery client is not available. Check credential setup.")
     
-    return client.query(sql_query).result()
+    if is_estimating():
+        record_estimate(sql_query, estimate_query_bytes(sql_query, params))
+        return EmptyRows()
+    
+    # Served from the local DuckDB mirror when it holds fresh copies of the tables
+    local_rows = local_mirror.query(sql_query, params)
+    if local_rows is not None:
+        return local_rows
+    
+    return timed_rows(_run_job(sql_query, params, max_bytes, page_size))
+
+class ColumnTable:
+    """
+    Column-oriented query result used when pyarrow is not installed.
+
+    Implements the subset of the pyarrow.Table / RecordBatch API the routes
+    use (column_names, num_rows, column(), to_pydict(), to_pylist()), so code
+    written against run_query_arrow() works either way.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+
+    @classmethod
+    def from_rows(cls, rows, column_names):
+        columns = {name: [] for name in column_names}
+        for row in rows:
+            for name, value in zip(column_names, row.values()):
+                columns[name].append(value)
+        return cls(columns)
+
+    @property
+    def column_names(self):
+        return list(self._columns)
+
+    @property
+    def num_rows(self):
+        return len(next(iter(self._columns.values()), []))
+
+    def column(self, name):
+        return self._columns[name]
+
+    def to_pydict(self):
+        return {name: list(values) for name, values in self._columns.items()}
+
+    def to_pylist(self):
+        names = self.column_names
+        return [dict(zip(names, values)) for values in zip(*self._columns.values())]
+
+def _column_names(rows):
+    return [field.name for field in (rows.schema or [])]
+
+@performance_monitor('bigquery_query_arrow')
+def run_query_arrow(sql_query, params=None, max_bytes=None):
+    """
+    Execute a query and return the whole result in columnar form.
+
+    Returns a pyarrow.Table, downloaded as Arrow record batches through the
+    BigQuery Storage Read API when google-cloud-bigquery-storage is installed
+    (REST otherwise). Without pyarrow, a ColumnTable built from the REST rows
+    is returned instead.
+    """
+    if not client:
+        raise Exception("BigQuery client is not available. Check credential setup.")
+    
+    if is_estimating():
+        record_estimate(sql_query, estimate_query_bytes(sql_query, params))
+        return ColumnTable({})
+    
+    rows = _run_job(sql_query, params, max_bytes)
+    with span('rows'):
+        if pyarrow is not None:
+            return rows.to_arrow(bqstorage_client=bqstorage_client, create_bqstorage_client=False)
+        return ColumnTable.from_rows(rows, _column_names(rows))
+
+def iter_query_batches(sql_query, params=None, max_bytes=None, batch_size=5000):
+    """
+    Execute a query and yield its result as a sequence of column batches.
+
+    Batches are pyarrow.RecordBatch objects (from the Storage Read API when
+    available) or ColumnTable chunks of `batch_size` rows without pyarrow.
+    They are produced lazily, so a caller streaming them out keeps memory flat.
+    """
+    if not client:
+        raise Exception("BigQuery client is not available. Check credential setup.")
+    
+    if is_estimating():
+        record_estimate(sql_query, estimate_query_bytes(sql_query, params))
+        return iter(())
+    
+    rows = _run_job(sql_query, params, max_bytes, page_size=batch_size)
+    if pyarrow is not None:
+        return rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    return _column_batches(rows, batch_size)
+
+def _column_batches(rows, batch_size):
+    column_names = _column_names(rows)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch_size:
+            yield ColumnTable.from_rows(chunk, column_names)
+            chunk = []
+    if chunk:
+        yield ColumnTable.from_rows(chunk, column_names)
+
+@performance_monitor('bigquery_query_batch')
+def run_queries(*queries):
+    """Execute several independent BigQuery queries concurrently.
+
+    Each query is either a SQL string or a (sql, params) tuple. All jobs are
+    submitted before waiting on any of them, so the total wait is roughly the
+    slowest job instead of the sum of all jobs. Results are returned in the
+    same order as the queries.
+    """
+    if not client:
+        raise Exception("BigQuery client is not available. Check credential setup.")
+    
+    queries = [query if isinstance(query, tuple) else (query, None) for query in queries]
+    if is_estimating():
+        for sql_query, params in queries:
+            record_estimate(sql_query, estimate_query_bytes(sql_query, params))
+        return [EmptyRows() for _ in queries]
+    
+    local_results = [local_mirror.query(sql_query, params) for sql_query, params in queries]
+    remote = [query for query, local_rows in zip(queries, local_results) if local_rows is None]
+    if not remote:
+        return local_results
+    remote_results = iter(_run_jobs(remote))
+    return [local_rows if local_rows is not None else next(remote_results) for local_rows in local_results]
+
+def _run_jobs(queries):
+    """Submit every (sql, params) query as a BigQuery job, then wait for all of them."""
+    budget = _check_budget(queries, None)
+    start = time.perf_counter()
+    jobs = []
+    results = []
+    sqls = [sql_query for sql_query, _ in queries]
+    try:
+        with span('bq'):
+            for sql_query, params in queries:
+                jobs.append(client.query(sql_query, job_config=_job_config(params, maximum_bytes_billed=budget)))
+            for sql_query, job in zip(sqls, jobs):
+                results.append(job.result())
+                record_job(sql_query, job, time.perf_counter() - start)
+        return [timed_rows(result) for result in results]
+    except Exception as e:
+        # Don't leave sibling jobs burning slots when one of them fails
+        for sql_query, job in zip(sqls[len(results):], jobs[len(results):]):
+            record_job(sql_query, job, time.perf_counter() - start, error=True)
+            if not job.done():
+                job.cancel()
+        if budget and is_bytes_limit_error(e):
+            raise QueryTooLargeError(budget) from e
+        raise
 
 def get_project_id():
     """Get the current project ID."""
@@ -57,21 +319,25 @@ def get_table_id():
 
 
 # --- PRODUCTS PAGE QUERIES ---
-@cache_query(cache_time=300)  # Cache for 5 minutes (reduced for fresh data)
+# Calendar days (first, last) of the products page date filters; last=None is open-ended
+PRODUCTS_DATE_FILTERS = {
+    'today': ("CURRENT_DATE()", "CURRENT_DATE()"),
+    'yesterday': ("DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)", "DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)"),
+    'last_7_days': ("DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)", None),
+    'last_30_days': ("DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)", None),
+    'current_month': ("DATE_TRUNC(CURRENT_DATE(), MONTH)", "LAST_DAY(CURRENT_DATE())"),
+}
+
+def _products_date_condition(date_filter):
+    """'AND ...' date condition for a products page filter ('' for all dates)."""
+    if date_filter not in PRODUCTS_DATE_FILTERS:
+        return ""
+    return "AND " + order_date_days_sql(*PRODUCTS_DATE_FILTERS[date_filter])
+
+@cache_query(cache_time=300, stale_time=900, tables=(POS_ORDER_LINES,))  # Fresh for 5 minutes, served stale up to 15 more while refreshing
 def get_top_10_products(date_filter='all'):
     """Get top 10 products by total sales from pos_order_lines, excluding خدمات."""
-    # Build date filter condition
-    date_condition = ""
-    if date_filter == 'today':
-        date_condition = "AND DATE(order_date) = CURRENT_DATE()"
-    elif date_filter == 'yesterday':
-        date_condition = "AND DATE(order_date) = DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)"
-    elif date_filter == 'last_7_days':
-        date_condition = "AND DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)"
-    elif date_filter == 'last_30_days':
-        date_condition = "AND DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)"
-    elif date_filter == 'current_month':
-        date_condition = "AND EXTRACT(YEAR FROM order_date) = EXTRACT(YEAR FROM CURRENT_DATE()) AND EXTRACT(MONTH FROM order_date) = EXTRACT(MONTH FROM CURRENT_DATE())"
+    date_condition = _products_date_condition(date_filter)
     
     sql = f'''
         SELECT 
@@ -83,13 +349,9 @@ def get_top_10_products(date_filter='all'):
             MIN(DATE(order_date)) as first_sale_date,
             MAX(DATE(order_date)) as last_sale_date
         FROM `{get_project_id()}.{get_dataset_id()}.pos_order_lines`
-        WHERE product_name NOT LIKE '%خدمات%' 
-        AND product_name NOT LIKE '%خصومات%'
-        AND product_name NOT LIKE '%خدمة%'
-        AND product_name NOT LIKE '%خصم%'
+        WHERE NOT {excluded_product_sql()}
         AND product_barcode IS NOT NULL
         AND product_barcode != ''
-        AND SPLIT(product_category, '/')[SAFE_OFFSET(0)] != 'خدمات'
         {date_condition}
         GROUP BY product_name, product_barcode
         ORDER BY total_sales_value DESC
@@ -97,21 +359,10 @@ def get_top_10_products(date_filter='all'):
     '''
     return [dict(row) for row in run_query(sql)]
 
-@cache_query(cache_time=300)  # Cache for 5 minutes (reduced for fresh data)
+@cache_query(cache_time=300, stale_time=900, tables=(POS_ORDER_LINES,))  # Fresh for 5 minutes, served stale up to 15 more while refreshing
 def get_top_10_products_by_category(date_filter='all'):
     """Get top 10 products by category, excluding خدمات."""
-    # Build date filter condition
-    date_condition = ""
-    if date_filter == 'today':
-        date_condition = "AND DATE(order_date) = CURRENT_DATE()"
-    elif date_filter == 'yesterday':
-        date_condition = "AND DATE(order_date) = DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)"
-    elif date_filter == 'last_7_days':
-        date_condition = "AND DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)"
-    elif date_filter == 'last_30_days':
-        date_condition = "AND DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)"
-    elif date_filter == 'current_month':
-        date_condition = "AND EXTRACT(YEAR FROM order_date) = EXTRACT(YEAR FROM CURRENT_DATE()) AND EXTRACT(MONTH FROM order_date) = EXTRACT(MONTH FROM CURRENT_DATE())"
+    date_condition = _products_date_condition(date_filter)
     
     sql = f'''
         SELECT 
@@ -124,13 +375,9 @@ def get_top_10_products_by_category(date_filter='all'):
             MIN(DATE(order_date)) as first_sale_date,
             MAX(DATE(order_date)) as last_sale_date
         FROM `{get_project_id()}.{get_dataset_id()}.pos_order_lines`
-        WHERE product_name NOT LIKE '%خدمات%' 
-        AND product_name NOT LIKE '%خصومات%'
-        AND product_name NOT LIKE '%خدمة%'
-        AND product_name NOT LIKE '%خصم%'
+        WHERE NOT {excluded_product_sql()}
         AND product_barcode IS NOT NULL
         AND product_barcode != ''
-        AND SPLIT(product_category, '/')[SAFE_OFFSET(0)] != 'خدمات'
         {date_condition}
         GROUP BY main_category, product_name, product_barcode
         ORDER BY total_sales_value DESC
@@ -138,7 +385,7 @@ def get_top_10_products_by_category(date_filter='all'):
     '''
     return [dict(row) for row in run_query(sql)]
 
-@cache_query(cache_time=600)  # Cache for 10 minutes
+@cache_query(cache_time=21600, stale_time=3600, tables=(HISTORICAL_INVENTORY, INVENTORY_LEVELS_HISTORY))  # 6 hours; invalidated by new snapshots
 def get_latest_inventory_date():
     """Get the latest snapshot date from inventory tables."""
     try:
@@ -165,7 +412,7 @@ def get_latest_inventory_date():
     
     return None
 
-@cache_query(cache_time=600)  # Cache for 10 minutes
+@cache_query(cache_time=21600, stale_time=3600, tables=(HISTORICAL_INVENTORY,))  # 6 hours; invalidated by new snapshots
 def get_all_inventory_dates():
     """Get all available snapshot dates (latest first)."""
     sql = f'''
@@ -176,15 +423,14 @@ def get_all_inventory_dates():
     '''
     return [str(row['snapshot_date']) for row in run_query(sql)]
 
-@cache_query(cache_time=300)  # Cache for 5 minutes
+@cache_query(cache_time=3600, stale_time=900, tables=(STOCK_DATA, HISTORICAL_INVENTORY))  # 1 hour; invalidated by stock updates
 def get_products_info(barcodes, snapshot_date=None):
     """Get product info for a list of barcodes from stock_data table or latest inventory snapshot."""
     if not barcodes:
         return []
     
     # Limit to first 20 barcodes for performance
-    barcodes = barcodes[:20]
-    barcodes_str = ','.join([f'"{b}"' for b in barcodes])
+    barcodes = list(barcodes[:20])
     
     # If no snapshot_date specified, use latest available date
     if snapshot_date is None:
@@ -196,18 +442,21 @@ def get_products_info(barcodes, snapshot_date=None):
             SELECT *,
                 CURRENT_DATE() as snapshot_date
             FROM `{get_project_id()}.{get_dataset_id()}.stock_data`
-            WHERE Barcode IN ({barcodes_str})
+            WHERE Barcode IN UNNEST(@barcodes)
             LIMIT 50
         '''
-        return [dict(row) for row in run_query(sql)]
+        return [dict(row) for row in run_query(sql, {'barcodes': barcodes})]
     except Exception as e:
         print(f"Error querying stock_data: {e}")
         
     # Fallback: try historical_inventory for specific date
     try:
-        date_condition = f"AND snapshot_date = '{snapshot_date}'" if snapshot_date else ""
-        if not snapshot_date:
-            date_condition = '''AND snapshot_date = (
+        params = {'barcodes': barcodes}
+        date_condition = "AND snapshot_date = CAST(@snapshot_date AS DATE)"
+        if snapshot_date:
+            params['snapshot_date'] = str(snapshot_date)
+        else:
+            date_condition = f'''AND snapshot_date = (
                 SELECT MAX(snapshot_date) 
                 FROM `{get_project_id()}.{get_dataset_id()}.historical_inventory`
             )'''
@@ -222,35 +471,39 @@ def get_products_info(barcodes, snapshot_date=None):
                 available_quantity,
                 snapshot_date
             FROM `{get_project_id()}.{get_dataset_id()}.historical_inventory`
-            WHERE product_barcode IN ({barcodes_str})
+            WHERE product_barcode IN UNNEST(@barcodes)
             {date_condition}
             LIMIT 50
         '''
-        return [dict(row) for row in run_query(sql)]
+        return [dict(row) for row in run_query(sql, params)]
     except Exception as e:
         print(f"Error querying historical_inventory: {e}")
         return []
 
-@cache_query(cache_time=900)  # Cache for 15 minutes
+@cache_query(cache_time=3600, stale_time=2700, tables=(INVENTORY_LEVELS_HISTORY, HISTORICAL_INVENTORY))  # 1 hour; invalidated by new snapshots
 def get_products_stock_history(barcodes, days=30, end_date=None):
     """Get daily stock history for a list of barcodes from inventory_levels_history table."""
     if not barcodes:
         return []
     
     # Limit to first 5 barcodes for performance
-    barcodes = barcodes[:5]
-    barcodes_str = ','.join([f'"{b}"' for b in barcodes])
+    barcodes = list(barcodes[:5])
     
     # Build date filter - if end_date not specified, use latest date
     if end_date is None:
         end_date = get_latest_inventory_date()
     
-    date_condition = f'''
-        AND snapshot_date <= '{end_date}'
-        AND snapshot_date >= DATE_SUB('{end_date}', INTERVAL {days} DAY)
-    ''' if end_date else f'''
-        AND snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)
-    '''
+    params = {'barcodes': barcodes, 'days': int(days)}
+    if end_date:
+        params['end_date'] = str(end_date)
+        date_condition = '''
+            AND snapshot_date <= CAST(@end_date AS DATE)
+            AND snapshot_date >= DATE_SUB(CAST(@end_date AS DATE), INTERVAL @days DAY)
+        '''
+    else:
+        date_condition = '''
+            AND snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL @days DAY)
+        '''
     
     # Try inventory_levels_history first
     try:
@@ -258,12 +511,12 @@ def get_products_stock_history(barcodes, days=30, end_date=None):
             SELECT snapshot_date, product_barcode, product_name, 
                    on_hand_quantity, reserved_quantity, available_quantity
             FROM `{get_project_id()}.{get_dataset_id()}.inventory_levels_history`
-            WHERE product_barcode IN ({barcodes_str})
+            WHERE product_barcode IN UNNEST(@barcodes)
             {date_condition}
             ORDER BY snapshot_date ASC
             LIMIT 500
         '''
-        return [dict(row) for row in run_query(sql)]
+        return [dict(row) for row in run_query(sql, params)]
     except Exception as e:
         print(f"Error querying inventory_levels_history: {e}")
         
@@ -273,12 +526,12 @@ def get_products_stock_history(barcodes, days=30, end_date=None):
             SELECT snapshot_date, product_barcode, product_name, 
                    on_hand_quantity, reserved_quantity, available_quantity
             FROM `{get_project_id()}.{get_dataset_id()}.historical_inventory`
-            WHERE product_barcode IN ({barcodes_str})
+            WHERE product_barcode IN UNNEST(@barcodes)
             {date_condition}
             ORDER BY snapshot_date ASC
             LIMIT 500
         '''
-        return [dict(row) for row in run_query(sql)]
+        return [dict(row) for row in run_query(sql, params)]
     except Exception as e:
         print(f"Error querying historical_inventory: {e}")
         return []
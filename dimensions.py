@@ -0,0 +1,313 @@
+# dimensions.py
+# In-memory dimension values: the filter suggestions and the branch/location dropdowns
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from datetime import timedelta
+from category_rules import is_deposit_sql, line_column, non_merchandise_sql
+from config import Config
+from data_versions import POS_ORDER_LINES, INVENTORY_LEVELS_HISTORY, get_version, partition_field
+from search_index import normalize
+
+# Fields /api/suggest completes (and the filter builder compares exactly)
+SUGGEST_FIELDS = ('branch', 'employee', 'category', 'product', 'purchase_source')
+
+def _order_line_dimensions():
+    """Dimension -> SQL of its value on a pos_order_lines row (NULL when the row doesn't count)."""
+    service_line = f"{non_merchandise_sql(is_service=line_column('is_service'))} AND NOT {is_deposit_sql()}"
+    return {
+        'branch': "branch",
+        'employee': "employee_name",
+        'category': "product_category",
+        'product': "product_name",
+        'purchase_source': line_column('purchase_source'),
+        'service_branch': f"IF({service_line}, branch, NULL)",
+    }
+
+# Customer location (city of the delivery address) of an order line, for the customers page
+CUSTOMER_LOCATION_SQL = """
+    CASE
+        WHEN delivery_address IS NULL OR delivery_address = '' THEN 'غير محدد'
+        WHEN LOWER(delivery_address) LIKE '%الرياض%' THEN 'الرياض'
+        WHEN LOWER(delivery_address) LIKE '%جدة%' THEN 'جدة'
+        WHEN LOWER(delivery_address) LIKE '%الدمام%' THEN 'الدمام'
+        WHEN LOWER(delivery_address) LIKE '%مكة%' THEN 'مكة المكرمة'
+        WHEN LOWER(delivery_address) LIKE '%المدينة%' THEN 'المدينة المنورة'
+        WHEN LOWER(delivery_address) LIKE '%الطائف%' THEN 'الطائف'
+        WHEN LOWER(delivery_address) LIKE '%الخبر%' THEN 'الخبر'
+        WHEN LOWER(delivery_address) LIKE '%القطيف%' THEN 'القطيف'
+        WHEN LOWER(delivery_address) LIKE '%الأحساء%' THEN 'الأحساء'
+        WHEN LOWER(delivery_address) LIKE '%أبها%' THEN 'أبها'
+        WHEN LOWER(delivery_address) LIKE '%تبوك%' THEN 'تبوك'
+        WHEN LOWER(delivery_address) LIKE '%جازان%' THEN 'جازان'
+        WHEN LOWER(delivery_address) LIKE '%نجران%' THEN 'نجران'
+        WHEN LOWER(delivery_address) LIKE '%حائل%' THEN 'حائل'
+        WHEN LOWER(delivery_address) LIKE '%القصيم%' THEN 'القصيم'
+        ELSE 'أخرى'
+    END"""
+CUSTOMER_LINE_CONDITIONS = (
+    "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')",
+    "subtotal_incl > 0",
+)
+
+_WORD_STARTS = re.compile(r'(?:^|(?<=[\s/\-_.,()]))\w', re.UNICODE)
+
+class PrefixIndex:
+    """
+    Sorted prefix index of one dimension's values.
+
+    Every word of a value is a key, so "محلي" finds "ملابس / محلي"; matches
+    on the start of the value rank first, then shorter values.
+    """
+
+    def __init__(self, values):
+        self.values = sorted({value for value in values if value})
+        self._exact = set(self.values)
+        keys = set()
+        for value in self.values:
+            text = normalize(value)
+            for match in _WORD_STARTS.finditer(text):
+                keys.add((text[match.start():], match.start() == 0, value))
+        self._keys = sorted(keys)
+
+    def __contains__(self, value):
+        return value in self._exact
+
+    def __len__(self):
+        return len(self.values)
+
+    def merged(self, values):
+        """A new index with `values` added (self when there is nothing new)."""
+        new_values = {value for value in values if value} - self._exact
+        return PrefixIndex(self.values + list(new_values)) if new_values else self
+
+    def suggest(self, query, limit=10):
+        """Values with a word starting with `query`, best matches first."""
+        query = normalize(query)
+        if not query:
+            return self.values[:limit]
+        matches = {}
+        for key, at_start, value in self._keys[bisect_left(self._keys, (query,)):]:
+            if not key.startswith(query):
+                break
+            matches[value] = matches.get(value, False) or at_start
+        ranked = sorted(matches, key=lambda value: (not matches[value], len(value), value))
+        return ranked[:limit]
+
+class DimensionCache:
+    """
+    Dimension values of pos_order_lines and inventory_levels_history, kept
+    in memory so dropdowns and suggestions don't query BigQuery.
+
+    Order-line dimensions are loaded in full once, then refreshed
+    incrementally: each refresh only reads lines ordered after the newest
+    one already loaded and adds their values. A full reload every
+    DIMENSION_FULL_REFRESH_HOURS drops values that disappeared and picks up
+    lines loaded late with older dates. Inventory locations are reloaded
+    whenever inventory_levels_history changes. Refreshes are skipped while
+    a table's data version is unchanged, and a failed one keeps serving the
+    previous values.
+    """
+
+    def __init__(self):
+        self._indexes = None
+        self._locations = Counter()
+        self._watermark = None
+        self._version = None
+        self._full_loaded_at = 0
+        self._loaded_at = 0
+        self._inventory = None
+        self._inventory_version = None
+        self._inventory_loaded_at = 0
+        self._lock = threading.Lock()
+
+    # --- pos_order_lines ---
+
+    def _load_order_lines(self, since):
+        import database
+        table = f"`{database.get_project_id()}.{database.get_dataset_id()}.{POS_ORDER_LINES}`"
+        conditions, params = ["TRUE"], {}
+        if since is not None:
+            conditions.append("order_date > @since_datetime")
+            params['since_datetime'] = since
+            if partition_field(POS_ORDER_LINES) == 'business_date':
+                # A line's business day is never before the calendar day it was ordered on
+                conditions.append("(business_date >= @since_business_date OR business_date IS NULL)")
+                params['since_business_date'] = since.date()
+        where_sql = " AND ".join(conditions)
+        columns = ",\n                ".join(
+            f"ARRAY_AGG(DISTINCT {sql} IGNORE NULLS) AS {field}" for field, sql in _order_line_dimensions().items()
+        )
+        values_query = f"""
+            SELECT
+                MAX(order_date) AS last_order_date,
+                {columns}
+            FROM {table}
+            WHERE {where_sql}
+        """
+        locations_query = f"""
+            SELECT {CUSTOMER_LOCATION_SQL} AS location, COUNT(*) AS order_count
+            FROM {table}
+            WHERE {where_sql} AND {" AND ".join(CUSTOMER_LINE_CONDITIONS)}
+            GROUP BY location
+        """
+        values_rows, location_rows = database.run_queries((values_query, params or None), (locations_query, params or None))
+        values = list(values_rows)[0]
+        locations = Counter({row.location: int(row.order_count) for row in location_rows})
+        return values, locations
+
+    def refresh(self, force=False):
+        """Bring the order-line dimensions up to date; True when anything was read."""
+        version = get_version(POS_ORDER_LINES)
+        with self._lock:
+            if not force and self._indexes is not None and version != '0' and version == self._version:
+                return False
+            full = (force or self._indexes is None or self._watermark is None
+                    or time.time() - self._full_loaded_at >= Config.DIMENSION_FULL_REFRESH_HOURS * 3600)
+            start = time.perf_counter()
+            try:
+                values, locations = self._load_order_lines(None if full else self._watermark)
+            except Exception as e:
+                if self._indexes is None:
+                    raise
+                print(f"⚠️ Could not refresh the dimensions, serving the previous values: {e}")
+                return False
+
+            fields = _order_line_dimensions()
+            if full:
+                self._indexes = {field: PrefixIndex(values[field] or []) for field in fields}
+                self._locations = locations
+                self._full_loaded_at = time.time()
+            else:
+                self._indexes = {field: self._indexes[field].merged(values[field] or []) for field in fields}
+                self._locations = self._locations + locations
+            if values['last_order_date'] is not None:
+                self._watermark = max(self._watermark or values['last_order_date'], values['last_order_date'])
+            self._version, self._loaded_at = version, time.time()
+            indexes = self._indexes
+
+        sizes = ", ".join(f"{len(index)} {field}" for field, index in indexes.items())
+        kind = "loaded" if full else "refreshed"
+        print(f"✅ Dimensions {kind} ({sizes}) in {time.perf_counter() - start:.2f}s")
+        return True
+
+    def index(self, field):
+        """PrefixIndex of an order-line dimension, loading the dimensions on first use."""
+        if self._indexes is None:
+            self.refresh()
+        return self._indexes[field]
+
+    def customer_locations(self):
+        """Order-line count per customer location (Counter)."""
+        if self._indexes is None:
+            self.refresh()
+        return self._locations
+
+    # --- inventory_levels_history ---
+
+    def _load_inventory(self):
+        import database
+        query = f"""
+            SELECT DISTINCT
+                product_name,
+                product_barcode,
+                location_name
+            FROM `{database.get_project_id()}.{database.get_dataset_id()}.{INVENTORY_LEVELS_HISTORY}`
+            WHERE snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)
+            AND product_name IS NOT NULL
+            AND product_barcode IS NOT NULL
+            AND location_name IS NOT NULL
+            ORDER BY product_name, location_name
+            LIMIT 500
+        """
+        products, locations = {}, set()
+        for row in database.run_query(query):
+            products[row['product_barcode']] = {
+                'product_barcode': row['product_barcode'],
+                'product_name': row['product_name']
+            }
+            locations.add(row['location_name'])
+        return list(products.values()), sorted(locations)
+
+    def refresh_inventory(self, force=False):
+        """Reload the inventory products and locations if the table changed (or daily, as the window moves)."""
+        version = get_version(INVENTORY_LEVELS_HISTORY)
+        with self._lock:
+            fresh = time.time() - self._inventory_loaded_at < timedelta(days=1).total_seconds()
+            if not force and self._inventory is not None and version != '0' and version == self._inventory_version and fresh:
+                return False
+            try:
+                inventory = self._load_inventory()
+            except Exception as e:
+                if self._inventory is None:
+                    raise
+                print(f"⚠️ Could not refresh the inventory locations, serving the previous values: {e}")
+                return False
+            self._inventory, self._inventory_version, self._inventory_loaded_at = inventory, version, time.time()
+        print(f"✅ Inventory dimensions loaded ({len(inventory[0])} products, {len(inventory[1])} locations)")
+        return True
+
+    def inventory(self):
+        """(products, locations) of the inventory dropdowns."""
+        if self._inventory is None:
+            self.refresh_inventory()
+        return self._inventory
+
+    def status(self):
+        return {
+            'values': {field: len(index) for field, index in self._indexes.items()} if self._indexes else None,
+            'customer_locations': len(self._locations),
+            'inventory_locations': len(self._inventory[1]) if self._inventory else None,
+            'version': self._version,
+            'watermark': str(self._watermark) if self._watermark else None,
+            'age_seconds': round(time.time() - self._loaded_at, 1) if self._loaded_at else None
+        }
+
+dimension_cache = DimensionCache()
+_refresh_thread = None
+
+def suggest(field, query, limit=10):
+    return dimension_cache.index(field).suggest(query, limit)
+
+def get_branches():
+    """All branches of pos_order_lines, sorted."""
+    return dimension_cache.index('branch').values
+
+def get_service_branches():
+    """Branches with service lines, sorted."""
+    return dimension_cache.index('service_branch').values
+
+def get_customer_locations(min_count=0):
+    """[(location, order-line count)] with more than `min_count` lines, most lines first."""
+    return [(name, count) for name, count in dimension_cache.customer_locations().most_common() if count > min_count]
+
+def get_inventory_filters():
+    """(products, locations) for the inventory page's dropdowns."""
+    return dimension_cache.inventory()
+
+def get_dimensions_status():
+    return dimension_cache.status()
+
+def start_dimension_refresh(interval=None):
+    """Start the background thread that refreshes the dimensions every `interval` seconds."""
+    global _refresh_thread
+    interval = interval or Config.DIMENSION_REFRESH_SECONDS
+    if _refresh_thread is not None or interval <= 0:
+        return _refresh_thread
+
+    def refresh_forever():
+        while True:
+            for refresh in (dimension_cache.refresh, dimension_cache.refresh_inventory):
+                try:
+                    refresh()
+                except Exception as e:
+                    print(f"⚠️ Could not load the dimensions: {e}")
+            time.sleep(interval)
+
+    _refresh_thread = threading.Thread(target=refresh_forever, name='dimension-refresh', daemon=True)
+    _refresh_thread.start()
+    print(f"✅ Dimension refresh started (every {interval}s)")
+    return _refresh_thread
@@ -0,0 +1,130 @@
+# kpi_engine.py
+# Aggregates of the main dashboard's widgets, computed in one scan of the request's facts
+
+from cache import cache_query
+from category_rules import non_merchandise_sql
+from data_versions import POS_ORDER_LINES, DAILY_ROLLUP
+from database import run_query
+from rollup import get_fact_source
+
+ONLINE_BRANCH = 'المتجر الإلكتروني'
+
+# Row flags the grouping sets split on (see get_kpi_cube for which widget reads which set)
+FLAGS_SQL = {
+    'is_non_merchandise': non_merchandise_sql(),
+    # Sales by purchase source: categorized goods, marked-down goods left out
+    'is_source_sale': f"product_category LIKE '% / %' AND NOT ({non_merchandise_sql()} OR product_category LIKE '%بضاعة مخفضة%')",
+    # Sales by category: categorized lines that aren't services
+    'is_category_sale': "product_category LIKE '% / %' AND NOT is_service",
+}
+
+# grouping set -> its GROUP BY columns (_GROUPING_SET_SQL names the set of each result row)
+GROUPING_SETS = {
+    'seller': ('branch', 'employee_name'),
+    'branch': ('branch',),
+    'source': ('is_source_sale', 'source_key'),
+    'category': ('is_category_sale', 'is_non_merchandise', 'main_category', 'purchase_source'),
+    'total': (),
+}
+
+_GROUPING_SET_SQL = """CASE
+                    WHEN GROUPING(employee_name) = 0 THEN 'seller'
+                    WHEN GROUPING(branch) = 0 THEN 'branch'
+                    WHEN GROUPING(source_key) = 0 THEN 'source'
+                    WHEN GROUPING(main_category) = 0 THEN 'category'
+                    ELSE 'total'
+                END"""
+
+def kpi_cube_sql(facts):
+    """The GROUPING SETS query over `facts` (a rollup.FactSource)."""
+    flags = ",\n                    ".join(f"{sql} AS {name}" for name, sql in FLAGS_SQL.items())
+    group_columns = []
+    for columns in GROUPING_SETS.values():
+        group_columns += [column for column in columns if column not in group_columns]
+    grouping_sets = ", ".join(f"({', '.join(columns)})" for columns in GROUPING_SETS.values())
+
+    return f"""
+            WITH Facts AS (
+                {facts.sql}
+            ),
+            FlaggedFacts AS (
+                SELECT
+                    *,
+                    LOWER(purchase_source) AS source_key,
+                    {flags}
+                FROM Facts
+            )
+            SELECT
+                {_GROUPING_SET_SQL} AS grouping_set,
+                {', '.join(group_columns)},
+                SUM(line_count) AS line_count,
+                SUM(total_sales) AS total_sales,
+                SUM(IF(NOT is_non_merchandise, total_sales, 0)) AS sales_without_services,
+                SUM(profit) AS profit,
+                SUM(net_sales) AS net_sales,
+                SUM(gross_sales_without_vat) AS gross_sales_without_vat,
+                SUM(total_cost) AS total_cost,
+                SUM(quantity) AS quantity,
+                SUM(IF(NOT is_non_merchandise, quantity, 0)) AS merchandise_quantity,
+                -- Branch KPIs of the main cards (the online store spellings are the cards' own)
+                SUM(IF(branch != 'المتجر الالكتروني' AND NOT is_non_merchandise, quantity, 0)) AS store_items_sold,
+                SUM(IF(branch != 'المتجر الإلكتروني' AND NOT is_non_merchandise, returned_quantity, 0)) AS store_returned_quantity,
+                SUM(IF(branch != 'المتجر الإلكتروني' AND NOT is_non_merchandise, returned_value, 0)) AS store_returned_value,
+                SUM(IF(branch != 'المتجر الالكتروني' AND is_service AND NOT is_service_adjustment, sold_value, 0)) AS services_value,
+                SUM(IF(branch != 'المتجر الالكتروني' AND is_service AND NOT is_service_adjustment, returned_value, 0)) AS returned_services_value,
+                COUNT(DISTINCT receipt_key) AS invoice_count,
+                COUNT(DISTINCT customer_key) AS customer_count,
+                COUNT(DISTINCT work_day_key) AS work_days
+            FROM FlaggedFacts
+            GROUP BY GROUPING SETS ({grouping_sets})
+        """
+
+@cache_query(cache_time=300, stale_time=900, tables=(POS_ORDER_LINES, DAILY_ROLLUP))  # Fresh for 5 minutes, served stale up to 15 more while refreshing
+def _run_kpi_cube(sql, params):
+    rows = {name: [] for name in GROUPING_SETS}
+    for row in run_query(sql, params):
+        rows[row['grouping_set']].append(dict(row))
+    return rows
+
+def get_kpi_cube():
+    """
+    Rows of every grouping set for the current request's filters, as
+    {grouping set: [row dict]}:
+
+    - total: one row, the main KPI cards and the grand totals
+    - branch: per branch (branch sales and profits)
+    - seller: per branch and employee (top sellers)
+    - source: per is_source_sale flag and lower-cased purchase source (sales details)
+    - category: per is_category_sale/is_non_merchandise flags, main category and purchase source (top categories)
+
+    Every widget of one dashboard view reads the same cached result, so the
+    facts are scanned once per filter instead of once per widget.
+    """
+    facts = get_fact_source(distinct_keys=True)
+    return _run_kpi_cube(kpi_cube_sql(facts), facts.params)
+
+def total_row(cube):
+    """The 'total' row (an empty dict when there were no facts)."""
+    return cube['total'][0] if cube['total'] else {}
+
+def measure(row, name):
+    """A measure of a cube row, 0 for missing or NULL values."""
+    return row.get(name) or 0
+
+def category_sources(cube, merchandise_only=False):
+    """
+    Measures per (main category, purchase source) of the categorized,
+    non-service lines, summed over the is_non_merchandise split
+    (`merchandise_only` keeps the merchandise part only).
+    """
+    sources = {}
+    for row in cube['category']:
+        if row['is_category_sale'] is not True:
+            continue
+        if merchandise_only and row['is_non_merchandise'] is not False:
+            continue
+        key = (row['main_category'], row['purchase_source'])
+        totals = sources.setdefault(key, {'main_category': key[0], 'purchase_source': key[1], 'total_sales': 0, 'quantity': 0, 'profit': 0, 'net_sales': 0})
+        for name in ('total_sales', 'quantity', 'profit', 'net_sales'):
+            totals[name] += measure(row, name)
+    return list(sources.values())
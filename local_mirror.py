@@ -0,0 +1,527 @@
+# local_mirror.py
+# Local DuckDB/Parquet mirror of the POS tables, used to answer dashboard queries without BigQuery
+
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from google.cloud.bigquery.table import Row
+from config import Config
+from data_versions import POS_ORDER_LINES, STOCK_DATA, get_version, table_modified
+from performance_monitor import record_timing
+from query_stats import fingerprint
+from request_timing import span
+
+# Optional: the mirror needs DuckDB (query engine) and pyarrow (Parquet files)
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow.compute as pyarrow_compute
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow_compute = None
+    parquet = None
+
+# Mirrored tables -> watermark column for incremental sync (None: replaced on every sync)
+MIRRORED_TABLES = {
+    POS_ORDER_LINES: 'order_date',
+    STOCK_DATA: None,
+}
+
+STATE_FILE = 'state.json'
+LOCK_FILE = '.sync.lock'
+
+def is_available():
+    return duckdb is not None and parquet is not None
+
+def is_enabled():
+    return Config.LOCAL_MIRROR_ENABLED and is_available()
+
+# --- FILES AND STATE ---
+# One directory of Parquet part files per table, plus state.json with the
+# watermark and sync times. The state file is shared by every worker process.
+
+def _table_dir(table):
+    return os.path.join(Config.LOCAL_MIRROR_DIR, table)
+
+def _parts(table):
+    directory = _table_dir(table)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.parquet'))
+
+def _sql_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+def _parquet_glob(table):
+    return _sql_string(os.path.join(_table_dir(table), '*.parquet'))
+
+_state = {}
+_state_mtime = None
+_state_lock = threading.Lock()
+
+def _state_path():
+    return os.path.join(Config.LOCAL_MIRROR_DIR, STATE_FILE)
+
+def _load_state():
+    """Current mirror state, re-read from state.json whenever another process rewrote it."""
+    global _state, _state_mtime
+    try:
+        mtime = os.stat(_state_path()).st_mtime_ns
+    except OSError:
+        return {}
+    with _state_lock:
+        if mtime != _state_mtime:
+            try:
+                with open(_state_path(), encoding='utf-8') as f:
+                    _state = json.load(f)
+                _state_mtime = mtime
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Could not read local mirror state: {e}")
+                return {}
+        return _state
+
+def _save_table_state(table, entry):
+    state = dict(_load_state())
+    state[table] = entry
+    temp_path = f"{_state_path()}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, _state_path())
+
+def table_status(table, state=None):
+    """
+    'fresh' when the mirrored copy of `table` can answer queries, otherwise
+    'missing', 'expired' (not synced within LOCAL_MIRROR_MAX_AGE_SECONDS) or
+    'outdated' (BigQuery reports a newer modification than the synced one).
+    """
+    entry = (state if state is not None else _load_state()).get(table)
+    if not entry or not entry.get('synced_at'):
+        return 'missing'
+    if time.time() - entry['synced_at'] > Config.LOCAL_MIRROR_MAX_AGE_SECONDS:
+        return 'expired'
+    version = get_version(table)
+    if version != '0' and entry.get('source_version') and version != entry['source_version']:
+        return 'outdated'
+    return 'fresh'
+
+# --- SYNC ---
+
+@contextmanager
+def _sync_lock():
+    """Cross-process lock so only one worker (or cron run) syncs at a time; yields False if busy."""
+    os.makedirs(Config.LOCAL_MIRROR_DIR, exist_ok=True)
+    with open(os.path.join(Config.LOCAL_MIRROR_DIR, LOCK_FILE), 'w') as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+def _write_part(directory, data):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{time.time_ns()}.parquet")
+    parquet.write_table(data, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)  # Readers only glob *.parquet, so they never see a partial file
+
+def _swap_dir(table, new_dir):
+    """Put a freshly written table directory in place of the current one."""
+    target = _table_dir(table)
+    old_dir = f"{target}.old-{time.time_ns()}"
+    if os.path.isdir(target):
+        os.replace(target, old_dir)
+    os.replace(new_dir, target)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def _compact(table):
+    """Merge the part files into one once incremental syncs have produced too many."""
+    if len(_parts(table)) <= Config.LOCAL_MIRROR_MAX_PARTS:
+        return
+    new_dir = f"{_table_dir(table)}.compact-{os.getpid()}"
+    os.makedirs(new_dir, exist_ok=True)
+    target = _sql_string(os.path.join(new_dir, f"part-{time.time_ns()}.parquet"))
+    connection = duckdb.connect()
+    try:
+        connection.execute(f"COPY (SELECT * FROM read_parquet({_parquet_glob(table)}, union_by_name = true)) TO {target} (FORMAT PARQUET)")
+    finally:
+        connection.close()
+    _swap_dir(table, new_dir)
+
+def _parse_watermark(value):
+    return date.fromisoformat(value) if len(value) == 10 else datetime.fromisoformat(value)
+
+def _full_sync_due(entry):
+    hours = Config.LOCAL_MIRROR_FULL_SYNC_HOURS
+    return bool(hours) and time.time() - entry.get('full_synced_at', 0) > hours * 3600
+
+def sync_table(table, full=False):
+    """
+    Bring the local copy of `table` up to date with BigQuery.
+
+    Tables with a watermark column get only the rows past the last synced
+    value appended as a new part file; other tables (and the periodic full
+    sync, which also picks up late or corrected rows) are rewritten whole.
+    Nothing is queried when the table's last_modified hasn't changed.
+    Returns 'unchanged', 'incremental' or 'full'.
+    """
+    import database
+    started = time.time()
+    entry = dict(_load_state().get(table) or {})
+    try:
+        modified = table_modified(table)
+    except Exception as e:
+        print(f"⚠️ Could not read metadata of {table}: {e}")
+        modified = None
+    column = MIRRORED_TABLES[table]
+
+    if not full and _parts(table) and modified is not None and modified == entry.get('source_version'):
+        entry.update(synced_at=started, last_error=None)
+        _save_table_state(table, entry)
+        return 'unchanged'
+
+    full = full or not column or not entry.get('watermark') or not _parts(table) or _full_sync_due(entry)
+    source = f"`{database.get_project_id()}.{database.get_dataset_id()}.{table}`"
+    if full:
+        data = database.run_query_arrow(f"SELECT * FROM {source}")
+        new_dir = f"{_table_dir(table)}.new-{os.getpid()}"
+        shutil.rmtree(new_dir, ignore_errors=True)
+        _write_part(new_dir, data)
+        _swap_dir(table, new_dir)
+        entry.update(rows=data.num_rows, watermark=None, full_synced_at=started)
+    else:
+        data = database.run_query_arrow(
+            f"SELECT * FROM {source} WHERE {column} > @watermark",
+            {'watermark': _parse_watermark(entry['watermark'])}
+        )
+        if data.num_rows:
+            _write_part(_table_dir(table), data)
+            _compact(table)
+        entry['rows'] = entry.get('rows', 0) + data.num_rows
+
+    if column and data.num_rows:
+        newest = pyarrow_compute.max(data[column]).as_py()
+        if newest is not None:
+            entry['watermark'] = newest.isoformat()
+    entry.update(synced_at=started, source_version=modified, files=len(_parts(table)), last_error=None)
+    _save_table_state(table, entry)
+    return 'full' if full else 'incremental'
+
+def sync_mirror(full=False, tables=None):
+    """Sync every mirrored table (or `tables`); returns the outcome per table."""
+    if not is_available():
+        return {'status': 'unavailable', 'message': 'duckdb and pyarrow are required for the local mirror'}
+
+    with _sync_lock() as acquired:
+        if not acquired:
+            return {'status': 'busy', 'message': 'Another process is syncing the local mirror'}
+        results = {}
+        for table in tables or MIRRORED_TABLES:
+            start = time.perf_counter()
+            try:
+                results[table] = sync_table(table, full)
+                print(f"✅ Local mirror of {table}: {results[table]} sync in {time.perf_counter() - start:.2f}s")
+            except Exception as e:
+                print(f"❌ Local mirror sync of {table} failed: {e}")
+                entry = dict(_load_state().get(table) or {})
+                entry['last_error'] = str(e)
+                _save_table_state(table, entry)
+                results[table] = f"error: {e}"
+        return {'status': 'success', 'tables': results}
+
+_sync_thread = None
+
+def start_mirror_sync(interval=None):
+    """Start the background thread that keeps the mirror in sync every `interval` seconds."""
+    global _sync_thread
+    interval = interval or Config.LOCAL_MIRROR_SYNC_SECONDS
+    if _sync_thread is not None or interval <= 0 or not is_enabled():
+        return _sync_thread
+
+    def sync_forever():
+        while True:
+            sync_mirror()
+            time.sleep(interval)
+
+    _sync_thread = threading.Thread(target=sync_forever, name='local-mirror-sync', daemon=True)
+    _sync_thread.start()
+    print(f"✅ Local mirror sync started (every {interval}s) in {Config.LOCAL_MIRROR_DIR}")
+    return _sync_thread
+
+# --- SQL TRANSLATION ---
+# The endpoints' BigQuery SQL is rewritten into DuckDB SQL. Anything the
+# rewriter doesn't know is left for BigQuery: translation returns None, and a
+# query DuckDB fails to parse or bind is remembered and not tried again.
+
+class UnsupportedSQL(Exception):
+    pass
+
+_REWRITES = [
+    (re.compile(r"\bIN\s+UNNEST\s*\(\s*@(\w+)\s*\)", re.I), r"IN (SELECT unnest($\1))"),
+    (re.compile(r"@(\w+)"), r"$\1"),
+    (re.compile(r"\bCURRENT_DATE\s*\(\s*\)", re.I), "current_date"),
+    (re.compile(r"\bCURRENT_DATETIME\s*\(\s*\)", re.I), "CAST(current_timestamp AS TIMESTAMP)"),
+    (re.compile(r"\bCURRENT_TIMESTAMP\s*\(\s*\)", re.I), "current_timestamp"),
+    (re.compile(r"\bSAFE_DIVIDE\s*\(", re.I), "bq_safe_divide("),
+    (re.compile(r"\bSAFE_CAST\s*\(", re.I), "TRY_CAST("),
+    (re.compile(r"\bCOUNTIF\s*\(", re.I), "count_if("),
+    (re.compile(r"\bREGEXP_CONTAINS\s*\(", re.I), "regexp_matches("),
+    (re.compile(r"\bSPLIT\s*\(", re.I), "string_split("),
+    (re.compile(r"\[\s*(?:SAFE_)?OFFSET\s*\(\s*(\d+)\s*\)\s*\]", re.I), r"[\1 + 1]"),
+    (re.compile(r"\[\s*(?:SAFE_)?ORDINAL\s*\(\s*(\d+)\s*\)\s*\]", re.I), r"[\1]"),
+    (re.compile(r"\bAS\s+INT64\b"), "AS BIGINT"),
+    (re.compile(r"\bAS\s+FLOAT64\b"), "AS DOUBLE"),
+    (re.compile(r"\bAS\s+(?:BIG)?NUMERIC\b"), "AS DECIMAL(38, 9)"),
+    (re.compile(r"\bAS\s+STRING\b"), "AS VARCHAR"),
+    (re.compile(r"\bAS\s+DATETIME\b"), "AS TIMESTAMP"),
+]
+
+_BACKTICKS = re.compile(r"`([^`]+)`")
+_DATE_PARTS = r"MICROSECOND|MILLISECOND|SECOND|MINUTE|HOUR|DAY|WEEK|MONTH|QUARTER|YEAR"
+_INTERVAL = re.compile(rf"^INTERVAL\s+(.+?)\s+({_DATE_PARTS})$", re.I | re.S)
+_DATE_PART = re.compile(rf"^({_DATE_PARTS})$", re.I)
+_EXTRACT_PARTS = {'DAYOFWEEK': '(EXTRACT(dow FROM {}) + 1)', 'DAYOFYEAR': 'EXTRACT(doy FROM {})'}
+_CALLS = re.compile(
+    r"\b(DATE|(?:DATE|DATETIME|TIMESTAMP)_(?:ADD|SUB|DIFF|TRUNC)|FORMAT_(?:DATE|DATETIME|TIMESTAMP)|EXTRACT)\s*\(",
+    re.I
+)
+
+def _call_arguments(sql, open_paren):
+    """Top-level arguments of the call whose '(' is at sql[open_paren], and the index after its ')'."""
+    depth, quote, current = 0, None, open_paren + 1
+    arguments = []
+    index = open_paren
+    while index < len(sql):
+        char = sql[index]
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                arguments.append(sql[current:index].strip())
+                return arguments, index + 1
+        elif char == ',' and depth == 1:
+            arguments.append(sql[current:index].strip())
+            current = index + 1
+        index += 1
+    raise UnsupportedSQL("unbalanced parentheses")
+
+def _date_part(value):
+    if not _DATE_PART.match(value):
+        raise UnsupportedSQL(f"date part {value}")
+    return value.lower()
+
+def _rewrite_call(name, arguments):
+    kind = name.split('_')[0]
+    if name == 'DATE':
+        if len(arguments) == 1:
+            return f"CAST({arguments[0]} AS DATE)"
+        if len(arguments) == 3:
+            return f"make_date({', '.join(arguments)})"
+    elif name.endswith(('_ADD', '_SUB')) and len(arguments) == 2:
+        interval = _INTERVAL.match(arguments[1])
+        if interval:
+            operator = '-' if name.endswith('_SUB') else '+'
+            expression = f"({arguments[0]}) {operator} INTERVAL ({interval.group(1)}) {_date_part(interval.group(2))}"
+            if kind == 'TIMESTAMP':
+                return f"({expression})"
+            return f"CAST({expression} AS {'DATE' if kind == 'DATE' else 'TIMESTAMP'})"
+    elif name.endswith('_DIFF') and len(arguments) == 3:
+        return f"date_diff('{_date_part(arguments[2])}', {arguments[1]}, {arguments[0]})"
+    elif name.endswith('_TRUNC') and len(arguments) == 2:
+        truncated = f"date_trunc('{_date_part(arguments[1])}', {arguments[0]})"
+        return f"CAST({truncated} AS DATE)" if kind == 'DATE' else truncated
+    elif name.startswith('FORMAT_') and len(arguments) == 2:
+        return f"strftime({arguments[1]}, {arguments[0]})"
+    elif name == 'EXTRACT' and len(arguments) == 1:
+        part, _, source = arguments[0].partition(' FROM ')
+        template = _EXTRACT_PARTS.get(part.strip().upper())
+        return template.format(source) if template else f"EXTRACT({arguments[0]})"
+    raise UnsupportedSQL(f"{name} with {len(arguments)} arguments")
+
+def _rewrite_calls(sql):
+    """Rewrite BigQuery date functions whose arguments differ from DuckDB's (inner calls first)."""
+    pieces, position = [], 0
+    while True:
+        match = _CALLS.search(sql, position)
+        if not match:
+            break
+        arguments, end = _call_arguments(sql, match.end() - 1)
+        pieces.append(sql[position:match.start()])
+        pieces.append(_rewrite_call(match.group(1).upper(), [_rewrite_calls(argument) for argument in arguments]))
+        position = end
+    pieces.append(sql[position:])
+    return ''.join(pieces)
+
+@lru_cache(maxsize=512)
+def translate_sql(sql_query):
+    """
+    DuckDB version of a BigQuery query and the mirrored tables it reads, or
+    None when the query touches any table that isn't mirrored.
+    """
+    tables = set()
+
+    def replace_identifier(match):
+        name = match.group(1)
+        if '.' not in name:
+            return f'"{name}"'  # Quoted column name
+        table = name.rsplit('.', 1)[-1]
+        if table not in MIRRORED_TABLES:
+            raise UnsupportedSQL(f"table {name}")
+        tables.add(table)
+        return f'"{table}"'
+
+    try:
+        sql = _BACKTICKS.sub(replace_identifier, sql_query)
+        if not tables or 'INFORMATION_SCHEMA' in sql.upper():
+            return None
+        for pattern, replacement in _REWRITES:
+            sql = pattern.sub(replacement, sql)
+        return _rewrite_calls(sql), tuple(sorted(tables))
+    except UnsupportedSQL:
+        return None
+
+# --- QUERIES ---
+
+class LocalRows(list):
+    """Mirror query result: BigQuery Row objects, so callers can't tell it from a RowIterator."""
+
+    def __init__(self, column_names, values):
+        field_to_index = {name: index for index, name in enumerate(column_names)}
+        super().__init__(Row(row, field_to_index) for row in values)
+        self.total_rows = len(self)
+
+_SETUP_STATEMENTS = (
+    "SET TimeZone = 'UTC'",  # CURRENT_DATE() and DATE(timestamp) are UTC in BigQuery
+    "SET default_null_order = 'nulls_first_on_asc_last_on_desc'",  # BigQuery's NULL ordering
+    "CREATE MACRO bq_safe_divide(a, b) AS CASE WHEN b = 0 THEN NULL ELSE a / b END",
+)
+
+_database = None
+_database_lock = threading.Lock()
+_views_state = -1  # state.json mtime the views were created for
+_thread_local = threading.local()
+_unsupported_queries = set()
+_counters = {'served': 0, 'stale': 0, 'unsupported': 0, 'errors': 0}
+_counters_lock = threading.Lock()
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+def _cursor():
+    """Per-thread cursor on the shared in-memory DuckDB database holding the Parquet views."""
+    global _database, _views_state
+    with _database_lock:
+        if _database is None:
+            _database = duckdb.connect(database=':memory:')
+            for statement in _SETUP_STATEMENTS:
+                try:
+                    _database.execute(statement)
+                except duckdb.Error as e:
+                    print(f"⚠️ Local mirror setup statement failed ({statement}): {e}")
+        if _views_state != _state_mtime:
+            # Views glob the part files at query time; they only need redefining after a resync
+            for table in MIRRORED_TABLES:
+                if _parts(table):
+                    _database.execute(f'CREATE OR REPLACE VIEW "{table}" AS SELECT * FROM read_parquet({_parquet_glob(table)}, union_by_name = true)')
+            _views_state = _state_mtime
+    cursor = getattr(_thread_local, 'cursor', None)
+    if cursor is None:
+        cursor = _thread_local.cursor = _database.cursor()
+    return cursor
+
+def query(sql_query, params=None):
+    """
+    Answer a query from the local mirror.
+
+    Returns LocalRows, or None when the query must go to BigQuery: mirror
+    disabled, a table that isn't mirrored, a mirrored table that isn't fresh,
+    SQL the translation doesn't cover, or any DuckDB error.
+    """
+    if not is_enabled():
+        return None
+    query_id, _ = fingerprint(sql_query)
+    if query_id in _unsupported_queries:
+        return None
+    translated = translate_sql(sql_query)
+    if translated is None:
+        _count('unsupported')
+        return None
+
+    local_sql, tables = translated
+    state = _load_state()
+    if any(table_status(table, state) != 'fresh' for table in tables):
+        _count('stale')
+        return None
+
+    names = set(re.findall(r"\$(\w+)", local_sql))
+    bound = {name: value for name, value in (params or {}).items() if name in names}
+    start = time.perf_counter()
+    try:
+        with span('mirror'):
+            cursor = _cursor()
+            cursor.execute(local_sql, bound)
+            column_names = [column[0] for column in cursor.description]
+            rows = LocalRows(column_names, cursor.fetchall())
+    except Exception as e:
+        if isinstance(e, (duckdb.ParserException, duckdb.BinderException)):
+            _unsupported_queries.add(query_id)  # A dialect difference; don't retry this query
+        print(f"⚠️ Local mirror could not run query {query_id}, using BigQuery: {e}")
+        _count('errors')
+        return None
+
+    record_timing('local_mirror_query', time.perf_counter() - start)
+    _count('served')
+    return rows
+
+def get_mirror_status():
+    """Mirror configuration, per-table freshness and query routing counters."""
+    state = _load_state()
+    tables = {}
+    for table in MIRRORED_TABLES:
+        entry = state.get(table) or {}
+        tables[table] = {
+            'status': table_status(table, state),
+            'age_seconds': round(time.time() - entry['synced_at'], 1) if entry.get('synced_at') else None,
+            'rows': entry.get('rows'),
+            'files': entry.get('files'),
+            'watermark': entry.get('watermark'),
+            'last_error': entry.get('last_error')
+        }
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        'enabled': Config.LOCAL_MIRROR_ENABLED,
+        'available': is_available(),
+        'directory': Config.LOCAL_MIRROR_DIR,
+        'max_age_seconds': Config.LOCAL_MIRROR_MAX_AGE_SECONDS,
+        'tables': tables,
+        'queries': counters,
+        'unsupported_queries': len(_unsupported_queries)
+    }
+
+if __name__ == '__main__':
+    # Sync from cron instead of (or in addition to) the in-process thread:
+    #   python local_mirror.py [--full]
+    import sys
+    from database import init_bigquery_client
+    if init_bigquery_client():
+        print(json.dumps(sync_mirror(full='--full' in sys.argv), ensure_ascii=False, indent=2))
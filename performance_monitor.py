@@ -1,40 +1,172 @@
 # performance_monitor.py
 # Performance monitoring utilities for the Flask application
 
+import math
 import time
 import functools
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from collections import deque
 import threading
 
-# Thread-safe storage for performance metrics
+class LatencyHistogram:
+    """
+    Constant-memory latency histogram with logarithmic buckets (HDR-style).
+
+    Bucket boundaries grow by a fixed ratio, so any recorded value is known to
+    within ~4.5% regardless of magnitude, from 0.1 ms up to one hour.
+    """
+
+    MIN_VALUE = 0.0001   # 0.1 ms
+    MAX_VALUE = 3600.0   # 1 hour
+    RATIO = 2 ** (1 / 8)
+
+    _LOG_RATIO = math.log(RATIO)
+    BUCKET_COUNT = int(math.ceil(math.log(MAX_VALUE / MIN_VALUE) / _LOG_RATIO)) + 2
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKET_COUNT
+        self.total = 0
+
+    def _bucket(self, value):
+        if value <= self.MIN_VALUE:
+            return 0
+        index = int(math.log(value / self.MIN_VALUE) / self._LOG_RATIO) + 1
+        return min(index, self.BUCKET_COUNT - 1)
+
+    def _bucket_value(self, index):
+        """Geometric midpoint of a bucket."""
+        if index == 0:
+            return self.MIN_VALUE
+        return self.MIN_VALUE * self.RATIO ** (index - 0.5)
+
+    def record(self, value):
+        self.counts[self._bucket(value)] += 1
+        self.total += 1
+
+    def percentile(self, percent):
+        if self.total == 0:
+            return 0
+        threshold = self.total * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return self._bucket_value(index)
+        return self._bucket_value(self.BUCKET_COUNT - 1)
+
+class RollingCounter:
+    """
+    Call/error/time totals over the last 1 minute, 5 minutes and 1 hour.
+
+    Uses a ring of 10-second slots, so memory stays fixed however busy the
+    operation is.
+    """
+
+    SLOT_SECONDS = 10
+    SLOT_COUNT = 360  # 1 hour
+    WINDOWS = {'1m': 60, '5m': 300, '1h': 3600}
+
+    def __init__(self):
+        # Each slot: [slot_number, calls, errors, total_time]
+        self.slots = [[-1, 0, 0, 0.0] for _ in range(self.SLOT_COUNT)]
+
+    def record(self, now, execution_time, error):
+        slot_number = int(now // self.SLOT_SECONDS)
+        slot = self.slots[slot_number % self.SLOT_COUNT]
+        if slot[0] != slot_number:
+            slot[0], slot[1], slot[2], slot[3] = slot_number, 0, 0, 0.0
+        slot[1] += 1
+        slot[3] += execution_time
+        if error:
+            slot[2] += 1
+
+    def totals(self, now):
+        current = int(now // self.SLOT_SECONDS)
+        result = {}
+        for name, seconds in self.WINDOWS.items():
+            oldest = current - seconds // self.SLOT_SECONDS + 1
+            calls = errors = 0
+            total_time = 0.0
+            for slot_number, slot_calls, slot_errors, slot_time in self.slots:
+                if oldest <= slot_number <= current:
+                    calls += slot_calls
+                    errors += slot_errors
+                    total_time += slot_time
+            result[name] = {
+                'calls': calls,
+                'errors': errors,
+                'avg_time': round(total_time / calls, 4) if calls else 0
+            }
+        return result
+
+class OperationMetrics:
+    """Metrics of one monitored operation, guarded by its own lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.call_count = 0
+        self.total_time = 0.0
+        self.min_time = float('inf')
+        self.max_time = 0.0
+        self.errors = 0
+        self.histogram = LatencyHistogram()
+        self.rolling = RollingCounter()
+        self.recent_calls = deque(maxlen=20)  # (timestamp, execution_time, error)
+
+    def record(self, execution_time, error):
+        now = time.time()
+        with self.lock:
+            self.call_count += 1
+            self.total_time += execution_time
+            if execution_time < self.min_time:
+                self.min_time = execution_time
+            if execution_time > self.max_time:
+                self.max_time = execution_time
+            if error:
+                self.errors += 1
+            self.histogram.record(execution_time)
+            self.rolling.record(now, execution_time, error)
+            self.recent_calls.append((now, execution_time, error))
+
+# Registry of per-operation metrics. metrics_lock only guards creating
+# entries and iterating the registry; recording takes the operation's own lock.
 metrics_lock = threading.Lock()
-performance_metrics = defaultdict(lambda: {
-    'call_count': 0,
-    'total_time': 0,
-    'avg_time': 0,
-    'min_time': float('inf'),
-    'max_time': 0,
-    'recent_calls': deque(maxlen=100),  # Store last 100 calls
-    'errors': 0
-})
+performance_metrics = {}
+
+def get_operation_metrics(operation_name):
+    metrics = performance_metrics.get(operation_name)
+    if metrics is None:
+        with metrics_lock:
+            metrics = performance_metrics.setdefault(operation_name, OperationMetrics())
+    return metrics
+
+def record_timing(operation_name, execution_time, error=False):
+    """Record one call of `operation_name` that took `execution_time` seconds."""
+    get_operation_metrics(operation_name).record(execution_time, error)
+
+    # Log slow operations (> 5 seconds)
+    if execution_time > 5.0:
+        print(f"⚠️  SLOW OPERATION: {operation_name} took {execution_time:.2f}s")
+
+def _snapshot():
+    with metrics_lock:
+        return list(performance_metrics.items())
 
 def performance_monitor(operation_name):
     """
     Decorator to monitor the performance of functions.
-    
+
     Args:
         operation_name (str): Name to identify the operation in metrics
-    
+
     Returns:
         decorator: Function decorator that measures execution time
     """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            start_time = time.time()
+            start_time = time.perf_counter()
             error_occurred = False
-            
+
             try:
                 result = func(*args, **kwargs)
                 return result
@@ -42,80 +174,50 @@ def performance_monitor(operation_name):
                 error_occurred = True
                 raise e
             finally:
-                end_time = time.time()
-                execution_time = end_time - start_time
-                
-                # Update metrics in a thread-safe manner
-                with metrics_lock:
-                    metrics = performance_metrics[operation_name]
-                    metrics['call_count'] += 1
-                    metrics['total_time'] += execution_time
-                    metrics['avg_time'] = metrics['total_time'] / metrics['call_count']
-                    metrics['min_time'] = min(metrics['min_time'], execution_time)
-                    metrics['max_time'] = max(metrics['max_time'], execution_time)
-                    
-                    # Store recent call info
-                    call_info = {
-                        'timestamp': datetime.now(),
-                        'execution_time': execution_time,
-                        'error': error_occurred
-                    }
-                    metrics['recent_calls'].append(call_info)
-                    
-                    if error_occurred:
-                        metrics['errors'] += 1
-                
-                # Log slow operations (> 5 seconds)
-                if execution_time > 5.0:
-                    print(f"⚠️  SLOW OPERATION: {operation_name} took {execution_time:.2f}s")
-        
+                record_timing(operation_name, time.perf_counter() - start_time, error_occurred)
+
         return wrapper
     return decorator
 
 def get_performance_report():
     """
     Get a comprehensive performance report of all monitored operations.
-    
+
     Returns:
         dict: Performance metrics for all operations
     """
-    with metrics_lock:
-        report = {}
-        
-        for operation_name, metrics in performance_metrics.items():
+    report = {}
+    now = time.time()
+
+    for operation_name, metrics in _snapshot():
+        with metrics.lock:
             # Calculate recent performance (last 10 calls)
-            recent_calls = list(metrics['recent_calls'])[-10:]
-            recent_avg = 0
-            recent_errors = 0
-            
-            if recent_calls:
-                recent_times = [call['execution_time'] for call in recent_calls]
-                recent_avg = sum(recent_times) / len(recent_times)
-                recent_errors = sum(1 for call in recent_calls if call['error'])
-            
-            # Calculate calls per minute (last hour)
-            now = datetime.now()
-            hour_ago = now - timedelta(hours=1)
-            recent_calls_last_hour = [
-                call for call in metrics['recent_calls'] 
-                if call['timestamp'] > hour_ago
-            ]
-            calls_per_minute = len(recent_calls_last_hour) / 60 if recent_calls_last_hour else 0
-            
+            recent_calls = list(metrics.recent_calls)[-10:]
+            recent_avg = sum(call[1] for call in recent_calls) / len(recent_calls) if recent_calls else 0
+            recent_errors = sum(1 for call in recent_calls if call[2])
+
+            windows = metrics.rolling.totals(now)
+            call_count = metrics.call_count
+
             report[operation_name] = {
-                'total_calls': metrics['call_count'],
-                'total_time': round(metrics['total_time'], 2),
-                'avg_time': round(metrics['avg_time'], 4),
-                'min_time': round(metrics['min_time'], 4) if metrics['min_time'] != float('inf') else 0,
-                'max_time': round(metrics['max_time'], 4),
+                'total_calls': call_count,
+                'total_time': round(metrics.total_time, 2),
+                'avg_time': round(metrics.total_time / call_count, 4) if call_count else 0,
+                'min_time': round(metrics.min_time, 4) if metrics.min_time != float('inf') else 0,
+                'max_time': round(metrics.max_time, 4),
+                'p50_time': round(metrics.histogram.percentile(50), 4),
+                'p90_time': round(metrics.histogram.percentile(90), 4),
+                'p95_time': round(metrics.histogram.percentile(95), 4),
+                'p99_time': round(metrics.histogram.percentile(99), 4),
                 'recent_avg_time': round(recent_avg, 4),
-                'total_errors': metrics['errors'],
+                'total_errors': metrics.errors,
                 'recent_errors': recent_errors,
-                'calls_per_minute': round(calls_per_minute, 2),
-                'error_rate': round((metrics['errors'] / metrics['call_count'] * 100), 2) if metrics['call_count'] > 0 else 0
+                'calls_per_minute': round(windows['1h']['calls'] / 60, 2),
+                'windows': windows,
+                'error_rate': round((metrics.errors / call_count * 100), 2) if call_count > 0 else 0
             }
-        
-        return report
+
+    return report
 
 def clear_metrics():
     """
@@ -128,60 +230,62 @@ def clear_metrics():
 def get_slow_operations(threshold=2.0):
     """
     Get operations that are running slower than the threshold.
-    
+
     Args:
         threshold (float): Time threshold in seconds
-    
+
     Returns:
         list: List of operations with recent slow calls
     """
-    with metrics_lock:
-        slow_operations = []
-        
-        for operation_name, metrics in performance_metrics.items():
-            # Check recent calls for slow operations
-            recent_calls = list(metrics['recent_calls'])[-10:]
-            slow_calls = [call for call in recent_calls if call['execution_time'] > threshold]
-            
-            if slow_calls:
-                avg_slow_time = sum(call['execution_time'] for call in slow_calls) / len(slow_calls)
-                slow_operations.append({
-                    'operation': operation_name,
-                    'slow_calls_count': len(slow_calls),
-                    'avg_slow_time': round(avg_slow_time, 4),
-                    'recent_calls_count': len(recent_calls)
-                })
-        
-        return sorted(slow_operations, key=lambda x: x['avg_slow_time'], reverse=True)
+    slow_operations = []
+
+    for operation_name, metrics in _snapshot():
+        # Check recent calls for slow operations
+        with metrics.lock:
+            recent_calls = list(metrics.recent_calls)[-10:]
+        slow_calls = [call for call in recent_calls if call[1] > threshold]
+
+        if slow_calls:
+            avg_slow_time = sum(call[1] for call in slow_calls) / len(slow_calls)
+            slow_operations.append({
+                'operation': operation_name,
+                'slow_calls_count': len(slow_calls),
+                'avg_slow_time': round(avg_slow_time, 4),
+                'recent_calls_count': len(recent_calls)
+            })
+
+    return sorted(slow_operations, key=lambda x: x['avg_slow_time'], reverse=True)
 
 def get_error_summary():
     """
     Get a summary of operations with errors.
-    
+
     Returns:
         list: List of operations with error information
     """
-    with metrics_lock:
-        error_summary = []
-        
-        for operation_name, metrics in performance_metrics.items():
-            if metrics['errors'] > 0:
-                error_rate = (metrics['errors'] / metrics['call_count'] * 100) if metrics['call_count'] > 0 else 0
-                
-                # Check recent errors
-                recent_calls = list(metrics['recent_calls'])[-20:]
-                recent_errors = sum(1 for call in recent_calls if call['error'])
-                
-                error_summary.append({
-                    'operation': operation_name,
-                    'total_errors': metrics['errors'],
-                    'total_calls': metrics['call_count'],
-                    'error_rate': round(error_rate, 2),
-                    'recent_errors': recent_errors,
-                    'recent_calls': len(recent_calls)
-                })
-        
-        return sorted(error_summary, key=lambda x: x['error_rate'], reverse=True)
+    error_summary = []
+
+    for operation_name, metrics in _snapshot():
+        with metrics.lock:
+            errors, call_count = metrics.errors, metrics.call_count
+            recent_calls = list(metrics.recent_calls)
+
+        if errors > 0:
+            error_rate = (errors / call_count * 100) if call_count > 0 else 0
+
+            # Check recent errors
+            recent_errors = sum(1 for call in recent_calls if call[2])
+
+            error_summary.append({
+                'operation': operation_name,
+                'total_errors': errors,
+                'total_calls': call_count,
+                'error_rate': round(error_rate, 2),
+                'recent_errors': recent_errors,
+                'recent_calls': len(recent_calls)
+            })
+
+    return sorted(error_summary, key=lambda x: x['error_rate'], reverse=True)
 
 # Initialize monitoring
 print("✅ Performance monitor initialized")
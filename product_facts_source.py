@@ -0,0 +1,115 @@
+# product_facts_source.py
+# Per-barcode product facts (stock joined with recent sales) and the relation the stock endpoints read them from
+
+from cache import cache_query
+from category_rules import DERIVED_COLUMNS, line_column
+from data_versions import PRODUCT_FACTS, POS_ORDER_LINES, STOCK_DATA
+from database import run_query, get_project_id, get_dataset_id
+
+# Sales windows in days; each gets units_<n>d, revenue_<n>d and lines_<n>d columns
+SALES_WINDOWS = (7, 30, 90)
+
+# Days of sales the days-of-cover is based on
+COVER_WINDOW = 30
+
+def product_facts_sql(orders_table, stock_table):
+    """
+    One row per barcode in stock_data or with order lines (merchandise only) in pos_order_lines.
+
+    Order lines are those of "main / source" categories that aren't services.
+    Sales are their sold lines (quantity > 0); last_activity_date also counts
+    returns. Windows are calendar days counted back from today.
+    """
+    window_columns = []
+    for days in SALES_WINDOWS:
+        in_window = f"quantity > 0 AND order_date >= CAST(DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY) AS DATETIME)"
+        window_columns += [
+            f"SUM(IF({in_window}, quantity, 0)) AS units_{days}d",
+            f"SUM(IF({in_window}, subtotal_incl, 0)) AS revenue_{days}d",
+            f"COUNTIF({in_window}) AS lines_{days}d",
+        ]
+    window_names = [f"{kind}_{days}d" for days in SALES_WINDOWS for kind in ('units', 'revenue', 'lines')]
+    sales_sql = ",\n                ".join(window_columns)
+    facts_sql = ",\n            ".join(f"COALESCE(s.{name}, 0) AS {name}" for name in window_names)
+
+    return f"""
+        WITH Sales AS (
+            SELECT
+                product_barcode AS barcode,
+                MAX(IF(quantity > 0, product_name, NULL)) AS product_name,
+                MAX(IF(quantity > 0, DATE(order_date), NULL)) AS last_sale_date,
+                MAX(DATE(order_date)) AS last_activity_date,
+                {sales_sql}
+            FROM {orders_table}
+            WHERE product_barcode IS NOT NULL
+            AND product_category LIKE '% / %'
+            AND NOT {line_column('is_service')}
+            GROUP BY product_barcode
+        ),
+        Stock AS (
+            SELECT
+                Barcode AS barcode,
+                MAX(Product_Name) AS product_name,
+                MAX(Category) AS category,
+                SUM(Qty_On_Hand) AS qty_on_hand,
+                SUM(Reserved_Qty) AS reserved_qty,
+                SUM(Available_Qty) AS available_qty,
+                AVG(Unit_Cost) AS unit_cost,
+                SUM(Total_Cost) AS total_cost
+            FROM {stock_table}
+            WHERE Barcode IS NOT NULL
+            GROUP BY Barcode
+        )
+        SELECT
+            COALESCE(st.barcode, s.barcode) AS barcode,
+            COALESCE(st.product_name, s.product_name) AS product_name,
+            st.category,
+            {DERIVED_COLUMNS['main_category']('st.category')} AS main_category,
+            {DERIVED_COLUMNS['purchase_source']('st.category')} AS purchase_source,
+            {DERIVED_COLUMNS['is_service']('st.category')} AS is_service,
+            st.qty_on_hand,
+            st.reserved_qty,
+            st.available_qty,
+            st.unit_cost,
+            st.total_cost,
+            st.available_qty * st.unit_cost AS stock_value,
+            s.last_sale_date,
+            s.last_activity_date,
+            {facts_sql},
+            IF(s.units_{COVER_WINDOW}d > 0, ROUND(st.available_qty / (s.units_{COVER_WINDOW}d / {COVER_WINDOW}), 1), NULL) AS days_of_cover,
+            CURRENT_TIMESTAMP() AS built_at
+        FROM Stock st
+        FULL OUTER JOIN Sales s ON st.barcode = s.barcode
+    """
+
+def _table(table_id):
+    return f"`{get_project_id()}.{get_dataset_id()}.{table_id}`"
+
+@cache_query(cache_time=3600, stale_time=600, tables=(PRODUCT_FACTS,))  # Invalidated when the ETL rebuilds the facts
+def _product_facts_built():
+    rows = list(run_query(f"SELECT MAX(built_at) AS built_at FROM {_table(PRODUCT_FACTS)}"))
+    return bool(rows) and rows[0]['built_at'] is not None
+
+def product_facts_available():
+    """
+    Whether the product facts table has been built (False when it is missing
+    or empty). A failed read isn't cached, so the next request tries again.
+    """
+    try:
+        return _product_facts_built()
+    except Exception as e:
+        print(f"⚠️ Product facts table is not available: {e}")
+        return False
+
+def product_facts_relation():
+    """
+    The relation to read product facts from: the built table, or until the ETL
+    has built it, the same facts computed on the fly from stock_data and
+    pos_order_lines (same columns, a full scan per query).
+    """
+    if product_facts_available():
+        return _table(PRODUCT_FACTS)
+    return f"({product_facts_sql(_table(POS_ORDER_LINES), _table(STOCK_DATA))})"
+
+# Every table the facts depend on, for caches of results read through product_facts_relation()
+PRODUCT_FACTS_SOURCES = (PRODUCT_FACTS, POS_ORDER_LINES, STOCK_DATA)
@@ -0,0 +1,107 @@
+# query_budget.py
+# Per-endpoint BigQuery byte budgets, dry-run estimation and the query-too-large error
+
+from flask import g, has_request_context, request
+from config import Config
+
+class QueryTooLargeError(Exception):
+    """Raised instead of running a query that would scan more than its byte budget."""
+
+    def __init__(self, budget_bytes, estimated_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.estimated_bytes = estimated_bytes
+        if estimated_bytes is not None:
+            message = f"Query would process {format_bytes(estimated_bytes)}, over the budget of {format_bytes(budget_bytes)}"
+        else:
+            message = f"Query would bill more than the budget of {format_bytes(budget_bytes)}"
+        super().__init__(f"{message} - narrow the date range or filters")
+
+    def to_dict(self):
+        return {
+            "status": "error",
+            "error": "query_too_large",
+            "message": "الاستعلام كبير جداً، يرجى تضييق نطاق التاريخ أو الفلاتر",
+            "details": str(self),
+            "estimated_bytes": self.estimated_bytes,
+            "budget_bytes": self.budget_bytes
+        }
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def _current_rule():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return None
+
+def current_budget():
+    """
+    Byte budget for queries of the current request.
+
+    Returns (budget_bytes, dry_run): endpoints listed in QUERY_BYTE_BUDGETS get
+    their own budget and are checked with a dry run first; everything else only
+    gets QUERY_MAX_BYTES_BILLED as a hard limit on the job when it is set.
+    """
+    rule = _current_rule()
+    if rule in Config.QUERY_BYTE_BUDGETS:
+        return Config.QUERY_BYTE_BUDGETS[rule], True
+    return Config.QUERY_MAX_BYTES_BILLED or None, False
+
+def is_bytes_limit_error(error):
+    """True for BigQuery's rejection of a job that would exceed maximum_bytes_billed."""
+    for detail in getattr(error, 'errors', None) or []:
+        if isinstance(detail, dict) and detail.get('reason') == 'bytesBilledLimitExceeded':
+            return True
+    return 'bytesBilledLimitExceeded' in str(error)
+
+# --- ESTIMATE MODE ---
+# While estimating, run_query only dry-runs queries and returns empty results,
+# so a view function can be executed to collect the bytes its queries would scan.
+
+class EmptyRows(list):
+    """Stand-in for a RowIterator with no rows."""
+    total_rows = 0
+
+def is_estimating():
+    return has_request_context() and g.get('query_estimates') is not None
+
+def record_estimate(sql, estimated_bytes):
+    g.query_estimates.append({'sql': sql, 'estimated_bytes': estimated_bytes})
+
+def estimate_view(app, path, query_string):
+    """
+    Dry-run every query the view at `path` would run for `query_string`.
+
+    Returns a dict with the total and per-query estimated bytes and the budget
+    that applies to the endpoint. Only endpoints listed in QUERY_BYTE_BUDGETS
+    can be estimated (ValueError otherwise): the view really runs, so any
+    side effect or thread it starts would not be a dry run.
+    """
+    adapter = app.url_map.bind('localhost')
+    rule, view_args = adapter.match(path, method='GET', return_rule=True)
+    if rule.rule not in Config.QUERY_BYTE_BUDGETS:
+        raise ValueError(f"{path} has no query byte budget to estimate against")
+    endpoint = rule.endpoint
+    with app.test_request_context(path, query_string=query_string):
+        g.query_estimates = []
+        try:
+            app.view_functions[endpoint](**view_args)
+        except Exception as e:
+            # Views may choke on empty results; the estimates are what we want
+            print(f"⚠️ View raised during estimate of {path}: {e}")
+        estimates = g.query_estimates
+        budget, _ = current_budget()
+
+    total = sum(item['estimated_bytes'] for item in estimates)
+    return {
+        'endpoint': path,
+        'queries': len(estimates),
+        'estimated_bytes': total,
+        'estimated': format_bytes(total),
+        'budget_bytes': budget,
+        'exceeds_budget': bool(budget) and any(item['estimated_bytes'] > budget for item in estimates)
+    }
@@ -0,0 +1,122 @@
+# query_stats.py
+# BigQuery job statistics grouped by normalized query fingerprint
+
+import hashlib
+import re
+import threading
+from flask import has_request_context, request
+
+MAX_FINGERPRINTS = 500
+SAMPLE_SQL_LENGTH = 600
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBERS = re.compile(r"(?<![\w.@`-])\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"IN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_WHITESPACE = re.compile(r"\s+")
+
+_stats = {}
+_stats_lock = threading.Lock()
+_dropped_jobs = 0
+
+def normalize_sql(sql):
+    """Strip comments and literals so queries differing only in values share a fingerprint."""
+    sql = _COMMENTS.sub(' ', sql)
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _IN_LISTS.sub('IN (?)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+def fingerprint(sql):
+    normalized = normalize_sql(sql)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+def _current_endpoint():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'background'
+
+def record_job(sql, job, latency, error=False):
+    """Record the statistics of one finished (or failed) BigQuery job."""
+    global _dropped_jobs
+    query_id, normalized = fingerprint(sql)
+    endpoint = _current_endpoint()
+
+    bytes_processed = getattr(job, 'total_bytes_processed', None) or 0
+    bytes_billed = getattr(job, 'total_bytes_billed', None) or 0
+    slot_millis = getattr(job, 'slot_millis', None) or 0
+    cache_hit = bool(getattr(job, 'cache_hit', False))
+
+    with _stats_lock:
+        stats = _stats.get(query_id)
+        if stats is None:
+            if len(_stats) >= MAX_FINGERPRINTS:
+                _dropped_jobs += 1
+                return
+            stats = _stats[query_id] = {
+                'fingerprint': query_id,
+                'sql': normalized[:SAMPLE_SQL_LENGTH],
+                'calls': 0,
+                'errors': 0,
+                'cache_hits': 0,
+                'total_bytes_processed': 0,
+                'total_bytes_billed': 0,
+                'total_slot_millis': 0,
+                'total_latency': 0.0,
+                'max_latency': 0.0,
+                'endpoints': {}
+            }
+        stats['calls'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['cache_hits'] += 1 if cache_hit else 0
+        stats['total_bytes_processed'] += bytes_processed
+        stats['total_bytes_billed'] += bytes_billed
+        stats['total_slot_millis'] += slot_millis
+        stats['total_latency'] += latency
+        stats['max_latency'] = max(stats['max_latency'], latency)
+        stats['endpoints'][endpoint] = stats['endpoints'].get(endpoint, 0) + 1
+
+SORT_KEYS = {
+    'bytes': 'total_bytes_billed',
+    'processed': 'total_bytes_processed',
+    'slot': 'total_slot_millis',
+    'latency': 'total_latency',
+    'calls': 'calls'
+}
+
+def get_query_stats(sort_by='bytes', limit=20):
+    """Rank query fingerprints by total bytes billed, slot time, latency or call count."""
+    sort_key = SORT_KEYS.get(sort_by, SORT_KEYS['bytes'])
+    with _stats_lock:
+        entries = [dict(stats, endpoints=dict(stats['endpoints'])) for stats in _stats.values()]
+        dropped = _dropped_jobs
+
+    for entry in entries:
+        calls = entry['calls']
+        entry['avg_latency'] = round(entry['total_latency'] / calls, 4) if calls else 0
+        entry['total_latency'] = round(entry['total_latency'], 4)
+        entry['max_latency'] = round(entry['max_latency'], 4)
+        entry['cache_hit_ratio'] = round(entry['cache_hits'] / calls * 100, 2) if calls else 0
+        entry['total_gb_billed'] = round(entry['total_bytes_billed'] / 1024 ** 3, 4)
+
+    total_jobs = sum(entry['calls'] for entry in entries)
+    total_cache_hits = sum(entry['cache_hits'] for entry in entries)
+    return {
+        'summary': {
+            'fingerprints': len(entries),
+            'total_jobs': total_jobs,
+            'total_bytes_processed': sum(entry['total_bytes_processed'] for entry in entries),
+            'total_bytes_billed': sum(entry['total_bytes_billed'] for entry in entries),
+            'total_slot_millis': sum(entry['total_slot_millis'] for entry in entries),
+            'cache_hit_ratio': round(total_cache_hits / total_jobs * 100, 2) if total_jobs else 0,
+            'untracked_jobs': dropped
+        },
+        'sorted_by': sort_by if sort_by in SORT_KEYS else 'bytes',
+        'queries': sorted(entries, key=lambda entry: entry[sort_key], reverse=True)[:limit]
+    }
+
+def clear_query_stats():
+    global _dropped_jobs
+    with _stats_lock:
+        _stats.clear()
+        _dropped_jobs = 0
@@ -0,0 +1,113 @@
+# request_timing.py
+# Per-request timing middleware with a Server-Timing breakdown
+
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from performance_monitor import record_timing
+
+# Spans reported in Server-Timing, in display order, with their descriptions
+SPAN_DESCRIPTIONS = {
+    'cache': 'Cache lookup',
+    'mirror': 'Local mirror query',
+    'bq': 'BigQuery job wait',
+    'rows': 'Row materialization',
+    'json': 'JSON serialization',
+}
+
+def _spans():
+    if has_request_context():
+        return g.get('timing_spans')
+    return None
+
+def add_span_time(name, seconds):
+    """Add `seconds` to span `name` of the current request (no-op outside requests)."""
+    spans = _spans()
+    if spans is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+@contextmanager
+def span(name):
+    """Time a block of code as part of span `name` of the current request."""
+    if _spans() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span_time(name, time.perf_counter() - start)
+
+class TimedRows:
+    """
+    Wraps a BigQuery RowIterator so the time spent producing rows (page fetches
+    and Row construction) is counted in the 'rows' span. Every other attribute
+    (total_rows, schema, ...) is delegated to the wrapped iterator.
+    """
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def __iter__(self):
+        iterator = iter(self._rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                add_span_time('rows', time.perf_counter() - start)
+                return
+            add_span_time('rows', time.perf_counter() - start)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._rows, name)
+
+def timed_rows(rows):
+    """Wrap query results for row timing when called inside an instrumented request."""
+    return TimedRows(rows) if _spans() is not None else rows
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Default JSON provider that counts serialization time in the 'json' span."""
+
+    def dumps(self, obj, **kwargs):
+        with span('json'):
+            return super().dumps(obj, **kwargs)
+
+def init_request_timing(app):
+    """
+    Time every request and report where the time went.
+
+    Per-endpoint totals and spans are recorded in performance_monitor as
+    'request <rule>' and 'request <rule> [span]'. The same breakdown is sent
+    to the browser in the Server-Timing header (visible in devtools).
+    """
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.timing_spans = {}
+
+    @app.after_request
+    def record_request_timing(response):
+        start = g.pop('request_start', None)
+        spans = g.pop('timing_spans', None)
+        if start is None or request.url_rule is None or request.endpoint == 'static':
+            return response
+
+        total = time.perf_counter() - start
+        operation = f"request {request.url_rule.rule}"
+        record_timing(operation, total, response.status_code >= 500)
+
+        entries = []
+        for name, description in SPAN_DESCRIPTIONS.items():
+            if name in spans:
+                record_timing(f"{operation} [{name}]", spans[name])
+                entries.append(f'{name};dur={spans[name] * 1000:.1f};desc="{description}"')
+        app_time = max(total - sum(spans.values()), 0.0)
+        entries.append(f'app;dur={app_time * 1000:.1f};desc="Python"')
+        entries.append(f'total;dur={total * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+        return response
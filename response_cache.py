@@ -0,0 +1,126 @@
+# response_cache.py
+# Route-level HTTP response caching with strong ETags for JSON API blueprints
+
+import gzip
+import hashlib
+import json
+from datetime import date
+from urllib.parse import urlencode
+from flask import request, g
+from cache import get_cache_backend
+from config import Config
+from data_versions import versions_for
+from request_timing import span
+
+def _response_cache_key(tables):
+    """
+    Route path plus the query string with parameters sorted (so ?a=1&b=2 == ?b=2&a=1).
+
+    Also includes today's date, since routes default to the current day when no
+    date filter is given, and the data versions of the tables the routes read.
+    """
+    query = urlencode(sorted(request.args.items(multi=True)))
+    versions = json.dumps(versions_for(tables), sort_keys=True)
+    digest = hashlib.sha256(f"{request.path}?{query}|{date.today().isoformat()}|{versions}".encode('utf-8')).hexdigest()
+    return f"response:{digest}"
+
+def _etag_matches(etag):
+    return etag in request.if_none_match or '*' in request.if_none_match
+
+def _accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+def _cacheable(response):
+    return (
+        request.method == 'GET'
+        and response.status_code == 200
+        and response.mimetype == 'application/json'
+        and not response.is_streamed
+        and not response.direct_passthrough
+        and 'Content-Encoding' not in response.headers
+    )
+
+def _bypass():
+    return not Config.RESPONSE_CACHE_ENABLED or 'no-cache' in request.headers.get('Cache-Control', '')
+
+def _serve(entry, owner):
+    """Build a response from a cached entry, answering If-None-Match with 304."""
+    from flask import current_app
+    use_gzip = entry['gzip'] and _accepts_gzip()
+    etag = entry['etag'] + ('-gz' if use_gzip else '')
+
+    if _etag_matches(etag):
+        response = current_app.response_class(status=304)
+    else:
+        body = entry['body'] if use_gzip or not entry['gzip'] else gzip.decompress(entry['body'])
+        response = current_app.response_class(body, status=200, mimetype=entry['mimetype'])
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Cache'] = 'HIT'
+    if entry['gzip']:
+        response.vary.add('Accept-Encoding')
+    print(f"✅ Response cache hit for {owner} {request.path}")
+    return response
+
+def enable_response_cache(blueprint, ttl, tables=()):
+    """
+    Cache successful JSON GET responses of every route in `blueprint` for `ttl` seconds.
+
+    The serialized body is stored in the query cache backend (gzip-compressed
+    above RESPONSE_CACHE_COMPRESS_MIN_BYTES), so a repeat request costs neither
+    a BigQuery job nor JSON encoding. Responses carry a strong ETag and
+    `If-None-Match` revalidations are answered with 304. Entries are dropped
+    as soon as one of `tables` gets a new data version.
+    """
+    owner = f"route:{blueprint.name}"
+
+    @blueprint.before_request
+    def serve_cached_response():
+        if request.method != 'GET' or _bypass():
+            return None
+        with span('cache'):
+            g.response_cache_key = _response_cache_key(tables)
+            found, entry, _ = get_cache_backend().get(g.response_cache_key, owner)
+        if found:
+            return _serve(entry, owner)
+        return None
+
+    @blueprint.after_request
+    def store_response(response):
+        cache_key = g.pop('response_cache_key', None)
+        if cache_key is None or response.headers.get('X-Cache') == 'HIT' or not _cacheable(response):
+            return response
+
+        body = response.get_data()
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        compress = len(body) >= Config.RESPONSE_CACHE_COMPRESS_MIN_BYTES
+        with span('cache'):
+            stored = gzip.compress(body, compresslevel=5) if compress else body
+            get_cache_backend().set(cache_key, {
+                'body': stored,
+                'gzip': compress,
+                'etag': etag,
+                'mimetype': response.mimetype
+            }, ttl, owner)
+
+        if compress and _accepts_gzip():
+            etag += '-gz'
+            response.set_data(stored)
+            response.headers['Content-Encoding'] = 'gzip'
+        if compress:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Cache'] = 'MISS'
+
+        if _etag_matches(etag):
+            # Same representation the client already has
+            response.status_code = 304
+            response.set_data(b'')
+            response.headers.pop('Content-Encoding', None)
+        return response
+
+    return blueprint
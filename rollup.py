@@ -0,0 +1,178 @@
+# rollup.py
+# Business-day rollup of pos_order_lines and the fact source the dashboard queries aggregate
+
+from datetime import datetime, time, timedelta
+from cache import cache_query
+from category_rules import DERIVED_COLUMNS, line_column
+from config import Config
+from data_versions import DAILY_ROLLUP
+from database import run_query, get_project_id, get_dataset_id, get_table_id
+from utils import (QueryFilter, add_business_date_range, business_date_of, get_business_datetime_range,
+                   get_user_filters, has_line_level_filters)
+
+# Dimensions of the rollup grain; the category-derived ones are defined in category_rules
+DIMENSIONS = ('business_date', 'branch', 'employee_name', 'product_category',
+              'main_category', 'purchase_source', 'is_service', 'is_service_adjustment')
+BUSINESS_DATE_SQL = "DATE(DATETIME_ADD(order_date, INTERVAL 3 HOUR))"
+
+# Additive measures (summed into the rollup), and the SQL computing them for one line
+MEASURES = (
+    ('line_count', "1"),
+    ('total_sales', "subtotal_incl"),
+    ('quantity', "quantity"),
+    ('net_sales', "ROUND(subtotal_incl / 1.15, 2)"),
+    ('total_cost', "total_cost"),
+    ('profit', "ROUND(subtotal_incl / 1.15, 2) - total_cost"),
+    ('gross_sales_without_vat', "IF(total_cost > 0, ROUND(subtotal_incl / 1.15, 2), 0)"),
+    ('sold_value', "IF(quantity > 0, subtotal_incl, 0)"),
+    ('returned_quantity', "IF(quantity < 0, ABS(quantity), 0)"),
+    ('returned_value', "IF(quantity < 0, ABS(subtotal_incl), 0)"),
+)
+
+# Distinct counts can't be summed; each rollup row keeps its distinct keys instead, so counts stay exact
+DISTINCT_KEYS = (
+    ('receipt_keys', 'receipt_key', "receipt_number"),
+    ('customer_keys', 'customer_key', "phone_number"),
+    ('work_day_keys', 'work_day_key', "DATE(order_date)"),
+)
+
+ROLLUP_COLUMNS = list(DIMENSIONS) + [name for name, _ in MEASURES] + [name for name, _, _ in DISTINCT_KEYS]
+
+# Business day N runs from 21:00 on day N-1 to 20:59:59 on day N
+def business_day_start(business_date):
+    return datetime.combine(business_date, time(21, 0, 0)) - timedelta(days=1)
+
+def _dimension_sql(name):
+    if name == 'business_date':
+        return BUSINESS_DATE_SQL
+    if name in DERIVED_COLUMNS:
+        return line_column(name)
+    return name
+
+def line_facts_sql(source_table, conditions=()):
+    """
+    One row per order line with the rollup's dimensions, measures and distinct
+    keys. Lines without a subtotal are left out, as the KPI queries always did.
+    """
+    columns = [f"{_dimension_sql(name)} AS {name}" for name in DIMENSIONS]
+    columns += [f"{sql} AS {name}" for name, sql in MEASURES]
+    columns += [f"{sql} AS {key}" for _, key, sql in DISTINCT_KEYS]
+    where_sql = " AND ".join(list(conditions) + ["subtotal_incl IS NOT NULL"])
+    return "SELECT\n    " + ",\n    ".join(columns) + f"\nFROM {source_table}\nWHERE {where_sql}"
+
+def rollup_rows_sql(source_table, conditions=()):
+    """Order lines aggregated to the rollup grain, in ROLLUP_COLUMNS order."""
+    dimensions = ", ".join(DIMENSIONS)
+    columns = [f"SUM({name}) AS {name}" for name, _ in MEASURES]
+    columns += [f"ARRAY_AGG(DISTINCT {key} IGNORE NULLS) AS {name}" for name, key, _ in DISTINCT_KEYS]
+    return (
+        f"SELECT\n    {dimensions},\n    " + ",\n    ".join(columns)
+        + f"\nFROM ({line_facts_sql(source_table, conditions)})\nGROUP BY {dimensions}"
+    )
+
+def _table(table_id):
+    return f"`{get_project_id()}.{get_dataset_id()}.{table_id}`"
+
+def rollup_facts_sql(conditions, distinct_keys=False):
+    """
+    Rollup rows matching `conditions` with the columns of line_facts_sql().
+
+    The measures come from the rollup rows themselves (their keys are NULL).
+    With `distinct_keys`, every key stored on a row is added as a row of its
+    own whose measures are NULL, so SUM() is unchanged and COUNT(DISTINCT)
+    of a key is exact.
+    """
+    dimensions = ", ".join(DIMENSIONS)
+    where_sql = " AND ".join(conditions)
+    measures = ", ".join(name for name, _ in MEASURES)
+    keys = ", ".join(f"NULL AS {key}" for _, key, _ in DISTINCT_KEYS)
+    parts = [f"SELECT {dimensions}, {measures}, {keys}\nFROM {_table(DAILY_ROLLUP)}\nWHERE {where_sql}"]
+    if distinct_keys:
+        null_measures = ", ".join(f"NULL AS {name}" for name, _ in MEASURES)
+        for array, key, _ in DISTINCT_KEYS:
+            key_columns = ", ".join(key if other == key else f"NULL AS {other}" for _, other, _ in DISTINCT_KEYS)
+            parts.append(f"SELECT {dimensions}, {null_measures}, {key_columns}\n"
+                         f"FROM {_table(DAILY_ROLLUP)}, UNNEST({array}) AS {key}\nWHERE {where_sql}")
+    return "\nUNION ALL\n".join(parts)
+
+@cache_query(cache_time=3600, stale_time=600, tables=(DAILY_ROLLUP,))  # Invalidated when the ETL rewrites the rollup
+def _rollup_coverage():
+    sql = f"SELECT MIN(business_date) AS first_date, MAX(business_date) AS last_date FROM {_table(DAILY_ROLLUP)}"
+    rows = list(run_query(sql))
+    if not rows or rows[0]['last_date'] is None:
+        return None
+    return rows[0]['first_date'], rows[0]['last_date']
+
+def get_rollup_coverage():
+    """
+    (first, last) business date in the rollup, or None when it is missing or
+    empty. A failed read isn't cached, so the next request tries again.
+    """
+    try:
+        return _rollup_coverage()
+    except Exception as e:
+        print(f"⚠️ Daily rollup is not available: {e}")
+        return None
+
+class FactSource:
+    """
+    The `Facts` relation a dashboard query aggregates, for the current request.
+
+    It has the columns of line_facts_sql() either way, and queries only SUM()
+    its measures (NULL on the rows that carry a distinct key) or count its
+    distinct keys.
+    """
+
+    def __init__(self, sql, params, from_rollup):
+        self.sql = sql
+        self.params = params
+        self.from_rollup = from_rollup
+
+def get_fact_source(distinct_keys=False):
+    """
+    Facts for the current request's filters (with the receipt, customer and
+    work day keys when `distinct_keys`, for queries counting them).
+
+    Closed business days come from the rollup whenever every filter maps to a
+    rollup dimension (dates, branch, employee, category, online/store); days
+    after the rollup's last one are read from the order lines and appended.
+    Filters on products or amounts need the order lines, so those requests
+    get per-line facts straight from pos_order_lines.
+    """
+    source_table = _table(get_table_id())
+    coverage = get_rollup_coverage() if Config.ROLLUP_ENABLED and not has_line_level_filters() else None
+    start_dt, end_dt = get_business_datetime_range()
+    start_date = business_date_of(start_dt) if start_dt else None
+    end_date = business_date_of(end_dt) if end_dt else None
+
+    if coverage is not None:
+        first_date, last_date = coverage
+        # Only closed business days are trusted, whatever the ETL wrote (today as the date filters see it)
+        last_date = min(last_date, business_date_of(datetime.now()) - timedelta(days=1))
+        if start_date is not None and not first_date <= start_date <= last_date:
+            coverage = None
+
+    if coverage is None:
+        filters = get_user_filters()
+        return FactSource(line_facts_sql(source_table, filters.conditions), filters.params, from_rollup=False)
+
+    dimension_filters = get_user_filters(include_date=False)
+    params = dict(dimension_filters.params, rollup_end_date=min(end_date or last_date, last_date))
+    rollup_conditions = dimension_filters.conditions + ["business_date <= @rollup_end_date"]
+    if start_date is not None:
+        rollup_conditions.append("business_date >= @rollup_start_date")
+        params['rollup_start_date'] = start_date
+    parts = [rollup_facts_sql(rollup_conditions, distinct_keys)]
+
+    if end_date is None or end_date > last_date:
+        # Days the rollup doesn't have yet (today's open business day)
+        open_start_dt = business_day_start(last_date + timedelta(days=1))
+        open_filters = QueryFilter(*dimension_filters.conditions)
+        open_filters.add("order_date >= @open_start_datetime", open_start_datetime=open_start_dt)
+        if end_dt is not None:
+            open_filters.add("order_date <= @open_end_datetime", open_end_datetime=end_dt)
+            add_business_date_range(open_filters, open_start_dt, end_dt)
+        params.update(open_filters.params)
+        parts.append(line_facts_sql(source_table, open_filters.conditions))
+
+    return FactSource("\nUNION ALL\n".join(parts), params, from_rollup=True)
@@ -101,6 +101,22 @@ def system_status():
         from performance_monitor import get_performance_report
         perf_metrics = get_performance_report()
         
+        # Get query cache statistics
+        from cache import get_cache_info
+        cache_info = get_cache_info()
+        
+        from data_versions import get_all_versions
+        data_versions = get_all_versions()
+        
+        from local_mirror import get_mirror_status
+        mirror_status = get_mirror_status()
+        
+        from stock_replica import get_replica_status
+        replica_status = get_replica_status()
+        
+        from dimensions import get_dimensions_status
+        dimensions_status = get_dimensions_status()
+        
         return jsonify({
             'status': 'success',
             'system_info': {
@@ -110,6 +126,11 @@ def system_status():
                     'repository': github_repo
                 },
                 'performance_metrics': perf_metrics,
+                'cache': cache_info,
+                'data_versions': data_versions,
+                'local_mirror': mirror_status,
+                'stock_replica': replica_status,
+                'filter_dimensions': dimensions_status,
                 'environment': {
                     'python_version': os.sys.version,
                     'flask_env': os.environ.get('FLASK_ENV', 'production')
@@ -123,6 +144,51 @@ def system_status():
             'message': str(e)
         }), 500
 
+@admin_bp.route("/api/local-mirror/sync", methods=['POST'])
+@performance_monitor('local_mirror_sync')
+def sync_local_mirror():
+    """
+    Sync the local DuckDB/Parquet mirror now (?full=true rewrites it from scratch).
+    """
+    try:
+        from local_mirror import sync_mirror
+        result = sync_mirror(full=request.args.get('full', 'false').lower() == 'true')
+        if result['status'] == 'unavailable':
+            return jsonify(result), 503
+        if result['status'] == 'busy':
+            return jsonify(result), 409
+        return jsonify(result)
+        
+    except Exception as e:
+        print(f"❌ Error in /api/local-mirror/sync: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@admin_bp.route("/api/query-stats")
+@performance_monitor('query_stats')
+def query_stats():
+    """
+    Rank BigQuery query fingerprints by cost (?sort=bytes|processed|slot|latency|calls&limit=20).
+    """
+    try:
+        from query_stats import get_query_stats
+        
+        sort_by = request.args.get('sort', 'bytes')
+        limit = request.args.get('limit', 20, type=int)
+        
+        return jsonify({
+            'status': 'success',
+            'data': get_query_stats(sort_by=sort_by, limit=limit)
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @admin_bp.route("/api/clear-all-cache", methods=['POST'])
 @performance_monitor('clear_all_cache')
 def clear_all_cache():
@@ -132,6 +198,7 @@ def clear_all_cache():
     try:
         from cache import clear_cache
         from performance_monitor import clear_metrics
+        from query_stats import clear_query_stats
         
         # Clear application cache
         clear_cache()
@@ -139,6 +206,9 @@ def clear_all_cache():
         # Clear performance metrics
         clear_metrics()
         
+        # Clear BigQuery job statistics
+        clear_query_stats()
+        
         return jsonify({
             'status': 'success',
             'message': 'تم مسح جميع الذاكرة المؤقتة بنجاح!'
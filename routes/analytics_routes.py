@@ -5,7 +5,10 @@ from flask import Blueprint, jsonify, render_template
 from decimal import Decimal
 from collections import OrderedDict
 from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from utils import get_user_filters
+from kpi_engine import category_sources, get_kpi_cube, measure, total_row
+from category_rules import line_column, non_merchandise_sql
+from query_budget import QueryTooLargeError
 
 analytics_bp = Blueprint('analytics', __name__)
 
@@ -13,78 +16,29 @@ analytics_bp = Blueprint('analytics', __name__)
 def branch_profit_analysis():
     """API endpoint for branch profit analysis."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-
-        branch_profits_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            ),
-            GrandTotals AS (
-                SELECT SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) as grand_total_profit
-                FROM FilteredData
-            ),
-            BranchData AS (
-                SELECT
-                    COALESCE(branch, 'غير محدد') as branch,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) AS profit,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) ELSE 0 END) AS net_sales_without_vat
-                FROM FilteredData
-                GROUP BY COALESCE(branch, 'غير محدد')
-                HAVING SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) > 0
-            )
-            SELECT
-                bd.branch,
-                CAST(bd.profit AS NUMERIC) as profit,
-                CAST(CASE 
-                    WHEN gt.grand_total_profit > 0 THEN (bd.profit / gt.grand_total_profit) * 100 
-                    ELSE 0 
-                END AS NUMERIC) as profit_percentage,
-                CAST(CASE 
-                    WHEN bd.net_sales_without_vat > 0 THEN (bd.profit / bd.net_sales_without_vat) * 100 
-                    ELSE 0 
-                END AS NUMERIC) as profit_margin
-            FROM BranchData bd
-            CROSS JOIN GrandTotals gt
-            ORDER BY bd.profit DESC, bd.branch ASC;
-        """
+        cube = get_kpi_cube()
+        totals = total_row(cube)
+        all_branches_profit = measure(totals, 'profit')
+        total_net_sales = measure(totals, 'net_sales')
+        grand_profit_margin = (all_branches_profit / total_net_sales * 100) if total_net_sales > 0 else 0
         
-        results = run_query(branch_profits_query)
+        rows = [dict(row, branch=row['branch'] or 'غير محدد') for row in cube['branch'] if measure(row, 'profit') > 0]
+        rows.sort(key=lambda row: (-row['profit'], row['branch']))
         
         branch_data = []
-        grand_total_profit, grand_total_sales = 0, 0
-        rows = list(results)
+        grand_total_profit = 0
         
         # Calculate totals for proper profit margin calculation
         for row in rows:
-            grand_total_profit += (row.profit or 0)
-        
-        # Calculate grand profit margin by running a separate query
-        margin_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            )
-            SELECT
-                SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) AS total_profit,
-                SUM(ROUND((subtotal_incl / 1.15), 2)) AS total_net_sales
-            FROM FilteredData
-        """
-        margin_results = list(run_query(margin_query))
-        if margin_results:
-            total_profit = margin_results[0].total_profit or 0
-            total_net_sales = margin_results[0].total_net_sales or 0
-            grand_profit_margin = (total_profit / total_net_sales * 100) if total_net_sales > 0 else 0
-        else:
-            grand_profit_margin = 0
+            grand_total_profit += row['profit']
         
         for row in rows:
+            net_sales = measure(row, 'net_sales')
             branch_data.append({
-                "branch": row.branch or "غير محدد",
-                "profit": f"{float(row.profit or 0):,.2f}",
-                "profit_percentage": f"{float(row.profit_percentage or 0):.2f}%",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%"
+                "branch": row['branch'],
+                "profit": f"{float(row['profit']):,.2f}",
+                "profit_percentage": f"{float(row['profit'] / all_branches_profit * 100 if all_branches_profit > 0 else 0):.2f}%",
+                "profit_margin": f"{float(row['profit'] / net_sales * 100 if net_sales > 0 else 0):.2f}%"
             })
         
         if branch_data:
@@ -101,91 +55,54 @@ def branch_profit_analysis():
         print(f"❌ Error in /api/branch-profit-analysis: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _top_categories(rank_by):
+    """
+    Purchase-source rows of the top 5 main categories by total `rank_by`
+    ('total_sales' or 'profit', ties share a rank), grouped per category,
+    best category first.
+    """
+    sources = category_sources(get_kpi_cube())
+    
+    category_totals = {}
+    for source in sources:
+        totals = category_totals.setdefault(source['main_category'], {'total_sales': 0, 'quantity': 0, 'profit': 0})
+        for name in totals:
+            totals[name] += source[name]
+    
+    # DENSE_RANK <= 5; an unnamed category takes a rank but isn't listed
+    top_values = sorted({totals[rank_by] for totals in category_totals.values()}, reverse=True)[:5]
+    rows = [source for source in sources
+            if source['main_category'] is not None and category_totals[source['main_category']][rank_by] in top_values]
+    rows.sort(key=lambda row: (-category_totals[row['main_category']][rank_by], -row[rank_by]))
+    
+    grouped_data = OrderedDict()
+    for row in rows:
+        totals = category_totals[row['main_category']]
+        if row['main_category'] not in grouped_data:
+            grouped_data[row['main_category']] = {
+                "category_name": row['main_category'],
+                "sources": [],
+                "category_total_sales": totals['total_sales'],
+                "category_total_items": totals['quantity'],
+                "category_total_profit": totals['profit'],
+            }
+        grouped_data[row['main_category']]["sources"].append(row)
+    return grouped_data
+
 @analytics_bp.route("/top-categories")
 def top_performing_categories():
     """API endpoint for top performing categories by sales."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} product_category LIKE '% / %'
-            AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-        """
-
-        top_categories_query = f"""
-            WITH BaseData AS (
-                SELECT
-                    SPLIT(product_category, ' / ')[SAFE_OFFSET(0)] AS category_name,
-                    SPLIT(product_category, ' / ')[SAFE_OFFSET(1)] AS purchase_source,
-                    subtotal_incl,
-                    quantity,
-                    total_cost
-                FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-                {where_sql}
-            ),
-            GroupedBySource AS (
-                SELECT
-                    category_name,
-                    purchase_source,
-                    SUM(subtotal_incl) as total_sales,
-                    SUM(quantity) as total_items_sold,
-                    SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) as profit
-                FROM BaseData
-                GROUP BY category_name, purchase_source
-            ),
-            CategoryTotals AS (
-                SELECT
-                    category_name,
-                    SUM(total_sales) as category_total_sales,
-                    SUM(total_items_sold) as category_total_items,
-                    SUM(profit) as category_total_profit,
-                    DENSE_RANK() OVER (ORDER BY SUM(total_sales) DESC) as rnk
-                FROM GroupedBySource
-                GROUP BY category_name
-            ),
-            TopCategories AS (
-                SELECT *
-                FROM CategoryTotals
-                WHERE rnk <= 5
-            )
-            SELECT
-                g.category_name,
-                g.purchase_source,
-                g.total_sales,
-                g.total_items_sold,
-                g.profit,
-                SAFE_DIVIDE(g.total_sales, tc.category_total_sales) * 100 as rate_within_category,
-                tc.category_total_sales,
-                tc.category_total_items,
-                tc.category_total_profit
-            FROM GroupedBySource g
-            INNER JOIN TopCategories tc ON g.category_name = tc.category_name
-            ORDER BY tc.category_total_sales DESC, g.total_sales DESC;
-        """
-        results = run_query(top_categories_query)
-        
-        grouped_data = OrderedDict()
-        for row in results:
-            cat_name = row.category_name or "غير محدد"
-            if cat_name not in grouped_data:
-                grouped_data[cat_name] = {
-                    "category_name": cat_name,
-                    "sources": [],
-                    "category_total_sales": row.category_total_sales or 0,
-                    "category_total_items": row.category_total_items or 0,
-                    "category_total_profit": row.category_total_profit or 0,
-                }
-            
-            grouped_data[cat_name]["sources"].append({
-                "purchase_source": row.purchase_source or "غير محدد",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "rate_within_category": f"{float(row.rate_within_category or 0):.2f}%",
-                "profit": f"{float(row.profit or 0):,.2f}",
-            })
+        grouped_data = _top_categories('total_sales')
+        for category in grouped_data.values():
+            category_total_sales = float(category["category_total_sales"])
+            category["sources"] = [{
+                "purchase_source": row['purchase_source'] or "غير محدد",
+                "total_sales": f"{float(row['total_sales']):,.2f}",
+                "total_items_sold": f"{int(row['quantity']):,}",
+                "rate_within_category": f"{float(row['total_sales']) / category_total_sales * 100 if category_total_sales else 0:.2f}%",
+                "profit": f"{float(row['profit']):,.2f}",
+            } for row in category["sources"]]
             
         return jsonify({"status": "success", "data": list(grouped_data.values())})
 
@@ -197,89 +114,15 @@ def top_performing_categories():
 def top_profitable_categories():
     """API endpoint for top categories by profit margin."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} product_category LIKE '% / %'
-            AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-        """
-
-        top_categories_query = f"""
-            WITH BaseData AS (
-                SELECT
-                    SPLIT(product_category, ' / ')[SAFE_OFFSET(0)] AS category_name,
-                    SPLIT(product_category, ' / ')[SAFE_OFFSET(1)] AS purchase_source,
-                    subtotal_incl,
-                    quantity,
-                    total_cost
-                FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-                {where_sql}
-            ),
-            GroupedBySource AS (
-                SELECT
-                    category_name,
-                    purchase_source,
-                    SUM(subtotal_incl) as total_sales,
-                    SUM(quantity) as total_items_sold,
-                    SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) as profit,
-                    SUM(ROUND((subtotal_incl / 1.15), 2)) AS net_sales_without_vat
-                FROM BaseData
-                GROUP BY category_name, purchase_source
-            ),
-            CategoryTotals AS (
-                SELECT
-                    category_name,
-                    SUM(total_sales) as category_total_sales,
-                    SUM(total_items_sold) as category_total_items,
-                    SUM(profit) as category_total_profit,
-                    DENSE_RANK() OVER (ORDER BY SUM(profit) DESC) as rnk
-                FROM GroupedBySource
-                GROUP BY category_name
-            ),
-            TopCategories AS (
-                SELECT *
-                FROM CategoryTotals
-                WHERE rnk <= 5
-            )
-            SELECT
-                g.category_name,
-                g.purchase_source,
-                g.total_sales,
-                g.total_items_sold,
-                g.profit,
-                g.net_sales_without_vat,
-                SAFE_DIVIDE(g.profit, g.net_sales_without_vat) * 100 as profit_margin,
-                tc.category_total_sales,
-                tc.category_total_items,
-                tc.category_total_profit
-            FROM GroupedBySource g
-            INNER JOIN TopCategories tc ON g.category_name = tc.category_name
-            ORDER BY tc.category_total_profit DESC, g.profit DESC;
-        """
-        results = run_query(top_categories_query)
-        
-        grouped_data = OrderedDict()
-        for row in results:
-            cat_name = row.category_name or "غير محدد"
-            if cat_name not in grouped_data:
-                grouped_data[cat_name] = {
-                    "category_name": cat_name,
-                    "sources": [],
-                    "category_total_sales": row.category_total_sales or 0,
-                    "category_total_items": row.category_total_items or 0,
-                    "category_total_profit": row.category_total_profit or 0,
-                }
-            
-            grouped_data[cat_name]["sources"].append({
-                "purchase_source": row.purchase_source or "غير محدد",
-                "profit": f"{float(row.profit or 0):,.2f}",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-            })
+        grouped_data = _top_categories('profit')
+        for category in grouped_data.values():
+            category["sources"] = [{
+                "purchase_source": row['purchase_source'] or "غير محدد",
+                "profit": f"{float(row['profit']):,.2f}",
+                "profit_margin": f"{float(row['profit'] / row['net_sales'] * 100 if row['net_sales'] else 0):.2f}%",
+                "total_items_sold": f"{int(row['quantity']):,}",
+                "total_sales": f"{float(row['total_sales']):,.2f}",
+            } for row in category["sources"]]
             
         return jsonify({"status": "success", "data": list(grouped_data.values())})
 
@@ -291,84 +134,46 @@ def top_profitable_categories():
 def top_10_categories_subtotal_quantity():
     """API endpoint for top 10 categories by subtotal and quantity."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        print(f"🔍 Top 10 Categories Filter: {where_sql}")  # Debug logging
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} product_category LIKE '% / %'
-            AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%')
-            AND subtotal_incl IS NOT NULL
-        """
-
-        top_categories_query = f"""
-            WITH FilteredData AS (
-                SELECT
-                    TRIM(SPLIT(product_category, ' / ')[SAFE_OFFSET(0)]) AS category_name,
-                    TRIM(SPLIT(product_category, ' / ')[SAFE_OFFSET(1)]) AS purchase_source,
-                    subtotal_incl,
-                    quantity,
-                    total_cost
-                FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-                {where_sql}
-            ),
-            CategoryTotals AS (
-                SELECT
-                    category_name,
-                    CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) AS NUMERIC) as total_subtotal,
-                    CAST(SUM(CASE WHEN quantity IS NOT NULL THEN quantity ELSE 0 END) AS INT64) as total_quantity,
-                    CAST(COUNT(DISTINCT purchase_source) AS INT64) as source_count,
-                    CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) AS NUMERIC) AS total_profit
-                FROM FilteredData
-                WHERE category_name IS NOT NULL AND category_name != ''
-                GROUP BY category_name
-                HAVING total_subtotal > 0
-                ORDER BY total_subtotal DESC, total_quantity DESC
-                LIMIT 10
-            )
-            SELECT
-                category_name,
-                total_subtotal,
-                total_quantity,
-                source_count,
-                total_profit,
-                CAST(CASE 
-                    WHEN total_subtotal > 0 THEN (total_profit / (total_subtotal / 1.15)) * 100 
-                    ELSE 0 
-                END AS NUMERIC) as profit_margin
-            FROM CategoryTotals
-            ORDER BY total_subtotal DESC, total_quantity DESC;
-        """
-        
-        results = run_query(top_categories_query)
+        # Merchandise of the categorized lines (no services or POS lines), per main category
+        category_totals = {}
+        for source in category_sources(get_kpi_cube(), merchandise_only=True):
+            if not source['main_category']:
+                continue
+            totals = category_totals.setdefault(source['main_category'], {'category_name': source['main_category'], 'total_subtotal': 0, 'total_quantity': 0, 'total_profit': 0, 'sources': set()})
+            totals['total_subtotal'] += source['total_sales']
+            totals['total_quantity'] += source['quantity']
+            totals['total_profit'] += source['profit']
+            if source['purchase_source'] is not None:
+                totals['sources'].add(source['purchase_source'])
+        
+        rows = [totals for totals in category_totals.values() if totals['total_subtotal'] > 0]
+        rows.sort(key=lambda row: (-row['total_subtotal'], -row['total_quantity']))
+        rows = rows[:10]
         
-        if not results:
+        if not rows:
             return jsonify({"status": "success", "data": []})
         
         categories_data = []
         grand_total_subtotal = 0
         grand_total_quantity = 0
         grand_total_profit = 0
-        rows = list(results)
         
         # Calculate totals
         for row in rows:
-            grand_total_subtotal += float(row.total_subtotal or 0)
-            grand_total_quantity += int(row.total_quantity or 0)
-            grand_total_profit += float(row.total_profit or 0)
+            grand_total_subtotal += float(row['total_subtotal'])
+            grand_total_quantity += int(round(row['total_quantity']))
+            grand_total_profit += float(row['total_profit'])
         
         # Format data for display
         for row in rows:
+            total_subtotal = float(row['total_subtotal'])
             categories_data.append({
-                "category_name": row.category_name or "غير محدد",
-                "total_subtotal": f"{float(row.total_subtotal or 0):,.2f}",
-                "total_quantity": f"{int(row.total_quantity or 0):,}",
-                "source_count": f"{int(row.source_count or 0):,}",
-                "total_profit": f"{float(row.total_profit or 0):,.2f}",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%"
+                "category_name": row['category_name'],
+                "total_subtotal": f"{total_subtotal:,.2f}",
+                "total_quantity": f"{int(round(row['total_quantity'])):,}",
+                "source_count": f"{len(row['sources']):,}",
+                "total_profit": f"{float(row['total_profit']):,.2f}",
+                "profit_margin": f"{float(row['total_profit']) / (total_subtotal / 1.15) * 100:.2f}%"
             })
         
         # Add totals row
@@ -395,7 +200,8 @@ def top_10_categories_subtotal_quantity():
 def top_15_customers():
     """API endpoint for top 15 customers with name, phone, branch, subtotal, quantity, and receipt count."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -413,7 +219,7 @@ def top_15_customers():
                     COALESCE(TRIM(phone_number), 'غير محدد') as phone_number,
                     COALESCE(TRIM(branch), 'غير محدد') as branch,
                     CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) AS NUMERIC) as total_subtotal,
-                    CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%') THEN quantity ELSE 0 END) AS INT64) as total_quantity,
+                    CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL AND NOT {non_merchandise_sql(is_service=line_column('is_service'))} THEN quantity ELSE 0 END) AS INT64) as total_quantity,
                     CAST(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END) AS INT64) as receipt_count,
                     CAST(SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) AS NUMERIC) AS total_profit,
                     CAST(COUNT(DISTINCT DATE(order_date)) AS INT64) as visit_days
@@ -451,7 +257,7 @@ def top_15_customers():
             ORDER BY total_subtotal DESC, total_quantity DESC;
         """
         
-        results = run_query(top_customers_query)
+        results = run_query(top_customers_query, filters.params)
         
         if not results:
             return jsonify({"status": "success", "data": []})
@@ -505,15 +311,20 @@ def top_15_customers():
         
         return jsonify({"status": "success", "data": customers_data})
 
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in /api/top-15-customers: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in /api/top-15-customers: {e}")
         import traceback
         traceback.print_exc()
+        return jsonify({"status": "error", "message": str(e)}), 500
 @analytics_bp.route("/customer-invoices/<phone_number>")
 def customer_invoices(phone_number):
     """API endpoint for customer invoices details."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -521,10 +332,8 @@ def customer_invoices(phone_number):
         print(f"🔍 Customer Invoices Filter: {where_sql}, Phone: {phone_number}")  # Debug logging
         
         # Add customer phone filter
-        if where_sql:
-            where_sql += f" AND phone_number = '{phone_number.replace('\'', '\'\'')}'"
-        else:
-            where_sql = f"WHERE phone_number = '{phone_number.replace('\'', '\'\'')}'"
+        filters.add("phone_number = @phone_number", phone_number=phone_number)
+        where_sql = filters.where_sql
         
         print(f"🔍 Final where clause: {where_sql}")  # Debug logging
         
@@ -571,7 +380,7 @@ def customer_invoices(phone_number):
         """
         
         print(f"🔍 Executing query for phone: {phone_number}")  # Debug logging
-        results = run_query(customer_invoices_query)
+        results = run_query(customer_invoices_query, filters.params)
         
         if not results:
             print(f"❌ No results returned from BigQuery for phone: {phone_number}")
@@ -647,6 +456,9 @@ def customer_invoices(phone_number):
             "invoices": invoices_data
         })
 
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in /api/customer-invoices/{phone_number}: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in /api/customer-invoices/{phone_number}: {e}")
         import traceback
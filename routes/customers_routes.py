@@ -2,7 +2,10 @@ from flask import Blueprint, render_template, jsonify, request
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from database import run_query, get_project_id, get_dataset_id
+from database import run_query, run_queries, get_project_id, get_dataset_id
+from utils import QueryFilter
+from dimensions import get_customer_locations
+from query_budget import QueryTooLargeError
 import logging
 
 customers_bp = Blueprint('customers', __name__)
@@ -16,46 +19,12 @@ def customers_analytics():
 def get_branches():
     """جلب قائمة الفروع المتاحة"""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        branches_query = f"""
-            SELECT 
-                CASE 
-                    WHEN delivery_address IS NULL OR delivery_address = '' THEN 'غير محدد'
-                    WHEN LOWER(delivery_address) LIKE '%الرياض%' THEN 'الرياض'
-                    WHEN LOWER(delivery_address) LIKE '%جدة%' THEN 'جدة'
-                    WHEN LOWER(delivery_address) LIKE '%الدمام%' THEN 'الدمام'
-                    WHEN LOWER(delivery_address) LIKE '%مكة%' THEN 'مكة المكرمة'
-                    WHEN LOWER(delivery_address) LIKE '%المدينة%' THEN 'المدينة المنورة'
-                    WHEN LOWER(delivery_address) LIKE '%الطائف%' THEN 'الطائف'
-                    WHEN LOWER(delivery_address) LIKE '%الخبر%' THEN 'الخبر'
-                    WHEN LOWER(delivery_address) LIKE '%القطيف%' THEN 'القطيف'
-                    WHEN LOWER(delivery_address) LIKE '%الأحساء%' THEN 'الأحساء'
-                    WHEN LOWER(delivery_address) LIKE '%أبها%' THEN 'أبها'
-                    WHEN LOWER(delivery_address) LIKE '%تبوك%' THEN 'تبوك'
-                    WHEN LOWER(delivery_address) LIKE '%جازان%' THEN 'جازان'
-                    WHEN LOWER(delivery_address) LIKE '%نجران%' THEN 'نجران'
-                    WHEN LOWER(delivery_address) LIKE '%حائل%' THEN 'حائل'
-                    WHEN LOWER(delivery_address) LIKE '%القصيم%' THEN 'القصيم'
-                    ELSE 'أخرى'
-                END as branch_name,
-                COUNT(*) as order_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-            WHERE phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')
-            AND subtotal_incl > 0
-            GROUP BY branch_name
-            HAVING order_count > 5
-            ORDER BY order_count DESC
-        """
-        
-        results = run_query(branches_query)
-        
+        # Customer locations from the in-memory dimensions (no BigQuery job)
         branches_data = []
-        for row in results:
+        for name, order_count in get_customer_locations(min_count=5):
             branches_data.append({
-                "name": row.branch_name or 'غير محدد',
-                "order_count": int(row.order_count or 0)
+                "name": name or 'غير محدد',
+                "order_count": order_count
             })
             
         return jsonify({"status": "success", "data": branches_data})
@@ -77,21 +46,21 @@ def customers_overview():
         branch = request.args.get('branch')
         
         # بناء شروط WHERE
-        where_conditions = [
+        filters = QueryFilter(
             "customer_name IS NOT NULL",
             "customer_name != ''",
             "subtotal_incl > 0",
             "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')"
-        ]
+        )
         
         if start_date:
-            where_conditions.append(f"order_date >= '{start_date}'")
+            filters.add("order_date >= CAST(@start_date AS DATETIME)", start_date=start_date)
         if end_date:
-            where_conditions.append(f"order_date <= '{end_date}'")
+            filters.add("order_date <= CAST(@end_date AS DATETIME)", end_date=end_date)
         if branch:
-            where_conditions.append(f"delivery_address LIKE '%{branch}%'")
+            filters.add("delivery_address LIKE @branch_pattern", branch_pattern=f"%{branch}%")
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         overview_query = f"""
             SELECT 
@@ -102,10 +71,10 @@ def customers_overview():
                 MIN(order_date) as first_order_date,
                 MAX(order_date) as last_order_date
             FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-            WHERE {where_clause}
+            {where_sql}
         """
         
-        results = list(run_query(overview_query))
+        results = list(run_query(overview_query, filters.params))
         
         if results:
             row = results[0]
@@ -137,6 +106,9 @@ def customers_overview():
             
         return jsonify({"status": "success", "data": data})
         
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in customers overview: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in customers overview: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -158,33 +130,29 @@ def top_customers_by_revenue():
         DATASET_ID = get_dataset_id()
         
         # بناء شروط WHERE
-        where_conditions = [
+        filters = QueryFilter(
             "phone_number IS NOT NULL",
             "phone_number != ''",
             "subtotal_incl > 0",
             "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')"
-        ]
+        )
         
         if start_date:
-            where_conditions.append(f"order_date >= '{start_date}'")
+            filters.add("order_date >= CAST(@start_date AS DATETIME)", start_date=start_date)
         if end_date:
-            where_conditions.append(f"order_date <= '{end_date}'")
+            filters.add("order_date <= CAST(@end_date AS DATETIME)", end_date=end_date)
         if branch:
-            where_conditions.append(f"delivery_address LIKE '%{branch}%'")
+            filters.add("delivery_address LIKE @branch_pattern", branch_pattern=f"%{branch}%")
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         # العدد الكلي
         count_query = f"""
             SELECT COUNT(DISTINCT phone_number) as total_count
             FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-            WHERE {where_clause}
+            {where_sql}
         """
         
-        count_result = list(run_query(count_query))
-        total_count = count_result[0].total_count if count_result else 0
-        total_pages = (total_count + limit - 1) // limit
-        
         revenue_query = f"""
             WITH CustomerRevenue AS (
                 SELECT 
@@ -198,7 +166,7 @@ def top_customers_by_revenue():
                     MAX(order_date) as last_order,
                     COUNT(DISTINCT DATE(order_date)) as active_days
                 FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE {where_clause}
+                {where_sql}
                 GROUP BY phone_number, customer_name, delivery_address
             ),
             TotalRevenue AS (
@@ -222,7 +190,10 @@ def top_customers_by_revenue():
             LIMIT {limit} OFFSET {offset}
         """
         
-        results = run_query(revenue_query)
+        count_result, results = run_queries((count_query, filters.params), (revenue_query, filters.params))
+        count_result = list(count_result)
+        total_count = count_result[0].total_count if count_result else 0
+        total_pages = (total_count + limit - 1) // limit
         
         customers_data = []
         for row in results:
@@ -250,6 +221,9 @@ def top_customers_by_revenue():
             }
         })
         
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in top customers by revenue: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in top customers by revenue: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -271,21 +245,21 @@ def top_customers_by_frequency():
         DATASET_ID = get_dataset_id()
         
         # بناء شروط WHERE
-        where_conditions = [
+        filters = QueryFilter(
             "phone_number IS NOT NULL",
             "phone_number != ''",
             "subtotal_incl > 0",
             "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')"
-        ]
+        )
         
         if start_date:
-            where_conditions.append(f"order_date >= '{start_date}'")
+            filters.add("order_date >= CAST(@start_date AS DATETIME)", start_date=start_date)
         if end_date:
-            where_conditions.append(f"order_date <= '{end_date}'")
+            filters.add("order_date <= CAST(@end_date AS DATETIME)", end_date=end_date)
         if branch:
-            where_conditions.append(f"delivery_address LIKE '%{branch}%'")
+            filters.add("delivery_address LIKE @branch_pattern", branch_pattern=f"%{branch}%")
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         frequency_query = f"""
             WITH CustomerFrequency AS (
@@ -300,7 +274,7 @@ def top_customers_by_frequency():
                     MAX(order_date) as last_order,
                     DATE_DIFF(MAX(order_date), MIN(order_date), DAY) as customer_lifetime_days
                 FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE {where_clause}
+                {where_sql}
                 GROUP BY phone_number, customer_name
             )
             SELECT 
@@ -322,7 +296,7 @@ def top_customers_by_frequency():
             LIMIT {limit} OFFSET {offset}
         """
         
-        results = run_query(frequency_query)
+        results = run_query(frequency_query, filters.params)
         
         customers_data = []
         for row in results:
@@ -341,6 +315,9 @@ def top_customers_by_frequency():
             
         return jsonify({"status": "success", "data": customers_data})
         
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in top customers by frequency: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in top customers by frequency: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -358,21 +335,21 @@ def customers_by_city():
         DATASET_ID = get_dataset_id()
         
         # بناء شروط WHERE
-        where_conditions = [
+        filters = QueryFilter(
             "customer_name IS NOT NULL",
             "customer_name != ''",
             "subtotal_incl > 0",
             "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')"
-        ]
+        )
         
         if start_date:
-            where_conditions.append(f"order_date >= '{start_date}'")
+            filters.add("order_date >= CAST(@start_date AS DATETIME)", start_date=start_date)
         if end_date:
-            where_conditions.append(f"order_date <= '{end_date}'")
+            filters.add("order_date <= CAST(@end_date AS DATETIME)", end_date=end_date)
         if branch:
-            where_conditions.append(f"delivery_address LIKE '%{branch}%'")
+            filters.add("delivery_address LIKE @branch_pattern", branch_pattern=f"%{branch}%")
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         # نحاول أولاً معرفة إذا كان هناك عمود للمدينة أو العنوان
         city_query = f"""
@@ -401,7 +378,7 @@ def customers_by_city():
                     SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) as total_revenue,
                     COUNT(*) as total_orders
                 FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE {where_clause}
+                {where_sql}
                 GROUP BY city, customer_name
             )
             SELECT 
@@ -417,7 +394,7 @@ def customers_by_city():
         """
         
         try:
-            results = run_query(city_query)
+            results = run_query(city_query, filters.params)
             
             cities_data = []
             for row in results:
@@ -440,6 +417,9 @@ def customers_by_city():
                 "note": "بيانات المدن غير متوفرة"
             })
         
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in customers by city: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in customers by city: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -457,25 +437,25 @@ def monthly_customer_trends():
         DATASET_ID = get_dataset_id()
         
         # بناء شروط WHERE
-        where_conditions = [
+        filters = QueryFilter(
             "customer_name IS NOT NULL",
             "customer_name != ''",
             "subtotal_incl > 0",
             "phone_number NOT IN ('0555555555', '0500000000', 'رفض العميل', '0000000000', '1111111111')"
-        ]
+        )
         
         # إضافة فلتر التاريخ الافتراضي (آخر 12 شهر) أو المخصص
         if start_date:
-            where_conditions.append(f"order_date >= '{start_date}'")
+            filters.add("order_date >= CAST(@start_date AS DATETIME)", start_date=start_date)
         else:
-            where_conditions.append("order_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 12 MONTH)")
+            filters.add("order_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 12 MONTH)")
             
         if end_date:
-            where_conditions.append(f"order_date <= '{end_date}'")
+            filters.add("order_date <= CAST(@end_date AS DATETIME)", end_date=end_date)
         if branch:
-            where_conditions.append(f"delivery_address LIKE '%{branch}%'")
+            filters.add("delivery_address LIKE @branch_pattern", branch_pattern=f"%{branch}%")
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         trends_query = f"""
             WITH MonthlyStats AS (
@@ -486,7 +466,7 @@ def monthly_customer_trends():
                     COUNT(*) as total_orders,
                     SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) as total_revenue
                 FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE {where_clause}
+                {where_sql}
                 GROUP BY year, month
             )
             SELECT 
@@ -499,7 +479,7 @@ def monthly_customer_trends():
             ORDER BY year, month
         """
         
-        results = run_query(trends_query)
+        results = run_query(trends_query, filters.params)
         
         trends_data = []
         for row in results:
@@ -513,6 +493,9 @@ def monthly_customer_trends():
             
         return jsonify({"status": "success", "data": trends_data})
         
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in monthly customer trends: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in monthly customer trends: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1,10 +1,39 @@
 # routes/dashboard_routes.py
 # Main dashboard routes for the Flask application
 
-from flask import Blueprint, render_template
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, current_app, jsonify, render_template, request
+from config import Config
+from streaming import stream_documents, wants_ndjson
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+# Widgets of the main dashboard served by /api/dashboard-bundle (name -> endpoint).
+# /api/top-15-customers stays a request of its own: it is only run after its byte estimate.
+DASHBOARD_WIDGETS = {
+    'kpis': '/api/data',
+    'services_details': '/api/services-details',
+    'sales_details': '/api/sales-details',
+    'branch_sales': '/api/branch-sales',
+    'branch_profits': '/api/branch-profits',
+    'top_categories': '/api/top-categories',
+    'top_categories_by_profit': '/api/top-categories-by-profit',
+    'top_sellers': '/api/top-sellers',
+    'top_10_sellers': '/api/top-10-sellers',
+    'top_products_by_sales_value': '/api/top_products_by_sales_value',
+    'top_products_by_quantity': '/api/top_products_by_quantity',
+    'top_products_by_profit': '/api/top_products_by_profit',
+    'top_categories_by_returns': '/api/top_categories_by_returns',
+    'top_sellers_by_returns': '/api/top_sellers_by_returns',
+    'top_10_categories': '/api/top-10-categories',
+    'stock_products': '/api/stock-products',
+}
+
+# Bounded pool shared by every bundle, so a burst of dashboards queues here
+# instead of each request starting a thread per widget
+_widget_executor = ThreadPoolExecutor(max_workers=Config.DASHBOARD_BUNDLE_WORKERS, thread_name_prefix='dashboard-widget')
+
 @dashboard_bp.route("/")
 def dashboard():
     """Renders the main dashboard page."""
@@ -14,3 +43,65 @@ def dashboard():
 def customer_invoices_page(phone_number):
     """Page to display customer invoices."""
     return render_template('customer_invoices.html')
+
+def _widget_environ(path):
+    """WSGI environ of the current request re-targeted at a widget endpoint (same query string)."""
+    environ = dict(request.environ, PATH_INFO=path)
+    # The bundle's own content negotiation and revalidation don't apply to its parts
+    for header in ('HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH'):
+        environ.pop(header, None)
+    return environ
+
+def _render_widget(app, environ):
+    """
+    Full dispatch of a widget endpoint (response cache, timing and error
+    handling included), returning its JSON document.
+    """
+    with app.request_context(environ):
+        response = app.full_dispatch_request()
+        try:
+            return json.loads(response.get_data())
+        except ValueError:
+            return {"status": "error", "message": f"HTTP {response.status_code}"}
+
+@dashboard_bp.route("/api/dashboard-bundle")
+def dashboard_bundle():
+    """
+    Every widget of the main dashboard for one filter, in one response.
+
+    The widgets run concurrently, each through its own endpoint (so they share
+    its query and response caches). Returns {"data": {widget: document}}, or
+    with ?format=ndjson one line per widget as soon as it is ready:
+        {"type": "widget", "widget": name, "endpoint": path, "document": {...}}
+        {"type": "end"}
+    """
+    try:
+        app = current_app._get_current_object()
+        futures = {
+            _widget_executor.submit(_render_widget, app, _widget_environ(path)): name
+            for name, path in DASHBOARD_WIDGETS.items()
+        }
+
+        def widget_documents():
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    document = future.result()
+                except Exception as e:
+                    print(f"❌ Error in dashboard widget {name}: {e}")
+                    document = {"status": "error", "message": str(e)}
+                yield name, document
+
+        if wants_ndjson():
+            def lines():
+                for name, document in widget_documents():
+                    yield {"type": "widget", "widget": name, "endpoint": DASHBOARD_WIDGETS[name], "document": document}
+                yield {"type": "end"}
+            return stream_documents(lines())
+
+        documents = dict(widget_documents())
+        return jsonify({"status": "success", "data": {name: documents[name] for name in DASHBOARD_WIDGETS}})
+
+    except Exception as e:
+        print(f"❌ Error in /api/dashboard-bundle: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
@@ -3,6 +3,7 @@
 
 from flask import Blueprint, jsonify
 from database import run_query, get_project_id, get_dataset_id, get_table_id
+from query_budget import QueryTooLargeError
 
 debug_bp = Blueprint('debug', __name__)
 
@@ -57,6 +58,9 @@ def debug_customer_sample():
         
         return jsonify({"status": "success", "data": sample_data})
 
+    except QueryTooLargeError as e:
+        print(f"⚠️ Query too large in debug sample: {e}")
+        return jsonify(e.to_dict()), 413
     except Exception as e:
         print(f"❌ Error in debug sample: {e}")
         import traceback
@@ -0,0 +1,22 @@
+# routes/dimension_routes.py
+# Typeahead suggestions for the dashboard filters
+
+from flask import Blueprint, jsonify, request
+from dimensions import SUGGEST_FIELDS, suggest
+
+dimension_bp = Blueprint('dimensions', __name__)
+
+@dimension_bp.route('/api/suggest')
+def suggest_values():
+    """Known values of a filter field (branch, employee, category, product, purchase source) matching the typed prefix."""
+    try:
+        field = request.args.get('field', '')
+        if field not in SUGGEST_FIELDS:
+            return jsonify({"status": "error", "message": f"field must be one of: {', '.join(SUGGEST_FIELDS)}"}), 400
+        query = request.args.get('q', '').strip()
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+        return jsonify({"status": "success", "field": field, "data": suggest(field, query, limit)})
+
+    except Exception as e:
+        print(f"❌ Error in /api/suggest: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
@@ -7,7 +7,12 @@ from datetime import datetime, timedelta
 import subprocess
 import os
 import threading
-from database import run_query, get_project_id, get_dataset_id
+from database import run_query, run_queries, get_project_id, get_dataset_id
+from data_versions import refresh_table_version, PRODUCT_FACTS, STOCK_DATA
+from product_facts_source import product_facts_relation
+from category_rules import is_service_sql, stock_column
+from stock_replica import (stock_replica, get_stock_items, get_recent_sales_quantities, find_by_barcode, search_products,
+                           is_categorized, is_listed, item_value, descending, paginate, summarize_by)
 
 inventory_dashboard_bp = Blueprint('inventory_dashboard', __name__)
 
@@ -51,10 +56,30 @@ def trigger_stock_update():
                 ], capture_output=True, text=True, timeout=300)  # 5 دقائق timeout
                 
                 print(f"✅ Stock update completed. Return code: {result.returncode}")
+                if result.returncode == 0:
+                    # Invalidate cached stock results right away instead of waiting for the watcher
+                    refresh_table_version(STOCK_DATA)
+                    # Reload the replica and rebuild the product search index before the next lookup
+                    try:
+                        stock_replica.search_index()
+                    except Exception as e:
+                        print(f"⚠️ Could not rebuild the product search index: {e}")
                 if result.stdout:
                     print(f"📊 Output: {result.stdout}")
                 if result.stderr:
                     print(f"⚠️ Errors: {result.stderr}")
+                
+                if result.returncode == 0:
+                    # إعادة بناء جدول حقائق المنتجات بعد تحديث المخزون
+                    facts_script = os.path.join(os.path.dirname(__file__), '..', 'data-push', 'product_facts.py')
+                    facts_result = subprocess.run([
+                        'python', facts_script
+                    ], capture_output=True, text=True, timeout=300)
+                    print(f"✅ Product facts rebuild completed. Return code: {facts_result.returncode}")
+                    if facts_result.returncode == 0:
+                        refresh_table_version(PRODUCT_FACTS)
+                    elif facts_result.stderr:
+                        print(f"⚠️ Errors: {facts_result.stderr}")
                     
             except subprocess.TimeoutExpired:
                 print("⏰ Stock update timed out after 5 minutes")
@@ -79,108 +104,40 @@ def trigger_stock_update():
 def inventory_kpis():
     """Get inventory KPIs."""
     try:
-        date_filter = request.args.get('date')
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        # Base query for current stock data
-        date_condition = ""
-        if date_filter:
-            # If specific date provided, try to get historical data
-            date_condition = f"AND DATE(snapshot_date) = '{date_filter}'" if 'historical_inventory' in str(date_filter) else ""
-        
-        kpi_query = f"""
-            SELECT 
-                COUNT(DISTINCT Barcode) as total_products,
-                SUM(Available_Qty) as total_quantity,
-                SUM(Available_Qty * Unit_Cost) as total_value,
-                COUNT(CASE WHEN Available_Qty < 10 THEN 1 END) as low_stock_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Barcode IS NOT NULL
-            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')))
-            {date_condition}
-        """
-        
-        result = list(run_query(kpi_query))
-        
-        if result:
-            kpi_data = result[0]
-            return jsonify({
-                "status": "success",
-                "data": {
-                    "total_products": int(kpi_data.total_products or 0),
-                    "total_quantity": int(kpi_data.total_quantity or 0),
-                    "total_value": f"{float(kpi_data.total_value or 0):,.2f}",
-                    "low_stock_count": int(kpi_data.low_stock_count or 0)
-                }
-            })
-        else:
-            return jsonify({
-                "status": "success",
-                "data": {
-                    "total_products": 0,
-                    "total_quantity": 0,
-                    "total_value": "0.00",
-                    "low_stock_count": 0
-                }
-            })
+        items = [item for item in get_stock_items() if item.barcode is not None and is_listed(item)]
+        return jsonify({
+            "status": "success",
+            "data": {
+                "total_products": len({item.barcode for item in items}),
+                "total_quantity": int(sum(item.available_qty or 0 for item in items)),
+                "total_value": f"{sum(item_value(item) or 0 for item in items):,.2f}",
+                "low_stock_count": sum(1 for item in items if item.available_qty is not None and item.available_qty < 10)
+            }
+        })
             
     except Exception as e:
         print(f"❌ Error in /api/inventory-kpis: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _category_breakdown(key):
+    """Top 10 groups of the categorized stock by value."""
+    items = [item for item in get_stock_items() if item.barcode is not None and is_categorized(item)]
+    category_data = []
+    for summary in summarize_by(items, key)[:10]:
+        category_data.append({
+            "category": summary['name'],
+            "products_count": summary['products_count'],
+            "total_quantity": int(summary['total_quantity']),
+            "total_value": float(summary['total_value']),
+            "percentage": float(summary['percentage'])
+        })
+    return category_data
+
 @inventory_dashboard_bp.route('/api/inventory-by-category')
 def inventory_by_category():
     """Get inventory distribution by category."""
     try:
-        date_filter = request.args.get('date')
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        category_query = f"""
-            WITH CategoryStats AS (
-                SELECT 
-                    TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)]) AS purchase_source,
-                    COUNT(DISTINCT Barcode) as products_count,
-                    SUM(Available_Qty) as total_quantity,
-                    SUM(Available_Qty * Unit_Cost) as total_value
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode IS NOT NULL
-                AND Category IS NOT NULL
-                AND Category LIKE '% / %'
-                AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-                GROUP BY TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)])
-            ),
-            TotalValue AS (
-                SELECT SUM(total_value) as grand_total
-                FROM CategoryStats
-            )
-            SELECT 
-                cs.purchase_source as category,
-                cs.products_count,
-                cs.total_quantity,
-                cs.total_value,
-                ROUND((cs.total_value / tv.grand_total) * 100, 2) as percentage
-            FROM CategoryStats cs
-            CROSS JOIN TotalValue tv
-            WHERE cs.purchase_source IS NOT NULL AND cs.purchase_source != ''
-            ORDER BY cs.total_value DESC
-            LIMIT 10
-        """
-        
-        results = run_query(category_query)
-        
-        category_data = []
-        for row in results:
-            category_data.append({
-                "category": row.category or 'غير محدد',
-                "products_count": int(row.products_count or 0),
-                "total_quantity": int(row.total_quantity or 0),
-                "total_value": float(row.total_value or 0),
-                "percentage": float(row.percentage or 0)
-            })
-            
-        return jsonify({"status": "success", "data": category_data})
+        return jsonify({"status": "success", "data": _category_breakdown(lambda item: item.purchase_source)})
         
     except Exception as e:
         print(f"❌ Error in /api/inventory-by-category: {e}")
@@ -190,103 +147,44 @@ def inventory_by_category():
 def inventory_by_main_category():
     """Get inventory distribution by main category (first part of split)."""
     try:
-        date_filter = request.args.get('date')
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        main_category_query = f"""
-            WITH MainCategoryStats AS (
-                SELECT 
-                    TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)]) AS main_category,
-                    COUNT(DISTINCT Barcode) as products_count,
-                    SUM(Available_Qty) as total_quantity,
-                    SUM(Available_Qty * Unit_Cost) as total_value
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode IS NOT NULL
-                AND Category IS NOT NULL
-                AND Category LIKE '% / %'
-                AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-                GROUP BY TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)])
-            ),
-            TotalValue AS (
-                SELECT SUM(total_value) as grand_total
-                FROM MainCategoryStats
-            )
-            SELECT 
-                cs.main_category as category,
-                cs.products_count,
-                cs.total_quantity,
-                cs.total_value,
-                ROUND((cs.total_value / tv.grand_total) * 100, 2) as percentage
-            FROM MainCategoryStats cs
-            CROSS JOIN TotalValue tv
-            WHERE cs.main_category IS NOT NULL AND cs.main_category != ''
-            ORDER BY cs.total_value DESC
-            LIMIT 10
-        """
-        
-        results = run_query(main_category_query)
-        
-        category_data = []
-        for row in results:
-            category_data.append({
-                "category": row.category or 'غير محدد',
-                "products_count": int(row.products_count or 0),
-                "total_quantity": int(row.total_quantity or 0),
-                "total_value": float(row.total_value or 0),
-                "percentage": float(row.percentage or 0)
-            })
-            
-        return jsonify({"status": "success", "data": category_data})
+        return jsonify({"status": "success", "data": _category_breakdown(lambda item: item.main_category)})
         
     except Exception as e:
         print(f"❌ Error in /api/inventory-by-main-category: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _stock_status(quantity):
+    """Stock status label and its CSS class."""
+    if quantity is None:
+        return 'مخزون جيد', 'stock-good'
+    if quantity == 0:
+        return 'نفد المخزون', 'stock-out'
+    if quantity < 10:
+        return 'مخزون منخفض', 'stock-low'
+    if quantity < 50:
+        return 'مخزون متوسط', 'stock-medium'
+    return 'مخزون جيد', 'stock-good'
+
 @inventory_dashboard_bp.route('/api/top-value-products')
 def top_value_products():
     """Get top products by inventory value."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        top_value_query = f"""
-            SELECT 
-                Product_Name as product_name,
-                Barcode,
-                Available_Qty as quantity,
-                (Available_Qty * Unit_Cost) as value,
-                CASE 
-                    WHEN Available_Qty = 0 THEN 'نفد المخزون'
-                    WHEN Available_Qty < 10 THEN 'مخزون منخفض'
-                    WHEN Available_Qty < 50 THEN 'مخزون متوسط'
-                    ELSE 'مخزون جيد'
-                END as stock_status,
-                CASE 
-                    WHEN Available_Qty = 0 THEN 'stock-low'
-                    WHEN Available_Qty < 10 THEN 'stock-low'
-                    WHEN Available_Qty < 50 THEN 'stock-medium'
-                    ELSE 'stock-good'
-                END as stock_status_class
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Available_Qty > 0
-            AND Unit_Cost > 0
-            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')))
-            ORDER BY (Available_Qty * Unit_Cost) DESC
-            LIMIT 50
-        """
-        
-        results = run_query(top_value_query)
+        items = [
+            item for item in get_stock_items()
+            if (item.available_qty or 0) > 0 and (item.unit_cost or 0) > 0 and is_listed(item)
+        ]
+        items.sort(key=item_value, reverse=True)
         
         products_data = []
-        for row in results:
+        for item in items[:50]:
+            stock_status, stock_status_class = _stock_status(item.available_qty)
             products_data.append({
-                "product_name": row.product_name,
-                "barcode": row.Barcode,
-                "quantity": int(row.quantity or 0),
-                "value": float(row.value or 0),
-                "stock_status": row.stock_status,
-                "stock_status_class": row.stock_status_class
+                "product_name": item.product_name,
+                "barcode": item.barcode,
+                "quantity": int(item.available_qty),
+                "value": float(item_value(item)),
+                "stock_status": stock_status,
+                "stock_status_class": stock_status_class
             })
             
         return jsonify({"status": "success", "data": products_data})
@@ -295,88 +193,43 @@ def top_value_products():
         print(f"❌ Error in /api/top-value-products: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _is_alert_candidate(item):
+    """Low stock (1-9 available) of a listed product, car spare parts excluded."""
+    if item.barcode is None or item.available_qty is None or not 0 < item.available_qty < 10:
+        return False
+    return is_listed(item) and (item.category is None or 'قطع غيار سيارات' not in item.category)
+
 @inventory_dashboard_bp.route('/api/stock-alerts')
 def stock_alerts():
     """Get stock alerts with intelligent stock status based on sales velocity."""
     try:
         page = int(request.args.get('page', 1))
         limit = int(request.args.get('limit', 50))
-        offset = (page - 1) * limit
-        
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        # Query للحصول على العدد الكلي
-        count_query = f"""
-            SELECT COUNT(*) as total_count
-            FROM (
-                SELECT 
-                    t1.Barcode
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data` AS t1
-                LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.pos_order_lines` AS t2
-                ON t1.Barcode = t2.product_barcode
-                AND t2.order_date >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 30 DAY)
-                WHERE t1.Available_Qty < 10
-                AND t1.Available_Qty > 0
-                AND t1.Barcode IS NOT NULL
-                AND (t1.Category IS NULL OR (t1.Category LIKE '% / %' 
-                    AND NOT (t1.Category LIKE '%خدمات%' 
-                        OR t1.Category LIKE '%خدمات وخصومات%'
-                        OR t1.Category LIKE '%قطع غيار سيارات%')))
-                GROUP BY t1.Product_Name, t1.Barcode, t1.Available_Qty, t1.Unit_Cost, t1.Category
-            ) AS subquery
-        """
-        
-        count_result = list(run_query(count_query))
-        total_count = count_result[0].total_count if count_result else 0
-        total_pages = (total_count + limit - 1) // limit
         
-        alerts_query = f"""
-            SELECT
-                t1.Product_Name AS product_name,
-                t1.Barcode AS barcode,
-                t1.Available_Qty AS qty_available,
-                t1.Unit_Cost,
-                (t1.Available_Qty * t1.Unit_Cost) AS value,
-                t1.Category AS full_category,
-                TRIM(SPLIT(t1.Category, ' / ')[SAFE_OFFSET(0)]) AS main_category,
-                COALESCE(SUM(t2.quantity), 0) AS total_sales_quantity_last_30_days,
-                CASE
-                    WHEN t1.Available_Qty <= COALESCE(SUM(t2.quantity), 0) / 30 * 7 THEN 'Very Low'
-                    WHEN t1.Available_Qty <= COALESCE(SUM(t2.quantity), 0) / 30 * 14 THEN 'Low'
-                    WHEN t1.Available_Qty < 10 THEN 'Low (Fixed Threshold)'
-                    ELSE 'Sufficient'
-                END AS stock_status
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data` AS t1
-            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.pos_order_lines` AS t2
-            ON t1.Barcode = t2.product_barcode
-            AND t2.order_date >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 30 DAY)
-            WHERE t1.Available_Qty < 10
-            AND t1.Available_Qty > 0
-            AND t1.Barcode IS NOT NULL
-            AND (t1.Category IS NULL OR (t1.Category LIKE '% / %' 
-                AND NOT (t1.Category LIKE '%خدمات%' 
-                    OR t1.Category LIKE '%خدمات وخصومات%'
-                    OR t1.Category LIKE '%قطع غيار سيارات%')))
-            GROUP BY t1.Product_Name, t1.Barcode, t1.Available_Qty, t1.Unit_Cost, t1.Category
-            ORDER BY t1.Available_Qty ASC, (t1.Available_Qty * t1.Unit_Cost) DESC
-            LIMIT {limit} OFFSET {offset}
-        """
-        
-        results = run_query(alerts_query)
+        candidates = [item for item in get_stock_items() if _is_alert_candidate(item)]
+        candidates.sort(key=lambda item: (item.available_qty, descending(item_value(item))))
+        page_items, total_count, total_pages = paginate(candidates, page, limit)
+        sales = get_recent_sales_quantities() if page_items else {}
         
         alerts_data = []
-        for row in results:
+        for item in page_items:
+            sold = sales.get(item.barcode, 0)
+            if item.available_qty <= sold / 30 * 7:
+                stock_status = 'Very Low'
+            elif item.available_qty <= sold / 30 * 14:
+                stock_status = 'Low'
+            else:
+                stock_status = 'Low (Fixed Threshold)'
             alerts_data.append({
-                "product_name": row.product_name,
-                "barcode": row.barcode,
-                "qty_available": int(row.qty_available or 0),
-                "unit_cost": float(row.Unit_Cost or 0),
-                "value": float(row.value or 0),
-                "category": row.full_category,
-                "main_category": row.main_category,
-                "total_sales_last_30_days": int(row.total_sales_quantity_last_30_days or 0),
-                "stock_status": row.stock_status
+                "product_name": item.product_name,
+                "barcode": item.barcode,
+                "qty_available": int(item.available_qty),
+                "unit_cost": float(item.unit_cost or 0),
+                "value": float(item_value(item) or 0),
+                "category": item.category,
+                "main_category": item.main_category,
+                "total_sales_last_30_days": int(sold),
+                "stock_status": stock_status
             })
             
         return jsonify({
@@ -400,68 +253,19 @@ def main_categories():
     try:
         page = int(request.args.get('page', 1))
         limit = int(request.args.get('limit', 50))
-        offset = (page - 1) * limit
-        
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        # Query للحصول على العدد الكلي
-        count_query = f"""
-            SELECT COUNT(DISTINCT TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)])) as total_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Barcode IS NOT NULL
-            AND Category IS NOT NULL
-            AND Category LIKE '% / %'
-            AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-            AND TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)]) IS NOT NULL 
-            AND TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)]) != ''
-        """
         
-        count_result = list(run_query(count_query))
-        total_count = count_result[0].total_count if count_result else 0
-        total_pages = (total_count + limit - 1) // limit
-        
-        main_category_query = f"""
-            WITH MainCategoryStats AS (
-                SELECT 
-                    TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)]) AS main_category,
-                    COUNT(DISTINCT Barcode) as product_count,
-                    SUM(Available_Qty) as total_quantity,
-                    SUM(Available_Qty * Unit_Cost) as total_value
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode IS NOT NULL
-                AND Category IS NOT NULL
-                AND Category LIKE '% / %'
-                AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-                GROUP BY TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(0)])
-            ),
-            TotalValue AS (
-                SELECT SUM(total_value) as grand_total
-                FROM MainCategoryStats
-            )
-            SELECT 
-                cs.main_category,
-                cs.product_count,
-                cs.total_quantity,
-                cs.total_value,
-                ROUND((cs.total_value / tv.grand_total) * 100, 2) as percentage
-            FROM MainCategoryStats cs
-            CROSS JOIN TotalValue tv
-            WHERE cs.main_category IS NOT NULL AND cs.main_category != ''
-            ORDER BY cs.total_value DESC
-            LIMIT {limit} OFFSET {offset}
-        """
-        
-        results = run_query(main_category_query)
+        items = [item for item in get_stock_items() if item.barcode is not None and is_categorized(item)]
+        summaries = summarize_by(items, lambda item: item.main_category)
+        page_summaries, total_count, total_pages = paginate(summaries, page, limit)
         
         category_data = []
-        for row in results:
+        for summary in page_summaries:
             category_data.append({
-                "main_category": row.main_category or 'غير محدد',
-                "product_count": int(row.product_count or 0),
-                "total_quantity": int(row.total_quantity or 0),
-                "total_value": f"{float(row.total_value or 0):,.2f}",
-                "percentage": float(row.percentage or 0)
+                "main_category": summary['name'],
+                "product_count": summary['products_count'],
+                "total_quantity": int(summary['total_quantity']),
+                "total_value": f"{float(summary['total_value']):,.2f}",
+                "percentage": float(summary['percentage'])
             })
             
         return jsonify({
@@ -485,71 +289,20 @@ def purchase_sources():
     try:
         page = int(request.args.get('page', 1))
         limit = int(request.args.get('limit', 50))
-        offset = (page - 1) * limit
         
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        # Query للحصول على العدد الكلي
-        count_query = f"""
-            SELECT COUNT(DISTINCT TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)])) as total_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Barcode IS NOT NULL
-            AND Category IS NOT NULL
-            AND Category LIKE '% / %'
-            AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-            AND TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)]) IS NOT NULL 
-            AND TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)]) != ''
-        """
-        
-        count_result = list(run_query(count_query))
-        total_count = count_result[0].total_count if count_result else 0
-        total_pages = (total_count + limit - 1) // limit
-        
-        category_query = f"""
-            WITH CategoryStats AS (
-                SELECT 
-                    TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)]) AS purchase_source,
-                    COUNT(DISTINCT Barcode) as product_count,
-                    SUM(Available_Qty) as total_quantity,
-                    SUM(Available_Qty * Unit_Cost) as total_value,
-                    AVG(Unit_Cost) as avg_price
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode IS NOT NULL
-                AND Category IS NOT NULL
-                AND Category LIKE '% / %'
-                AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')
-                GROUP BY TRIM(SPLIT(Category, ' / ')[SAFE_OFFSET(1)])
-            ),
-            TotalValue AS (
-                SELECT SUM(total_value) as grand_total
-                FROM CategoryStats
-            )
-            SELECT 
-                cs.purchase_source,
-                cs.product_count,
-                cs.total_quantity,
-                cs.total_value,
-                cs.avg_price,
-                ROUND((cs.total_value / tv.grand_total) * 100, 2) as percentage
-            FROM CategoryStats cs
-            CROSS JOIN TotalValue tv
-            WHERE cs.purchase_source IS NOT NULL AND cs.purchase_source != ''
-            ORDER BY cs.total_value DESC
-            LIMIT {limit} OFFSET {offset}
-        """
-        
-        results = run_query(category_query)
+        items = [item for item in get_stock_items() if item.barcode is not None and is_categorized(item)]
+        summaries = summarize_by(items, lambda item: item.purchase_source)
+        page_summaries, total_count, total_pages = paginate(summaries, page, limit)
         
         category_data = []
-        for row in results:
+        for summary in page_summaries:
             category_data.append({
-                "purchase_source": row.purchase_source or 'غير محدد',
-                "product_count": int(row.product_count or 0),
-                "total_quantity": int(row.total_quantity or 0),
-                "total_value": f"{float(row.total_value or 0):,.2f}",
-                "avg_price": f"{float(row.avg_price or 0):,.2f}",
-                "percentage": float(row.percentage or 0)
+                "purchase_source": summary['name'],
+                "product_count": summary['products_count'],
+                "total_quantity": int(summary['total_quantity']),
+                "total_value": f"{float(summary['total_value']):,.2f}",
+                "avg_price": f"{float(summary['avg_price'] or 0):,.2f}",
+                "percentage": float(summary['percentage'])
             })
             
         return jsonify({
@@ -571,34 +324,20 @@ def purchase_sources():
 def low_stock_alerts():
     """Get low stock alerts."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
-        alerts_query = f"""
-            SELECT 
-                Product_Name as product_name,
-                Barcode as barcode,
-                Available_Qty as quantity,
-                Unit_Cost,
-                (Available_Qty * Unit_Cost) as value
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Available_Qty < 10
-            AND Barcode IS NOT NULL
-            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')))
-            ORDER BY Available_Qty ASC, (Available_Qty * Unit_Cost) DESC
-            LIMIT 50
-        """
-        
-        results = run_query(alerts_query)
+        items = [
+            item for item in get_stock_items()
+            if item.barcode is not None and item.available_qty is not None and item.available_qty < 10 and is_listed(item)
+        ]
+        items.sort(key=lambda item: (item.available_qty, descending(item_value(item))))
         
         alerts_data = []
-        for row in results:
+        for item in items[:50]:
             alerts_data.append({
-                "product_name": row.product_name,
-                "barcode": row.barcode,
-                "quantity": int(row.quantity or 0),
-                "unit_cost": float(row.Unit_Cost or 0),
-                "value": float(row.value or 0)
+                "product_name": item.product_name,
+                "barcode": item.barcode,
+                "quantity": int(item.available_qty),
+                "unit_cost": float(item.unit_cost or 0),
+                "value": float(item_value(item) or 0)
             })
             
         return jsonify({"status": "success", "data": alerts_data})
@@ -615,69 +354,44 @@ def stagnant_stock():
         limit = int(request.args.get('limit', 50))
         offset = (page - 1) * limit
         
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
+        # Products in stock with no order line (sale or return) in the last 30 days
+        stagnant_conditions = """
+            WHERE available_qty > 0
+            AND (last_activity_date IS NULL OR last_activity_date < DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY))
+            AND (category IS NULL OR (category LIKE '% / %' 
+                AND NOT is_service
+                AND NOT (category LIKE '%منوع%')
+                AND NOT (category LIKE '%ادوات تغليف%')
+                AND NOT (category LIKE '%ورد%')
+                AND NOT (category LIKE '%بوكيه ورد%')
+                AND NOT (category LIKE '%اشجار زينة%')))
+        """
+        facts = product_facts_relation()
         
         # Query للحصول على العدد الكلي
         count_query = f"""
-            WITH RecentSales AS (
-                SELECT DISTINCT product_barcode
-                FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-                AND product_barcode IS NOT NULL
-                AND product_category LIKE '% / %'
-                AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-            )
             SELECT COUNT(*) as total_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data` s
-            LEFT JOIN RecentSales rs ON s.Barcode = rs.product_barcode
-            WHERE rs.product_barcode IS NULL
-            AND s.Available_Qty > 0
-            AND (s.Category IS NULL OR (s.Category LIKE '% / %' 
-                AND NOT (s.Category LIKE '%خدمات%' OR s.Category LIKE '%خدمات وخصومات%')
-                AND NOT (s.Category LIKE '%منوع%')
-                AND NOT (s.Category LIKE '%ادوات تغليف%')
-                AND NOT (s.Category LIKE '%ورد%')
-                AND NOT (s.Category LIKE '%بوكيه ورد%')
-                AND NOT (s.Category LIKE '%اشجار زينة%')))
+            FROM {facts}
+            {stagnant_conditions}
         """
         
-        count_result = list(run_query(count_query))
-        total_count = count_result[0].total_count if count_result else 0
-        total_pages = (total_count + limit - 1) // limit
-        
-        # Get products that haven't sold in the last 30 days
         stagnant_query = f"""
-            WITH RecentSales AS (
-                SELECT DISTINCT product_barcode
-                FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-                AND product_barcode IS NOT NULL
-                AND product_category LIKE '% / %'
-                AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-            )
             SELECT 
-                s.Product_Name as product_name,
-                s.Barcode as barcode,
-                s.Available_Qty as quantity,
-                s.Unit_Cost as unit_cost,
-                (s.Available_Qty * s.Unit_Cost) as total_value
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data` s
-            LEFT JOIN RecentSales rs ON s.Barcode = rs.product_barcode
-            WHERE rs.product_barcode IS NULL
-            AND s.Available_Qty > 0
-            AND (s.Category IS NULL OR (s.Category LIKE '% / %' 
-                AND NOT (s.Category LIKE '%خدمات%' OR s.Category LIKE '%خدمات وخصومات%')
-                AND NOT (s.Category LIKE '%منوع%')
-                AND NOT (s.Category LIKE '%ادوات تغليف%')
-                AND NOT (s.Category LIKE '%ورد%')
-                AND NOT (s.Category LIKE '%بوكيه ورد%')
-                AND NOT (s.Category LIKE '%اشجار زينة%')))
-            ORDER BY s.Available_Qty DESC
+                product_name,
+                barcode,
+                available_qty as quantity,
+                unit_cost,
+                stock_value as total_value
+            FROM {facts}
+            {stagnant_conditions}
+            ORDER BY available_qty DESC
             LIMIT {limit} OFFSET {offset}
         """
         
-        results = run_query(stagnant_query)
+        count_result, results = run_queries(count_query, stagnant_query)
+        count_result = list(count_result)
+        total_count = count_result[0].total_count if count_result else 0
+        total_pages = (total_count + limit - 1) // limit
         
         stagnant_data = []
         for row in results:
@@ -708,48 +422,30 @@ def stagnant_stock():
 def bestselling_with_stock():
     """Get best selling products with current stock levels."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
         bestselling_query = f"""
-            WITH SalesData AS (
-                SELECT 
-                    product_barcode,
-                    product_name,
-                    SUM(quantity) as total_quantity,
-                    SUM(subtotal_incl) as total_sales
-                FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-                WHERE DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-                AND product_barcode IS NOT NULL
-                AND quantity > 0
-                AND product_category LIKE '% / %'
-                AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-                GROUP BY product_barcode, product_name
-                ORDER BY total_sales DESC
-                LIMIT 50
-            )
             SELECT 
-                sd.product_name,
-                sd.product_barcode,
-                sd.total_quantity,
-                sd.total_sales,
-                COALESCE(st.Available_Qty, 0) as current_stock,
+                product_name,
+                barcode as product_barcode,
+                units_30d as total_quantity,
+                revenue_30d as total_sales,
+                COALESCE(available_qty, 0) as current_stock,
                 CASE 
-                    WHEN COALESCE(st.Available_Qty, 0) = 0 THEN 'نفد المخزون'
-                    WHEN COALESCE(st.Available_Qty, 0) < 10 THEN 'مخزون منخفض'
-                    WHEN COALESCE(st.Available_Qty, 0) < 50 THEN 'مخزون متوسط'
+                    WHEN COALESCE(available_qty, 0) = 0 THEN 'نفد المخزون'
+                    WHEN COALESCE(available_qty, 0) < 10 THEN 'مخزون منخفض'
+                    WHEN COALESCE(available_qty, 0) < 50 THEN 'مخزون متوسط'
                     ELSE 'مخزون جيد'
                 END as stock_status,
                 CASE 
-                    WHEN COALESCE(st.Available_Qty, 0) = 0 THEN 'stock-low'
-                    WHEN COALESCE(st.Available_Qty, 0) < 10 THEN 'stock-low'
-                    WHEN COALESCE(st.Available_Qty, 0) < 50 THEN 'stock-medium'
+                    WHEN COALESCE(available_qty, 0) = 0 THEN 'stock-low'
+                    WHEN COALESCE(available_qty, 0) < 10 THEN 'stock-low'
+                    WHEN COALESCE(available_qty, 0) < 50 THEN 'stock-medium'
                     ELSE 'stock-good'
                 END as stock_status_class
-            FROM SalesData sd
-            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.stock_data` st ON sd.product_barcode = st.Barcode
-            WHERE (st.Category IS NULL OR (st.Category LIKE '% / %' AND NOT (st.Category LIKE '%خدمات%' OR st.Category LIKE '%خدمات وخصومات%')))
-            ORDER BY sd.total_sales DESC
+            FROM {product_facts_relation()}
+            WHERE lines_30d > 0
+            AND (category IS NULL OR (category LIKE '% / %' AND NOT is_service))
+            ORDER BY revenue_30d DESC
+            LIMIT 50
         """
         
         results = run_query(bestselling_query)
@@ -775,27 +471,17 @@ def bestselling_with_stock():
 def profitable_with_stock_simple():
     """Get most profitable products with current stock levels - simplified version."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
         # Simplified query focusing on revenue only
         simple_query = f"""
             SELECT 
                 product_name,
-                product_barcode,
-                SUM(subtotal_incl) as total_revenue,
-                SUM(quantity) as total_quantity_sold,
-                COUNT(*) as transaction_count
-            FROM `{PROJECT_ID}.{DATASET_ID}.pos_order_lines`
-            WHERE DATE(order_date) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-            AND product_barcode IS NOT NULL
-            AND quantity > 0
-            AND subtotal_incl > 0
-            AND product_category LIKE '% / %'
-            AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-            GROUP BY product_barcode, product_name
-            HAVING total_revenue > 100
-            ORDER BY total_revenue DESC
+                barcode as product_barcode,
+                revenue_30d as total_revenue,
+                units_30d as total_quantity_sold,
+                lines_30d as transaction_count
+            FROM {product_facts_relation()}
+            WHERE revenue_30d > 100
+            ORDER BY revenue_30d DESC
             LIMIT 50
         """
         
@@ -821,6 +507,22 @@ def profitable_with_stock_simple():
         print(f"❌ Error in /api/profitable-with-stock-simple: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _product_details(item, last_updated):
+    stock_status, stock_status_class = _stock_status(item.available_qty)
+    return {
+        "product_name": item.product_name,
+        "barcode": item.barcode,
+        "category": item.category or 'غير محدد',
+        "qty_on_hand": int(item.qty_on_hand or 0),
+        "reserved_qty": int(item.reserved_qty or 0),
+        "available_qty": int(item.available_qty or 0),
+        "unit_cost": float(item.unit_cost or 0),
+        "total_value": float(item_value(item) or 0),
+        "last_updated": str(last_updated) if last_updated else 'غير محدد',
+        "stock_status": stock_status,
+        "stock_status_class": stock_status_class
+    }
+
 @inventory_dashboard_bp.route('/api/search-product')
 def search_product():
     """Search for product by barcode in stock_data table."""
@@ -829,108 +531,19 @@ def search_product():
         if not barcode:
             return jsonify({"status": "error", "message": "Barcode parameter is required"}), 400
             
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        
         # Search for exact barcode match first
-        search_query = f"""
-            SELECT 
-                Product_Name as product_name,
-                Barcode as barcode,
-                Category as category,
-                Qty_On_Hand as qty_on_hand,
-                Reserved_Qty as reserved_qty,
-                Available_Qty as available_qty,
-                Unit_Cost as unit_cost,
-                (Available_Qty * Unit_Cost) as total_value,
-                CURRENT_TIMESTAMP() as last_updated,
-                CASE 
-                    WHEN Available_Qty = 0 THEN 'نفد المخزون'
-                    WHEN Available_Qty < 10 THEN 'مخزون منخفض'
-                    WHEN Available_Qty < 50 THEN 'مخزون متوسط'
-                    ELSE 'مخزون جيد'
-                END as stock_status,
-                CASE 
-                    WHEN Available_Qty = 0 THEN 'stock-out'
-                    WHEN Available_Qty < 10 THEN 'stock-low'
-                    WHEN Available_Qty < 50 THEN 'stock-medium'
-                    ELSE 'stock-good'
-                END as stock_status_class
-            FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-            WHERE Barcode = '{barcode}'
-            LIMIT 1
-        """
+        item = find_by_barcode(barcode)
+        last_updated = stock_replica.loaded_at
+        if item is not None:
+            return jsonify({"status": "success", "data": _product_details(item, last_updated)})
         
-        results = list(run_query(search_query))
-        
-        if results:
-            product = results[0]
-            product_data = {
-                "product_name": product.product_name,
-                "barcode": product.barcode,
-                "category": product.category or 'غير محدد',
-                "qty_on_hand": int(product.qty_on_hand or 0),
-                "reserved_qty": int(product.reserved_qty or 0),
-                "available_qty": int(product.available_qty or 0),
-                "unit_cost": float(product.unit_cost or 0),
-                "total_value": float(product.total_value or 0),
-                "last_updated": str(product.last_updated) if product.last_updated else 'غير محدد',
-                "stock_status": product.stock_status,
-                "stock_status_class": product.stock_status_class
-            }
-            return jsonify({"status": "success", "data": product_data})
+        # If exact match not found, try partial search (ranked barcode/name matches)
+        products_data = [_product_details(item, last_updated) for item in search_products(barcode, limit=10)]
+        
+        if products_data:
+            return jsonify({"status": "success", "data": products_data, "multiple": True})
         else:
-            # If exact match not found, try partial search
-            partial_search_query = f"""
-                SELECT 
-                    Product_Name as product_name,
-                    Barcode as barcode,
-                    Category as category,
-                    Qty_On_Hand as qty_on_hand,
-                    Reserved_Qty as reserved_qty,
-                    Available_Qty as available_qty,
-                    Unit_Cost as unit_cost,
-                    (Available_Qty * Unit_Cost) as total_value,
-                    CURRENT_TIMESTAMP() as last_updated,
-                    CASE 
-                        WHEN Available_Qty = 0 THEN 'نفد المخزون'
-                        WHEN Available_Qty < 10 THEN 'مخزون منخفض'
-                        WHEN Available_Qty < 50 THEN 'مخزون متوسط'
-                        ELSE 'مخزون جيد'
-                    END as stock_status,
-                    CASE 
-                        WHEN Available_Qty = 0 THEN 'stock-out'
-                        WHEN Available_Qty < 10 THEN 'stock-low'
-                        WHEN Available_Qty < 50 THEN 'stock-medium'
-                        ELSE 'stock-good'
-                    END as stock_status_class
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode LIKE '%{barcode}%' 
-                OR Product_Name LIKE '%{barcode}%'
-                LIMIT 10
-            """
-            
-            partial_results = list(run_query(partial_search_query))
-            
-            if partial_results:
-                products_data = []
-                for product in partial_results:
-                    products_data.append({
-                        "product_name": product.product_name,
-                        "barcode": product.barcode,
-                        "category": product.category or 'غير محدد',
-                        "qty_on_hand": int(product.qty_on_hand or 0),
-                        "reserved_qty": int(product.reserved_qty or 0),
-                        "available_qty": int(product.available_qty or 0),
-                        "unit_cost": float(product.unit_cost or 0),
-                        "total_value": float(product.total_value or 0),
-                        "last_updated": str(product.last_updated) if product.last_updated else 'غير محدد',
-                        "stock_status": product.stock_status,
-                        "stock_status_class": product.stock_status_class
-                    })
-                return jsonify({"status": "success", "data": products_data, "multiple": True})
-            else:
-                return jsonify({"status": "error", "message": "لم يتم العثور على منتج بهذا الباركود"}), 404
+            return jsonify({"status": "error", "message": "لم يتم العثور على منتج بهذا الباركود"}), 404
         
     except Exception as e:
         print(f"❌ Error in /api/search-product: {e}")
@@ -957,14 +570,14 @@ def historical_stock():
                 reserved_quantity as reserved_qty,
                 available_quantity as available_qty
             FROM `{PROJECT_ID}.{DATASET_ID}.historical_inventory`
-            WHERE DATE(snapshot_date) = '{date_filter}'
-            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')))
+            WHERE DATE(snapshot_date) = CAST(@snapshot_date AS DATE)
+            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT {is_service_sql('Category')}))
             ORDER BY product_name
             LIMIT 100
         """
         
         try:
-            results = run_query(historical_query)
+            results = run_query(historical_query, {'snapshot_date': date_filter})
             historical_data = []
             for row in results:
                 historical_data.append({
@@ -992,7 +605,7 @@ def historical_stock():
                 Available_Qty as available_qty
             FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
             WHERE Barcode IS NOT NULL
-            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT (Category LIKE '%خدمات%' OR Category LIKE '%خدمات وخصومات%')))
+            AND (Category IS NULL OR (Category LIKE '% / %' AND NOT {stock_column('is_service')}))
             ORDER BY Product_Name
             LIMIT 100
         """
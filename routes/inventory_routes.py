@@ -3,9 +3,15 @@
 
 from flask import Blueprint, render_template, jsonify
 # Assuming you have a central place for your BigQuery logic, like in the example
-from database import run_query, get_project_id, get_dataset_id
+from database import iter_query_batches, get_project_id, get_dataset_id
 from cache import cache_query
+from utils import QueryFilter
+from dimensions import get_inventory_filters
 from performance_monitor import performance_monitor
+from streaming import stream_column_batches
+
+# Rows fetched from BigQuery per page while streaming
+STREAM_PAGE_SIZE = 5000
 
 inventory_bp = Blueprint('inventory', __name__)
 
@@ -16,41 +22,8 @@ def inventory_dashboard():
     Main inventory data is loaded asynchronously via API.
     """
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        INVENTORY_TABLE_ID = "inventory_levels_history"
-
-        # Lightweight query to get only unique products and locations for filters
-        query = f"""
-            SELECT DISTINCT 
-                product_name, 
-                product_barcode, 
-                location_name
-            FROM `{PROJECT_ID}.{DATASET_ID}.{INVENTORY_TABLE_ID}`
-            WHERE snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)
-            AND product_name IS NOT NULL 
-            AND product_barcode IS NOT NULL
-            AND location_name IS NOT NULL
-            ORDER BY product_name, location_name
-            LIMIT 500
-        """
-        results = run_query(query)
-        
-        # Process unique products and locations
-        products_dict = {}
-        locations_set = set()
-        
-        for row in results:
-            if row['product_barcode'] and row['product_name']:
-                products_dict[row['product_barcode']] = {
-                    'product_barcode': row['product_barcode'],
-                    'product_name': row['product_name']
-                }
-            if row['location_name']:
-                locations_set.add(row['location_name'])
-        
-        unique_products = list(products_dict.values())
-        unique_locations = sorted(list(locations_set))
+        # Products and locations seen in the last 7 days, from the in-memory dimensions
+        unique_products, unique_locations = get_inventory_filters()
         
         return render_template(
             "inventory_dashboard.html", 
@@ -72,6 +45,7 @@ def inventory_history_api():
     """
     API endpoint to serve large inventory history dataset asynchronously.
     This decouples heavy data transfer from initial page load.
+    Rows are streamed as they arrive (?format=ndjson for NDJSON).
     """
     try:
         PROJECT_ID = get_project_id()
@@ -93,15 +67,9 @@ def inventory_history_api():
             ORDER BY snapshot_date DESC, product_name
             LIMIT 50000
         """
-        results = run_query(query)
-        
-        stock_history = [dict(row) for row in results]
+        batches = iter_query_batches(query, batch_size=STREAM_PAGE_SIZE)
         
-        return jsonify({
-            'status': 'success',
-            'data': stock_history,
-            'total_records': len(stock_history)
-        })
+        return stream_column_batches(batches)
 
     except Exception as e:
         print(f"❌ Error in /api/inventory/history: {e}")
@@ -116,6 +84,7 @@ def inventory_history_api():
 def inventory_filtered_api():
     """
     API endpoint for filtered inventory data based on product/location.
+    Rows are streamed as they arrive (?format=ndjson for NDJSON).
     """
     try:
         from flask import request
@@ -130,14 +99,14 @@ def inventory_filtered_api():
         days = int(request.args.get('days', 30))
         
         # Build dynamic WHERE clause
-        where_conditions = [f"snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)"]
+        filters = QueryFilter().add("snapshot_date >= DATE_SUB(CURRENT_DATE(), INTERVAL @days DAY)", days=days)
         
         if product_barcode:
-            where_conditions.append(f"product_barcode = '{product_barcode}'")
+            filters.add("product_barcode = @product_barcode", product_barcode=product_barcode)
         if location_name:
-            where_conditions.append(f"location_name = '{location_name}'")
+            filters.add("location_name = @location_name", location_name=location_name)
         
-        where_clause = " AND ".join(where_conditions)
+        where_sql = filters.where_sql
         
         query = f"""
             SELECT 
@@ -149,18 +118,13 @@ def inventory_filtered_api():
                 reserved_quantity,
                 available_quantity
             FROM `{PROJECT_ID}.{DATASET_ID}.{INVENTORY_TABLE_ID}`
-            WHERE {where_clause}
+            {where_sql}
             ORDER BY snapshot_date DESC, product_name
             LIMIT 10000
         """
-        results = run_query(query)
+        batches = iter_query_batches(query, filters.params, batch_size=STREAM_PAGE_SIZE)
         
-        filtered_data = [dict(row) for row in results]
-        
-        return jsonify({
-            'status': 'success',
-            'data': filtered_data,
-            'total_records': len(filtered_data),
+        return stream_column_batches(batches, meta={
             'filters': {
                 'product_barcode': product_barcode,
                 'location_name': location_name,
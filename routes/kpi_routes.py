@@ -1,11 +1,16 @@
 # routes/kpi_routes.py
 # KPI and main business metrics API routes
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, current_app
+from urllib.parse import urlencode
+from werkzeug.exceptions import HTTPException
 from decimal import Decimal
 from collections import OrderedDict
 from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from utils import get_user_filters
+from kpi_engine import get_kpi_cube, measure, total_row
+from category_rules import line_column
+from query_budget import estimate_view
 
 kpi_bp = Blueprint('kpi', __name__)
 
@@ -13,86 +18,37 @@ kpi_bp = Blueprint('kpi', __name__)
 def main_kpi_data():
     """API endpoint to fetch the main KPI data."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        print(f"🔍 KPI Data Filter: {where_sql}")  # Debug logging
+        totals = total_row(get_kpi_cube())
         
-        kpi_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` 
-                {where_sql}
-            )
-            SELECT
-                -- ## مجموعة المبيعات ##
-                -- 1. إجمالي المبيعات
-                CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 0) AS NUMERIC) AS total_sales,
-                -- 2. المبيعات بدون خدمات
-                CAST(COALESCE(SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, subtotal_incl, 0)), 0) AS NUMERIC) AS sales_without_services,
-
-                -- ## مجموعة الأرباح ##
-                -- 3. إجمالي الأرباح
-                CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END), 0) AS NUMERIC) AS profit,
-                -- 4. هامش الربح
-                CAST(COALESCE(SAFE_DIVIDE(
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END),
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) ELSE 0 END)
-                ), 0) AS NUMERIC) as profit_margin,
-
-                -- ## مجموعة الفواتير والعملاء ##
-                -- 5. عدد الفواتير
-                CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END), 0) AS INT64) AS invoice_count,
-                -- 6. متوسط قيمة الفاتورة
-                CAST(COALESCE(SAFE_DIVIDE(
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 
-                    COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END)
-                ), 0) AS NUMERIC) as avg_invoice_value,
-                -- 7. عدد العملاء
-                CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN phone_number ELSE NULL END), 0) AS INT64) AS customer_count,
-
-                -- ## مجموعة القطع ##
-                -- 8. عدد القطع المباعة
-                CAST(COALESCE(SUM(IF(branch != 'المتجر الالكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, quantity, 0)), 0) AS INT64) AS total_items_sold,
-
-                -- ## مجموعة المرتجعات ##
-                -- 9. عدد القطع المرتجعة
-                CAST(COALESCE(SUM(IF(quantity < 0 AND branch != 'المتجر الإلكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, ABS(quantity), 0)), 0) AS INT64) AS returned_items_count,
-                -- 10. قيمة القطع المرتجعة
-                CAST(COALESCE(SUM(IF(quantity < 0 AND branch != 'المتجر الإلكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, ABS(subtotal_incl), 0)), 0) AS NUMERIC) AS returned_items_value,
-
-                -- ## مجموعة الخدمات ##
-                -- 11. قيمة الخدمات
-                CAST(COALESCE(SUM(IF(
-                    quantity > 0 AND
-                    branch != 'المتجر الالكتروني' AND
-                    (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%') AND
-                    (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%') AND
-                    subtotal_incl IS NOT NULL,
-                    subtotal_incl, 0
-                )), 0) AS NUMERIC) AS services_value,
-                -- 12. مرتجعات الخدمات
-                CAST(COALESCE(SUM(IF(
-                    quantity < 0 AND
-                    branch != 'المتجر الالكتروني' AND
-                    (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%') AND
-                    (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%') AND
-                    subtotal_incl IS NOT NULL,
-                    ABS(subtotal_incl), 0
-                )), 0) AS NUMERIC) AS returned_services_value,
-
-                -- ## Other KPIs (not displayed but might be needed) ##
-                CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) ELSE 0 END), 0) AS NUMERIC) AS net_sales_without_vat,
-                CAST(COALESCE(SUM(IF(total_cost > 0 AND subtotal_incl IS NOT NULL, ROUND((subtotal_incl / 1.15), 2), 0)), 0) AS NUMERIC) AS gross_sales_without_vat,
-                CAST(COALESCE(SUM(CASE WHEN total_cost IS NOT NULL THEN total_cost ELSE 0 END), 0) AS NUMERIC) AS total_cost_all
-
-            FROM FilteredData
-            WHERE subtotal_incl IS NOT NULL;
-        """
+        total_sales = measure(totals, 'total_sales')
+        net_sales = measure(totals, 'net_sales')
+        invoice_count = measure(totals, 'invoice_count')
         
-        results = run_query(kpi_query)
-        kpis_english = dict(list(results)[0]) if results.total_rows > 0 else {}
+        # Same order as the cards on the dashboard
+        kpis_english = {
+            # ## مجموعة المبيعات ##
+            "total_sales": float(total_sales),
+            "sales_without_services": float(measure(totals, 'sales_without_services')),
+            # ## مجموعة الأرباح ##
+            "profit": float(measure(totals, 'profit')),
+            "profit_margin": measure(totals, 'profit') / net_sales if net_sales else 0,
+            # ## مجموعة الفواتير والعملاء ##
+            "invoice_count": int(invoice_count),
+            "avg_invoice_value": float(total_sales / invoice_count) if invoice_count else 0.0,
+            "customer_count": int(measure(totals, 'customer_count')),
+            # ## مجموعة القطع ##
+            "total_items_sold": int(round(measure(totals, 'store_items_sold'))),
+            # ## مجموعة المرتجعات ##
+            "returned_items_count": int(round(measure(totals, 'store_returned_quantity'))),
+            "returned_items_value": float(measure(totals, 'store_returned_value')),
+            # ## مجموعة الخدمات ##
+            "services_value": float(measure(totals, 'services_value')),
+            "returned_services_value": float(measure(totals, 'returned_services_value')),
+            # ## Other KPIs (not displayed but might be needed) ##
+            "net_sales_without_vat": float(net_sales),
+            "gross_sales_without_vat": float(measure(totals, 'gross_sales_without_vat')),
+            "total_cost_all": float(measure(totals, 'total_cost'))
+        }
 
         key_mapping = {
             "total_sales": "إجمالي المبيعات",
@@ -111,7 +67,6 @@ def main_kpi_data():
             "total_cost_all": "إجمالي التكلفة"
         }
 
-        # The order of the final dictionary is now controlled by the SQL query's SELECT order
         formatted_kpis_arabic = {}
         fields_to_exclude = ['gross_sales_without_vat', 'net_sales_without_vat', 'total_cost_all']
 
@@ -138,22 +93,17 @@ def main_kpi_data():
 def services_breakdown():
     """API endpoint for services breakdown details."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
         
         # Add business logic conditions to the universal filter
-        if where_sql:
-            where_sql += """ AND quantity > 0
-                AND (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-                AND (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%')
-            """
-        else:
-            where_sql = """WHERE quantity > 0
-                AND (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
-                AND (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%')
-            """
+        filters.add(f"""quantity > 0
+            AND {line_column('is_service')}
+            AND NOT {line_column('is_service_adjustment')}
+        """)
+        where_sql = filters.where_sql
 
         services_query = f"""
             SELECT 
@@ -165,7 +115,7 @@ def services_breakdown():
             HAVING SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) > 0 
             ORDER BY total_value DESC;
         """
-        results = run_query(services_query)
+        results = run_query(services_query, filters.params)
         
         services_data, total_sum = [], 0
         rows = list(results)
@@ -185,83 +135,31 @@ def services_breakdown():
 def sales_breakdown_by_source():
     """API endpoint for sales breakdown by purchase source."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-
-        # Add business logic conditions
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} product_category LIKE '% / %'
-            AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%' OR product_category LIKE '%بضاعة مخفضة%')
-        """
-
-        sales_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            ),
-            GrandTotals AS (
-                SELECT SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) as grand_total_sales
-                FROM FilteredData
-            ),
-            GroupedData AS (
-                SELECT
-                    TRIM(LOWER(SPLIT(product_category, ' / ')[SAFE_OFFSET(1)])) AS purchase_source,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) as total_sales,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN quantity ELSE 0 END) AS total_items_sold,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END) AS profit,
-                    SUM(CASE WHEN subtotal_incl IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) ELSE 0 END) AS net_sales_without_vat
-                FROM FilteredData
-                WHERE subtotal_incl IS NOT NULL
-                GROUP BY purchase_source
-                HAVING SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) > 0
-                ORDER BY total_sales DESC
-            )
-            SELECT
-                purchase_source,
-                CAST(total_sales AS NUMERIC) as total_sales,
-                CAST(total_items_sold AS INT64) as total_items_sold,
-                CAST((total_sales / (SELECT grand_total_sales FROM GrandTotals)) * 100 AS NUMERIC) as rate_by_source,
-                CAST(SAFE_DIVIDE(profit, net_sales_without_vat) * 100 AS NUMERIC) as profit_margin
-            FROM GroupedData
-            CROSS JOIN GrandTotals;
-        """
+        # Categorized goods (no services, POS lines or marked-down goods) per purchase source
+        source_rows = [row for row in get_kpi_cube()['source'] if row['is_source_sale'] is True]
+        grand_source_sales = sum(measure(row, 'total_sales') for row in source_rows)
+        total_profit = sum(measure(row, 'profit') for row in source_rows)
+        total_net_sales = sum(measure(row, 'net_sales') for row in source_rows)
+        grand_profit_margin = (total_profit / total_net_sales * 100) if total_net_sales > 0 else 0
         
-        results = run_query(sales_query)
+        rows = [row for row in source_rows if measure(row, 'total_sales') > 0]
+        rows.sort(key=lambda row: row['total_sales'], reverse=True)
         
-        sales_data, grand_total_sales, grand_total_items, grand_total_profit, grand_net_sales = [], 0, 0, 0, 0
-        rows = list(results)
+        sales_data, grand_total_sales, grand_total_items = [], 0, 0
         
-        # Calculate totals including profit and net sales for margin calculation
+        # Calculate totals of the listed sources
         for row in rows:
-            grand_total_sales += (row.total_sales or 0)
-            grand_total_items += (row.total_items_sold or 0)
-        
-        # Calculate grand profit margin by running a separate query
-        profit_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            )
-            SELECT
-                SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) AS total_profit,
-                SUM(ROUND((subtotal_incl / 1.15), 2)) AS total_net_sales
-            FROM FilteredData
-        """
-        profit_results = list(run_query(profit_query))
-        if profit_results:
-            total_profit = profit_results[0].total_profit or 0
-            total_net_sales = profit_results[0].total_net_sales or 0
-            grand_profit_margin = (total_profit / total_net_sales * 100) if total_net_sales > 0 else 0
-        else:
-            grand_profit_margin = 0
+            grand_total_sales += row['total_sales']
+            grand_total_items += int(round(measure(row, 'quantity')))
         
         for row in rows:
+            net_sales = measure(row, 'net_sales')
             sales_data.append({
-                "purchase_source": row.purchase_source or "غير محدد",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "rate_by_source": f"{float(row.rate_by_source or 0):.2f}%",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%"
+                "purchase_source": row['source_key'] or "غير محدد",
+                "total_sales": f"{float(row['total_sales']):,.2f}",
+                "total_items_sold": f"{int(round(measure(row, 'quantity'))):,}",
+                "rate_by_source": f"{float(row['total_sales'] / grand_source_sales * 100 if grand_source_sales else 0):.2f}%",
+                "profit_margin": f"{float(measure(row, 'profit') / net_sales * 100 if net_sales else 0):.2f}%"
             })
         
         if sales_data:
@@ -283,85 +181,37 @@ def sales_breakdown_by_source():
 def branch_sales_performance():
     """API endpoint for branch sales performance analysis."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        print(f"🔍 Branch Sales Filter: {where_sql}")  # Debug logging
+        cube = get_kpi_cube()
+        all_branches_sales = measure(total_row(cube), 'total_sales')
         
-        # Add some basic validation
-        if not PROJECT_ID or not DATASET_ID or not TABLE_ID:
-            return jsonify({"status": "error", "message": "Database configuration missing"}), 500
+        # The cube rows are shared with the other widgets (and the cache), so they're copied before relabelling
+        rows = [dict(row, branch=row['branch'] or 'غير محدد') for row in cube['branch'] if measure(row, 'total_sales') > 0]
+        rows.sort(key=lambda row: (-row['total_sales'], row['branch']))
         
-        branch_sales_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` 
-                {where_sql}
-            ),
-            GrandTotals AS (
-                SELECT 
-                    CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 0) AS NUMERIC) as grand_total_sales,
-                    CAST(COALESCE(COUNT(CASE WHEN subtotal_incl IS NOT NULL THEN 1 ELSE NULL END), 0) AS INT64) as total_records
-                FROM FilteredData
-            ),
-            BranchData AS (
-                SELECT
-                    COALESCE(branch, 'غير محدد') as branch,
-                    CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 0) AS NUMERIC) as total_sales,
-                    CAST(COALESCE(SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, quantity, 0)), 0) AS INT64) AS total_items_sold,
-                    CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END), 0) AS INT64) AS invoice_count,
-                    CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN phone_number ELSE NULL END), 0) AS INT64) AS customer_count
-                FROM FilteredData
-                GROUP BY COALESCE(branch, 'غير محدد')
-                HAVING SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) > 0
-            )
-            SELECT
-                bd.branch,
-                bd.total_sales,
-                bd.total_items_sold,
-                bd.invoice_count,
-                bd.customer_count,
-                CAST(CASE 
-                    WHEN gt.grand_total_sales > 0 THEN (bd.total_sales / gt.grand_total_sales) * 100 
-                    ELSE 0 
-                END AS NUMERIC) as sales_percentage,
-                CAST(CASE 
-                    WHEN bd.invoice_count > 0 THEN bd.total_sales / bd.invoice_count 
-                    ELSE 0 
-                END AS NUMERIC) as avg_invoice_value
-            FROM BranchData bd
-            CROSS JOIN GrandTotals gt
-            WHERE gt.total_records > 0
-            ORDER BY bd.total_sales DESC, bd.branch ASC;
-        """
-        
-        results = run_query(branch_sales_query)
-        
-        if not results:
+        if not rows:
             return jsonify({"status": "success", "data": []})
         
         branch_data = []
         grand_total_sales, grand_total_items, grand_total_invoices, grand_total_customers = 0, 0, 0, 0
-        rows = list(results)
         
         # Calculate totals first
         for row in rows:
-            grand_total_sales += float(row.total_sales or 0)
-            grand_total_items += int(row.total_items_sold or 0)
-            grand_total_invoices += int(row.invoice_count or 0)
-            grand_total_customers += int(row.customer_count or 0)
+            grand_total_sales += float(row['total_sales'])
+            grand_total_items += int(round(measure(row, 'merchandise_quantity')))
+            grand_total_invoices += int(measure(row, 'invoice_count'))
+            grand_total_customers += int(measure(row, 'customer_count'))
         
         # Format data for display
         for row in rows:
+            invoice_count = int(measure(row, 'invoice_count'))
             branch_data.append({
-                "branch": row.branch or "غير محدد",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "invoice_count": f"{int(row.invoice_count or 0):,}",
-                "customer_count": f"{int(row.customer_count or 0):,}",
-                "sales_percentage": f"{float(row.sales_percentage or 0):.2f}%",
-                "avg_invoice_value": f"{float(row.avg_invoice_value or 0):,.2f}"
+                "branch": row['branch'],
+                "total_sales": f"{float(row['total_sales']):,.2f}",
+                "total_items_sold": f"{int(round(measure(row, 'merchandise_quantity'))):,}",
+                "invoice_count": f"{invoice_count:,}",
+                "customer_count": f"{int(measure(row, 'customer_count')):,}",
+                "sales_percentage": f"{float(row['total_sales'] / all_branches_sales * 100 if all_branches_sales > 0 else 0):.2f}%",
+                "avg_invoice_value": f"{float(row['total_sales'] / invoice_count if invoice_count > 0 else 0):,.2f}"
             })
         
         # Add totals row
@@ -389,7 +239,8 @@ def branch_sales_performance():
 def debug_totals():
     """Debug endpoint to verify data consistency between KPI cards and branch table."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -419,15 +270,36 @@ def debug_totals():
             FROM FilteredData;
         """
         
-        results = run_query(debug_query)
+        results = run_query(debug_query, filters.params)
         debug_data = dict(list(results)[0]) if results.total_rows > 0 else {}
         
         return jsonify({
             "status": "success", 
             "filter_used": where_sql,
+            "filter_params": {name: str(value) for name, value in filters.params.items()},
             "debug_data": debug_data
         })
 
     except Exception as e:
         print(f"❌ Error in debug endpoint: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
+
+@kpi_bp.route("/query-estimate")
+def query_estimate():
+    """Dry-run estimate of the bytes an endpoint would scan (?endpoint=/api/...&<same filters>)."""
+    try:
+        endpoint = request.args.get('endpoint', '')
+        if not endpoint.startswith(('/api/', '/debug/')) or endpoint == request.path:
+            return jsonify({"status": "error", "message": "Invalid endpoint"}), 400
+        
+        query_string = urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'endpoint'])
+        estimate = estimate_view(current_app._get_current_object(), endpoint, query_string)
+        return jsonify({"status": "success", "data": estimate})
+
+    except HTTPException:
+        return jsonify({"status": "error", "message": "Unknown endpoint"}), 404
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error in /api/query-estimate: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
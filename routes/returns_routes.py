@@ -4,8 +4,9 @@
 from flask import Blueprint, jsonify
 from decimal import Decimal
 from collections import OrderedDict
-from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from database import run_query
+from rollup import get_fact_source
+from dimensions import get_branches
 
 returns_bp = Blueprint('returns', __name__)
 
@@ -13,30 +14,26 @@ returns_bp = Blueprint('returns', __name__)
 def categories_with_highest_returns():
     """API endpoint for categories with highest return rates."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} quantity < 0
-            AND branch != 'المتجر الإلكتروني'
-            AND SPLIT(product_category, ' / ')[SAFE_OFFSET(1)] NOT LIKE '%خدمات%'
-        """
+        facts = get_fact_source()
 
         query = f"""
+            WITH Facts AS (
+                {facts.sql}
+            )
             SELECT
-                SPLIT(product_category, ' / ')[SAFE_OFFSET(0)] AS category_name,
-                SUM(ABS(IF(quantity < 0, quantity, 0))) as returned_quantity,
-                SUM(ABS(IF(quantity < 0, subtotal_incl, 0))) as returned_value
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            {where_sql}
+                main_category AS category_name,
+                SUM(returned_quantity) as returned_quantity,
+                SUM(returned_value) as returned_value
+            FROM Facts
+            WHERE returned_quantity > 0
+                AND branch != 'المتجر الإلكتروني'
+                AND purchase_source NOT LIKE '%خدمات%'
             GROUP BY category_name
-            HAVING returned_value > 0
+            HAVING SUM(returned_value) > 0
             ORDER BY returned_value DESC
             LIMIT 5;
         """
-        results = run_query(query)
+        results = run_query(query, facts.params)
         data = []
         total_qty = 0
         total_val = 0
@@ -65,32 +62,28 @@ def categories_with_highest_returns():
 def employees_with_highest_returns():
     """API endpoint for employees with highest return rates."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f""" {and_clause} quantity < 0
-            AND employee_name IS NOT NULL
-            AND branch != 'المتجر الإلكتروني'
-            AND SPLIT(product_category, ' / ')[SAFE_OFFSET(1)] NOT LIKE '%خدمات%'
-        """
+        facts = get_fact_source()
 
         query = f"""
+            WITH Facts AS (
+                {facts.sql}
+            )
             SELECT
                 branch,
                 employee_name,
-                SUM(ABS(IF(quantity < 0, quantity, 0))) as returned_quantity,
-                SUM(ABS(IF(quantity < 0, subtotal_incl, 0))) as returned_value
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            {where_sql}
+                SUM(returned_quantity) as returned_quantity,
+                SUM(returned_value) as returned_value
+            FROM Facts
+            WHERE returned_quantity > 0
+                AND employee_name IS NOT NULL
+                AND branch != 'المتجر الإلكتروني'
+                AND purchase_source NOT LIKE '%خدمات%'
             GROUP BY branch, employee_name
-            HAVING returned_value > 0
+            HAVING SUM(returned_value) > 0
             ORDER BY returned_value DESC
             LIMIT 5;
         """
-        results = run_query(query)
+        results = run_query(query, facts.params)
         data = []
         total_qty = 0
         total_val = 0
@@ -121,19 +114,8 @@ def employees_with_highest_returns():
 def available_branches():
     """Get all available branches for filtering."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        query = f"""
-            SELECT DISTINCT branch
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            WHERE branch IS NOT NULL
-            ORDER BY branch;
-        """
-        results = run_query(query)
-        branches = [row.branch for row in results]
-        return jsonify({"status": "success", "data": branches})
+        # Served from the in-memory dimensions (no BigQuery job)
+        return jsonify({"status": "success", "data": get_branches()})
     except Exception as e:
         print(f"❌ Error in /api/branch-list: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
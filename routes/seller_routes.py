@@ -5,81 +5,50 @@ from flask import Blueprint, jsonify
 from decimal import Decimal
 from collections import OrderedDict
 from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from utils import get_user_filters
+from kpi_engine import ONLINE_BRANCH, get_kpi_cube, measure
+from category_rules import line_column
 
 seller_bp = Blueprint('seller', __name__)
 
+def _store_sellers():
+    """Seller rows of the physical branches (the online store left out), with their branch's total sales."""
+    cube = get_kpi_cube()
+    branch_sales = {row['branch']: measure(row, 'total_sales') for row in cube['branch']}
+    return [dict(row, branch_sales=branch_sales[row['branch']]) for row in cube['seller']
+            if row['branch'] not in (None, ONLINE_BRANCH) and row['employee_name'] is not None]
+
+def _format_seller(row):
+    total_sales = measure(row, 'total_sales')
+    invoice_count = measure(row, 'invoice_count')
+    net_sales = measure(row, 'net_sales')
+    return {
+        "employee_name": row['employee_name'],
+        "branch": row['branch'],
+        "total_sales": f"{float(total_sales):,.2f}",
+        "sales_percentage_in_branch": f"{float(total_sales / row['branch_sales'] * 100 if row['branch_sales'] else 0):.2f}%",
+        "total_items_sold": f"{int(round(measure(row, 'merchandise_quantity'))):,}",
+        "invoice_count": f"{int(invoice_count):,}",
+        "avg_invoice_value": f"{float(total_sales / invoice_count if invoice_count else 0):,.2f}",
+        "profit": f"{float(measure(row, 'profit')):,.2f}",
+        "profit_margin": f"{float(measure(row, 'profit') / net_sales * 100 if net_sales else 0):.2f}%",
+        "work_days": f"{int(measure(row, 'work_days')):,}",
+    }
+
 @seller_bp.route("/top-sellers")
 def top_performing_sellers():
     """API endpoint for top performing sellers by branch."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
+        sellers = _store_sellers()
         
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f" {and_clause} branch != 'المتجر الإلكتروني'"
-
-        top_sellers_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            ),
-            BranchTotals AS (
-                SELECT
-                    branch,
-                    SUM(subtotal_incl) as total_branch_sales
-                FROM FilteredData
-                GROUP BY branch
-            ),
-            SellerMetrics AS (
-                SELECT
-                    branch,
-                    employee_name,
-                    SUM(subtotal_incl) as total_sales,
-                    SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%'), quantity, 0)) as total_items_sold,
-                    COUNT(DISTINCT receipt_number) as invoice_count,
-                    SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) AS profit,
-                    SUM(ROUND((subtotal_incl / 1.15), 2)) AS net_sales_without_vat,
-                    COUNT(DISTINCT DATE(order_date)) as work_days,
-                    RANK() OVER (PARTITION BY branch ORDER BY SUM(subtotal_incl) DESC) as seller_rank
-                FROM FilteredData
-                WHERE employee_name IS NOT NULL
-                GROUP BY branch, employee_name
-            )
-            SELECT
-                s.branch,
-                s.employee_name,
-                s.total_sales,
-                s.total_items_sold,
-                s.invoice_count,
-                s.profit,
-                s.work_days,
-                SAFE_DIVIDE(s.total_sales, s.invoice_count) as avg_invoice_value,
-                SAFE_DIVIDE(s.profit, s.net_sales_without_vat) * 100 as profit_margin,
-                SAFE_DIVIDE(s.total_sales, bt.total_branch_sales) * 100 as sales_percentage_in_branch
-            FROM SellerMetrics s
-            JOIN BranchTotals bt ON s.branch = bt.branch
-            WHERE s.seller_rank = 1
-            ORDER BY s.total_sales DESC;
-        """
-        results = run_query(top_sellers_query)
+        # Best seller of each branch (all of them on a tie)
+        best_sales = {}
+        for row in sellers:
+            best_sales[row['branch']] = max(best_sales.get(row['branch'], measure(row, 'total_sales')), measure(row, 'total_sales'))
+        rows = [row for row in sellers if measure(row, 'total_sales') == best_sales[row['branch']]]
+        rows.sort(key=lambda row: measure(row, 'total_sales'), reverse=True)
         
-        sellers_data = []
-        for row in results:
-            sellers_data.append({
-                "employee_name": row.employee_name or "غير محدد",
-                "branch": row.branch or "غير محدد",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-                "sales_percentage_in_branch": f"{float(row.sales_percentage_in_branch or 0):.2f}%",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "invoice_count": f"{int(row.invoice_count or 0):,}",
-                "avg_invoice_value": f"{float(row.avg_invoice_value or 0):,.2f}",
-                "profit": f"{float(row.profit or 0):,.2f}",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%",
-                "work_days": f"{int(row.work_days or 0):,}",
-            })
-            
+        sellers_data = [_format_seller(row) for row in rows]
         return jsonify({"status": "success", "data": sellers_data})
 
     except Exception as e:
@@ -90,72 +59,9 @@ def top_performing_sellers():
 def top_10_sales_performers():
     """API endpoint for top 10 sales performers overall."""
     try:
-        where_sql = get_user_filters_string()
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f" {and_clause} branch != 'المتجر الإلكتروني'"
-
-        top_10_sellers_query = f"""
-            WITH FilteredData AS (
-                SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` {where_sql}
-            ),
-            BranchTotals AS (
-                SELECT
-                    branch,
-                    SUM(subtotal_incl) as total_branch_sales
-                FROM FilteredData
-                GROUP BY branch
-            ),
-            SellerMetrics AS (
-                SELECT
-                    branch,
-                    employee_name,
-                    SUM(subtotal_incl) as total_sales,
-                    SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%'), quantity, 0)) as total_items_sold,
-                    COUNT(DISTINCT receipt_number) as invoice_count,
-                    SUM(ROUND((subtotal_incl / 1.15), 2) - total_cost) AS profit,
-                    SUM(ROUND((subtotal_incl / 1.15), 2)) AS net_sales_without_vat,
-                    COUNT(DISTINCT DATE(order_date)) as work_days
-                FROM FilteredData
-                WHERE employee_name IS NOT NULL
-                GROUP BY branch, employee_name
-            )
-            SELECT
-                s.branch,
-                s.employee_name,
-                s.total_sales,
-                s.total_items_sold,
-                s.invoice_count,
-                s.profit,
-                s.work_days,
-                SAFE_DIVIDE(s.total_sales, s.invoice_count) as avg_invoice_value,
-                SAFE_DIVIDE(s.profit, s.net_sales_without_vat) * 100 as profit_margin,
-                SAFE_DIVIDE(s.total_sales, bt.total_branch_sales) * 100 as sales_percentage_in_branch
-            FROM SellerMetrics s
-            JOIN BranchTotals bt ON s.branch = bt.branch
-            ORDER BY s.total_sales DESC
-            LIMIT 10;
-        """
-        results = run_query(top_10_sellers_query)
+        rows = sorted(_store_sellers(), key=lambda row: measure(row, 'total_sales'), reverse=True)[:10]
         
-        sellers_data = []
-        for row in results:
-            sellers_data.append({
-                "employee_name": row.employee_name or "غير محدد",
-                "branch": row.branch or "غير محدد",
-                "total_sales": f"{float(row.total_sales or 0):,.2f}",
-                "sales_percentage_in_branch": f"{float(row.sales_percentage_in_branch or 0):.2f}%",
-                "total_items_sold": f"{int(row.total_items_sold or 0):,}",
-                "invoice_count": f"{int(row.invoice_count or 0):,}",
-                "avg_invoice_value": f"{float(row.avg_invoice_value or 0):,.2f}",
-                "profit": f"{float(row.profit or 0):,.2f}",
-                "profit_margin": f"{float(row.profit_margin or 0):.2f}%",
-                "work_days": f"{int(row.work_days or 0):,}",
-            })
-            
+        sellers_data = [_format_seller(row) for row in rows]
         return jsonify({"status": "success", "data": sellers_data})
 
     except Exception as e:
@@ -166,13 +72,13 @@ def top_10_sales_performers():
 def top_products_by_sales_value():
     """API endpoint for best selling products by sales value."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
         
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f" {and_clause} NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')"
+        filters.add(f"NOT {line_column('is_service')}")
+        where_sql = filters.where_sql
 
         query = f"""
             SELECT
@@ -186,7 +92,7 @@ def top_products_by_sales_value():
             ORDER BY total_sales DESC
             LIMIT 10;
         """
-        results = run_query(query)
+        results = run_query(query, filters.params)
         data = [
             {
                 "product_barcode": row.product_barcode,
@@ -204,13 +110,13 @@ def top_products_by_sales_value():
 def top_products_by_quantity_sold():
     """API endpoint for best selling products by quantity."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
         
-        and_clause = "AND " if where_sql else "WHERE "
-        where_sql += f" {and_clause} NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')"
+        filters.add(f"NOT {line_column('is_service')}")
+        where_sql = filters.where_sql
 
         query = f"""
             SELECT
@@ -224,7 +130,7 @@ def top_products_by_quantity_sold():
             ORDER BY total_quantity DESC
             LIMIT 10;
         """
-        results = run_query(query)
+        results = run_query(query, filters.params)
         data = [
             {
                 "product_barcode": row.product_barcode,
@@ -242,7 +148,8 @@ def top_products_by_quantity_sold():
 def top_products_by_profit_margin():
     """API endpoint for most profitable products."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -261,7 +168,7 @@ def top_products_by_profit_margin():
                 total_profit DESC
             LIMIT 10;
         """
-        results = run_query(query)
+        results = run_query(query, filters.params)
         data = [
             {
                 "product_barcode": row.product_barcode,
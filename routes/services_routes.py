@@ -4,7 +4,9 @@
 from flask import Blueprint, jsonify, render_template
 from decimal import Decimal
 from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from utils import get_user_filters
+from category_rules import is_deposit_sql, line_column, non_merchandise_sql
+from dimensions import get_service_branches
 
 services_bp = Blueprint('services', __name__)
 
@@ -17,29 +19,10 @@ def services_page():
 def get_services_branches():
     """API endpoint to get available branches from services data."""
     try:
-        PROJECT_ID = get_project_id()
-        DATASET_ID = get_dataset_id()
-        TABLE_ID = get_table_id()
-        
-        branches_query = f"""
-            SELECT DISTINCT branch
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            WHERE (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%')
-                AND product_name NOT LIKE '%عربون طلب بضاعة%'
-                AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%'
-                AND product_name NOT LIKE '%عربون%'
-                AND product_name NOT LIKE '%دفع مسبق%'
-                AND branch IS NOT NULL
-                AND branch != ''
-            ORDER BY branch
-        """
-        
-        result = run_query(branches_query)
-        branches = [row.branch for row in result if row.branch]
-        
+        # Served from the in-memory dimensions (no BigQuery job)
         return jsonify({
             'status': 'success',
-            'branches': branches
+            'branches': get_service_branches()
         })
         
     except Exception as e:
@@ -54,7 +37,8 @@ def services_data():
         from flask import request
         print(f"🔍 Services Data - Request args: {dict(request.args)}")
         
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -76,11 +60,8 @@ def services_data():
                     SUM(CASE WHEN quantity > 0 THEN subtotal_incl ELSE 0 END) as total_amount,
                     COUNT(DISTINCT receipt_number) as receipt_count
                 FROM FilteredData
-                WHERE (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%')
-                    AND product_name NOT LIKE '%عربون طلب بضاعة%'
-                    AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%'
-                    AND product_name NOT LIKE '%عربون%'
-                    AND product_name NOT LIKE '%دفع مسبق%'
+                WHERE {non_merchandise_sql(is_service=line_column('is_service'))}
+                    AND NOT {is_deposit_sql()}
                     AND subtotal_incl IS NOT NULL
                     AND quantity > 0
                 GROUP BY product_name, product_category, branch
@@ -96,7 +77,7 @@ def services_data():
             ORDER BY total_amount DESC
         """
         
-        services_result = run_query(services_query)
+        services_result = run_query(services_query, filters.params)
         
         # تحويل النتائج إلى قائمة
         services_list = []
@@ -142,7 +123,8 @@ def services_returns():
         from flask import request
         print(f"🔍 Services Returns - Request args: {dict(request.args)}")
         
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
@@ -164,11 +146,8 @@ def services_returns():
                     SUM(CASE WHEN quantity < 0 THEN ABS(subtotal_incl) ELSE 0 END) as returned_amount,
                     COUNT(DISTINCT CASE WHEN quantity < 0 THEN receipt_number END) as return_receipts
                 FROM FilteredData
-                WHERE (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%')
-                    AND product_name NOT LIKE '%عربون طلب بضاعة%'
-                    AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%'
-                    AND product_name NOT LIKE '%عربون%'
-                    AND product_name NOT LIKE '%دفع مسبق%'
+                WHERE {non_merchandise_sql(is_service=line_column('is_service'))}
+                    AND NOT {is_deposit_sql()}
                     AND subtotal_incl IS NOT NULL
                     AND quantity < 0
                 GROUP BY product_name, product_category, branch
@@ -185,7 +164,7 @@ def services_returns():
             ORDER BY returned_amount DESC
         """
         
-        returns_result = run_query(returns_query)
+        returns_result = run_query(returns_query, filters.params)
         
         # تحويل النتائج إلى قائمة
         returns_list = []
@@ -4,7 +4,9 @@
 from flask import Blueprint, jsonify
 from decimal import Decimal
 from database import run_query, get_project_id, get_dataset_id, get_table_id
-from utils import get_user_filters_string
+from utils import get_user_filters
+from category_rules import line_column, non_merchandise_sql
+from product_facts_source import product_facts_relation
 
 stock_bp = Blueprint('stock', __name__)
 
@@ -12,12 +14,17 @@ stock_bp = Blueprint('stock', __name__)
 def stock_products():
     """API endpoint for top 20 products with stock information."""
     try:
-        where_sql = get_user_filters_string()
+        filters = get_user_filters()
+        filters.add(f"""quantity > 0 
+                    AND NOT {non_merchandise_sql(is_service=line_column('is_service'))}
+                    AND product_barcode IS NOT NULL
+                    AND product_barcode != ''""")
+        where_sql = filters.where_sql
         PROJECT_ID = get_project_id()
         DATASET_ID = get_dataset_id()
         TABLE_ID = get_table_id()
         
-        # Query to get top 20 products by sales with their stock information
+        # Query to get top 20 products by sales, with their stock from the product facts (one row per barcode)
         stock_query = f"""
             WITH SalesData AS (
                 SELECT 
@@ -28,27 +35,22 @@ def stock_products():
                     SUM(ROUND((subtotal_incl / 1.15), 2) - (total_cost)) as total_profit
                 FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` 
                 {where_sql}
-                    {"AND" if where_sql else "WHERE"} quantity > 0 
-                    AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%')
-                    AND product_barcode IS NOT NULL
-                    AND product_barcode != ''
                 GROUP BY product_barcode, product_name
                 ORDER BY total_sales DESC
                 LIMIT 20
             ),
             StockData AS (
                 SELECT 
-                    Barcode as barcode,
-                    MAX(Product_Name) as product_name,
-                    MAX(Category) as category,
-                    SUM(Qty_On_Hand) as qty_on_hand,
-                    SUM(Reserved_Qty) as reserved_qty,
-                    SUM(Available_Qty) as available_qty,
-                    AVG(Unit_Cost) as unit_cost,
-                    SUM(Total_Cost) as total_cost
-                FROM `{PROJECT_ID}.{DATASET_ID}.stock_data`
-                WHERE Barcode IS NOT NULL
-                GROUP BY Barcode
+                    barcode,
+                    product_name,
+                    category,
+                    qty_on_hand,
+                    reserved_qty,
+                    available_qty,
+                    unit_cost,
+                    total_cost
+                FROM {product_facts_relation()}
+                WHERE barcode IN (SELECT product_barcode FROM SalesData)
             )
             SELECT 
                 s.product_barcode,
@@ -81,7 +83,7 @@ def stock_products():
             ORDER BY s.total_sales DESC;
         """
         
-        results = run_query(stock_query)
+        results = run_query(stock_query, filters.params)
         
         products_data = []
         for row in results:
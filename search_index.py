@@ -0,0 +1,106 @@
+# search_index.py
+# In-memory barcode and product-name index of the stock replica, for the product search
+
+import re
+from bisect import bisect_left
+
+# Arabic spellings that staff type interchangeably (hamza forms, taa marbuta, alef maqsura)
+_ARABIC_LETTERS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ة': 'ه', 'ى': 'ي'})
+# Diacritics (tashkeel) and tatweel carry no meaning for a search
+_IGNORED_CHARACTERS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u0640]')
+_SEPARATORS = re.compile(r'[\s/\-_.,()]+')
+
+GRAM_SIZE = 3
+
+def normalize(text):
+    """Lower-cased text with Arabic letter variants unified and diacritics removed."""
+    text = _IGNORED_CHARACTERS.sub('', (text or '').lower().translate(_ARABIC_LETTERS))
+    return ' '.join(text.split())
+
+def _grams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+class SearchIndex:
+    """
+    Lookup structures over a list of StockItem tuples.
+
+    Exact barcodes are a dict lookup. For partial matches each word of the
+    query is looked up in a trigram index of the normalized names and
+    barcodes (words of 3+ characters) or in a sorted list of their words
+    (shorter ones, matched as word prefixes); items must match every word.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self._by_barcode = {}
+        self._texts = []
+        self._grams = {}
+        words = set()
+        for position, item in enumerate(items):
+            if item.barcode:
+                self._by_barcode.setdefault(item.barcode.strip(), position)
+            name = normalize(item.product_name)
+            barcode = normalize(item.barcode)
+            self._texts.append((name, barcode))
+            for gram in _grams(name) | _grams(barcode):
+                self._grams.setdefault(gram, set()).add(position)
+            for word in _SEPARATORS.split(name) + [barcode]:
+                if word:
+                    words.add((word, position))
+        self._words = sorted(words)
+
+    def exact(self, barcode):
+        """The item with this barcode, or None."""
+        position = self._by_barcode.get(barcode.strip())
+        return self.items[position] if position is not None else None
+
+    def _word_candidates(self, word):
+        if len(word) >= GRAM_SIZE:
+            postings = sorted((self._grams.get(gram, set()) for gram in _grams(word)), key=len)
+            return set.intersection(*postings)
+        candidates = set()
+        start = bisect_left(self._words, (word,))
+        for indexed_word, position in self._words[start:]:
+            if not indexed_word.startswith(word):
+                break
+            candidates.add(position)
+        return candidates
+
+    def _candidates(self, words):
+        candidates = None
+        for word in sorted(words, key=len, reverse=True):
+            matches = self._word_candidates(word)
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                break
+        return candidates
+
+    def _rank(self, query, words, position):
+        name, barcode = self._texts[position]
+        if barcode.startswith(query):
+            rank = 0
+        elif name.startswith(query):
+            rank = 1
+        elif any(word.startswith(query) for word in _SEPARATORS.split(name)):
+            rank = 2
+        elif query in name or query in barcode:
+            rank = 3
+        elif all(word in name or word in barcode for word in words):
+            rank = 4  # Every word of the query, in any order
+        else:
+            return None
+        return rank, len(name), name
+
+    def search(self, query, limit=10):
+        """Items whose barcode or name contains every word of `query`, best matches first."""
+        query = normalize(query)
+        if not query:
+            return []
+        words = query.split()
+        ranked = []
+        for position in self._candidates(words):
+            rank = self._rank(query, words, position)
+            if rank is not None:
+                ranked.append((rank, position))
+        ranked.sort()
+        return [self.items[position] for _, position in ranked[:limit]]
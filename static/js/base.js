@@ -0,0 +1,46 @@
+// base.js
+// Shared helpers loaded on every page (see templates/base.html)
+
+// --- Streaming fetch for NDJSON endpoints (e.g. /inventory/api/inventory/history?format=ndjson) ---
+// Calls handlers.onMeta(meta) once, handlers.onRows(rows) for every batch as it
+// arrives, then resolves with the total number of records. Rows are rendered
+// progressively instead of waiting for (and holding) the whole response.
+// handlers.onMessage(message) sees every line, for streams of other message types.
+async function fetchNDJSON(url, handlers = {}) {
+    const { onMeta = () => {}, onRows = () => {}, onMessage = () => {} } = handlers;
+    const response = await fetch(url, { headers: { 'Accept': 'application/x-ndjson' } });
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let total = 0;
+
+    const handleLine = (line) => {
+        if (!line.trim()) return;
+        const message = JSON.parse(line);
+        onMessage(message);
+        if (message.type === 'meta') {
+            onMeta(message);
+        } else if (message.type === 'rows') {
+            onRows(message.data);
+        } else if (message.type === 'end') {
+            total = message.total_records;
+        } else if (message.type === 'error') {
+            throw new Error(message.message);
+        }
+    };
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(handleLine);
+    }
+    handleLine(buffer + decoder.decode());
+    return total;
+}
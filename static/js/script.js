@@ -129,6 +129,9 @@ function getApiParams() {
     const endDate = document.getElementById('end-date')?.value || '';
     const branch = document.getElementById('branch-select')?.value || '';
     const monthPicker = document.getElementById('month-picker')?.value || '';
+    const employee = document.getElementById('employee-filter')?.value.trim() || '';
+    const category = document.getElementById('category-filter')?.value.trim() || '';
+    const product = document.getElementById('product-filter')?.value.trim() || '';
 
     let params = new URLSearchParams();
 
@@ -173,6 +176,17 @@ function getApiParams() {
         params.append('branch', branch);
     }
 
+    // Employee, category and product filters (category and product match exactly when picked from the suggestions)
+    if (employee) params.append('employee', employee);
+    if (category) {
+        params.append('category', category);
+        if (document.getElementById('category-filter').dataset.exact) params.append('category_exact', '1');
+    }
+    if (product) {
+        params.append('product', product);
+        if (document.getElementById('product-filter').dataset.exact) params.append('product_exact', '1');
+    }
+
     return '?' + params.toString();
 }
 
@@ -184,6 +198,7 @@ function clearAllFilters() {
     document.getElementById('start-date').value = '';
     document.getElementById('end-date').value = '';
     document.getElementById('month-picker').value = '';
+    document.querySelectorAll('.suggest-filter').forEach(input => { input.value = ''; input.dataset.exact = ''; });
     // Don't clear branch filter as it's independent
 }
 
@@ -221,6 +236,9 @@ function updateAllDashboardData(queryString = '') {
         document.getElementById('manual-fetch-btn').classList.add('active');
     }
 
+    // One request for every widget; each fetch function below picks its part up as it arrives
+    loadDashboardBundle(queryString);
+
     // Call all individual fetch functions
     fetchKPIs(queryString);
     fetchServicesDetails(queryString);
@@ -243,6 +261,59 @@ function updateAllDashboardData(queryString = '') {
     fetchStockProducts(queryString);
 }
 
+// --- Dashboard bundle: all widgets of one filter from /api/dashboard-bundle ---
+// Endpoints answered by the bundle (DASHBOARD_WIDGETS in routes/dashboard_routes.py)
+const BUNDLED_ENDPOINTS = [
+    '/api/data', '/api/services-details', '/api/sales-details', '/api/branch-sales', '/api/branch-profits',
+    '/api/top-categories', '/api/top-categories-by-profit', '/api/top-sellers', '/api/top-10-sellers',
+    '/api/top_products_by_sales_value', '/api/top_products_by_quantity', '/api/top_products_by_profit',
+    '/api/top_categories_by_returns', '/api/top_sellers_by_returns', '/api/top-10-categories', '/api/stock-products'
+];
+let dashboardBundle = null;
+
+// Filters a query string resolves to on the server: the first value of each key (request.args.get), in key order
+function effectiveParams(queryString) {
+    const params = new URLSearchParams();
+    new URLSearchParams(queryString.replace('?', '')).forEach((value, key) => {
+        if (!params.has(key)) params.append(key, value);
+    });
+    params.sort();
+    return params.toString();
+}
+
+function loadDashboardBundle(queryString) {
+    const params = effectiveParams(queryString);
+    const bundle = { params, parts: {} };
+    BUNDLED_ENDPOINTS.forEach(endpoint => {
+        const part = bundle.parts[endpoint] = {};
+        part.promise = new Promise((resolve, reject) => { part.resolve = resolve; part.reject = reject; });
+        part.promise.catch(() => {});  // Parts no widget asked for
+    });
+    const parts = { ...bundle.parts };
+    dashboardBundle = bundle;
+
+    // Parts are NDJSON lines sent as soon as each widget is ready
+    fetchNDJSON(`/api/dashboard-bundle?${params}${params ? '&' : ''}format=ndjson`, {
+        onMessage: message => {
+            if (message.type === 'widget' && parts[message.endpoint]) {
+                parts[message.endpoint].resolve(message.document);
+            }
+        }
+    }).catch(err => console.error('Error fetching the dashboard bundle:', err)).finally(() => {
+        // Widgets the bundle didn't deliver fall back to their own request
+        Object.values(parts).forEach(part => part.reject());
+    });
+}
+
+// JSON of a widget endpoint: its part of the current bundle when the bundle ran with the same filters, its own request otherwise
+function fetchWidgetJSON(url) {
+    const [endpoint, query = ''] = url.split('?');
+    const part = dashboardBundle?.parts[endpoint];
+    if (!part || effectiveParams(query) !== dashboardBundle.params) return fetch(url).then(res => res.json());
+    delete dashboardBundle.parts[endpoint];  // Later calls (e.g. a single widget refresh) make their own request
+    return part.promise.catch(() => fetch(url).then(res => res.json()));
+}
+
 // --- Generic Table Fetching Function ---
 function fetchAndRenderTable(endpoint, containerId, title, columns, rowGenerator) {
     const tableContent = document.getElementById(containerId);
@@ -251,7 +322,7 @@ function fetchAndRenderTable(endpoint, containerId, title, columns, rowGenerator
     // Add query parameters to endpoint if it doesn't already have them
     const finalEndpoint = endpoint + (endpoint.includes('?') ? '&' : '?') + getApiParams().substring(1);
     
-    fetch(finalEndpoint).then(res => res.json()).then(data => {
+    fetchWidgetJSON(finalEndpoint).then(data => {
         if (data.status === 'success' && data.data.length > 0) {
             let html = `<h2>${title}</h2><table class="details-table"><thead><tr>`;
             columns.forEach(col => html += `<th>${col}</th>`);
@@ -260,6 +331,8 @@ function fetchAndRenderTable(endpoint, containerId, title, columns, rowGenerator
                 html += rowGenerator(row);
             });
             tableContent.innerHTML = html + `</tbody></table>`;
+        } else if (data.error === 'query_too_large') {
+            tableContent.innerHTML = `<h2>${title}</h2><div class="message-box error">${data.message}</div>`;
         } else {
             tableContent.innerHTML = '';
         }
@@ -269,6 +342,21 @@ function fetchAndRenderTable(endpoint, containerId, title, columns, rowGenerator
     });
 }
 
+// --- Warn before running a query that exceeds the endpoint's byte budget ---
+// Resolves to true (and shows a warning in the container) when the range is too heavy.
+function warnIfQueryTooLarge(endpoint, queryString, containerId, title) {
+    const params = [queryString.replace('?', ''), getApiParams().substring(1)].filter(Boolean).join('&');
+    const estimateUrl = `/api/query-estimate?endpoint=${encodeURIComponent(endpoint)}${params ? '&' + params : ''}`;
+    
+    return fetch(estimateUrl).then(res => res.json()).then(data => {
+        if (data.status === 'success' && data.data.exceeds_budget) {
+            document.getElementById(containerId).innerHTML = `<h2>${title}</h2><div class="message-box error">الفترة المحددة كبيرة جداً (${data.data.estimated})، يرجى تضييق نطاق التاريخ أو الفلاتر.</div>`;
+            return true;
+        }
+        return false;
+    }).catch(() => false);
+}
+
 // --- Individual Data Fetching Functions ---
 function fetchKPIs(queryString) {
     const kpiContent = document.getElementById('kpi-content');
@@ -290,7 +378,7 @@ function fetchKPIs(queryString) {
         "مرتجعات الخدمات"
     ];
 
-    fetch('/api/data' + queryString).then(res => res.json()).then(data => {
+    fetchWidgetJSON('/api/data' + queryString).then(data => {
         if (data.status === 'success' && Object.keys(data.data).length > 0) {
             let html = `<h2><i class="fas fa-chart-line"></i> المؤشرات الرئيسية</h2><div class="kpi-grid">`;
             const icons = {
@@ -370,7 +458,7 @@ function fetchBranchProfits(queryString) {
 function fetchTopCategories(queryString) {
     const tableContent = document.getElementById('top-categories-table-content');
     showLoader('top-categories-table-content');
-    fetch('/api/top-categories' + queryString).then(res => res.json()).then(data => {
+    fetchWidgetJSON('/api/top-categories' + queryString).then(data => {
         if (data.status === 'success' && data.data.length > 0) {
             let html = `<h2><i class="fas fa-sitemap"></i> أكثر 5 فئات مبيعاً</h2><table class="details-table">
                             <thead><tr><th>اسم الفئة</th><th>جهة الشراء</th><th>قيمة المبيعات</th><th>الكمية المباعة</th><th>النسبة داخل الفئة</th><th>الأرباح</th></tr></thead><tbody>`;
@@ -393,7 +481,7 @@ function fetchTopCategories(queryString) {
 function fetchTopCategoriesByProfit(queryString) {
     const tableContent = document.getElementById('top-categories-by-profit-table-content');
     showLoader('top-categories-by-profit-table-content');
-    fetch('/api/top-categories-by-profit' + queryString).then(res => res.json()).then(data => {
+    fetchWidgetJSON('/api/top-categories-by-profit' + queryString).then(data => {
         if (data.status === 'success' && data.data.length > 0) {
             let html = `<h2><i class="fas fa-trophy"></i> أكثر 5 فئات ربحاً</h2><table class="details-table">
                             <thead><tr><th>اسم الفئة</th><th>جهة الشراء</th><th>الأرباح</th><th>هامش الربح</th><th>الكمية المباعة</th><th>المبيعات</th></tr></thead><tbody>`;
@@ -490,7 +578,14 @@ function fetchTop10Categories(queryString) {
 }
 
 function fetchTop15Customers(queryString) {
-    fetchAndRenderTable(`/api/top-15-customers${queryString}`, 'top-15-customers-table-content', '<i class="fas fa-user-friends"></i> أهم 15 عميل مع التفاصيل الكاملة', ['اسم العميل', 'رقم الهاتف', 'الفرع', 'إجمالي المبيعات', 'الكمية', 'عدد الفواتير', 'الأرباح', 'أيام الزيارة', 'متوسط قيمة الفاتورة', 'هامش الربح'],
+    const title = '<i class="fas fa-user-friends"></i> أهم 15 عميل مع التفاصيل الكاملة';
+    warnIfQueryTooLarge('/api/top-15-customers', queryString, 'top-15-customers-table-content', title).then(tooLarge => {
+        if (!tooLarge) renderTop15Customers(queryString, title);
+    });
+}
+
+function renderTop15Customers(queryString, title) {
+    fetchAndRenderTable(`/api/top-15-customers${queryString}`, 'top-15-customers-table-content', title, ['اسم العميل', 'رقم الهاتف', 'الفرع', 'إجمالي المبيعات', 'الكمية', 'عدد الفواتير', 'الأرباح', 'أيام الزيارة', 'متوسط قيمة الفاتورة', 'هامش الربح'],
         (row) => {
             if (row.customer_name.includes('<strong>')) {
                 return `<tr class="total-row"><td>${row.customer_name}</td><td>${row.phone_number}</td><td>${row.branch}</td><td>${row.total_subtotal}</td><td>${row.total_quantity}</td><td>${row.receipt_count}</td><td>${row.total_profit}</td><td>${row.visit_days}</td><td>${row.avg_receipt_value}</td><td>${row.profit_margin}</td></tr>`;
@@ -516,6 +611,36 @@ function loadBranches() {
     }).catch(err => console.error('Error loading branches:', err));
 }
 
+// --- Filter suggestions (typeahead from /api/suggest) ---
+function setupSuggestionInput(input) {
+    const datalist = document.getElementById(input.getAttribute('list'));
+    let timer = null;
+    let lastQuery = null;
+    input.addEventListener('input', event => {
+        // Picking a datalist option fires an input without inputType (or insertReplacementText); typing doesn't
+        const picked = !event.inputType || event.inputType === 'insertReplacementText';
+        input.dataset.exact = picked && [...datalist.options].some(option => option.value === input.value) ? 'true' : '';
+        clearTimeout(timer);
+        timer = setTimeout(() => {
+            const query = input.value.trim();
+            if (query === lastQuery) return;
+            lastQuery = query;
+            fetch(`/api/suggest?field=${input.dataset.field}&q=${encodeURIComponent(query)}`)
+                .then(res => res.json())
+                .then(data => {
+                    if (data.status !== 'success' || query !== input.value.trim()) return;
+                    datalist.innerHTML = '';
+                    data.data.forEach(value => {
+                        const option = document.createElement('option');
+                        option.value = value;
+                        datalist.appendChild(option);
+                    });
+                })
+                .catch(err => console.error('Error loading suggestions:', err));
+        }, 200);
+    });
+}
+
 function populateDaySelectors(maxDay = 31) {
     const daySelector = document.getElementById('day-selector');
     const startDaySelector = document.getElementById('start-day');
@@ -750,6 +875,17 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Employee, category and product filters: suggest values while typing, update on change
+    document.querySelectorAll('.suggest-filter').forEach(input => {
+        setupSuggestionInput(input);
+        input.addEventListener('change', () => {
+            const params = getApiParams();
+            if (params !== '?') {
+                updateAllDashboardData(params);
+            }
+        });
+    });
+
     // Add clear all filters button functionality
     const clearFiltersBtn = document.createElement('button');
     clearFiltersBtn.textContent = 'مسح جميع الفلاتر';
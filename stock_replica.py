@@ -0,0 +1,181 @@
+# stock_replica.py
+# In-process replica of stock_data, which the inventory dashboard widgets are computed from
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from cache import cache_query
+from category_rules import stock_column
+from config import Config
+from data_versions import STOCK_DATA, get_version
+from database import run_query, get_project_id, get_dataset_id
+from product_facts_source import PRODUCT_FACTS_SOURCES, product_facts_relation
+from search_index import SearchIndex
+
+# stock_data is a snapshot of a few thousand SKUs replaced wholesale by
+# data-push/inventory.py. It is read once per version into memory and every
+# filter, grouping, sort and page of the dashboard is done on that copy.
+
+StockItem = namedtuple('StockItem', [
+    'product_name', 'barcode', 'category', 'qty_on_hand', 'reserved_qty', 'available_qty', 'unit_cost',
+    'main_category', 'purchase_source', 'is_service'
+])
+
+def item_value(item):
+    """Available_Qty * Unit_Cost (None when either is missing, as in SQL)."""
+    if item.available_qty is None or item.unit_cost is None:
+        return None
+    return item.available_qty * item.unit_cost
+
+def is_listed(item):
+    """Items the dashboard shows: uncategorized, or a "main / source" category that isn't a service."""
+    return item.category is None or (' / ' in item.category and not item.is_service)
+
+def is_categorized(item):
+    """Items counted in the category breakdowns (a "main / source" category that isn't a service)."""
+    return item.category is not None and ' / ' in item.category and not item.is_service
+
+class StockReplica:
+    """
+    Rows of stock_data, reloaded when the table's data version changes.
+
+    Without a known version (the metadata watcher isn't running) the copy is
+    reloaded once it is older than STOCK_REPLICA_MAX_AGE_SECONDS. A failed
+    reload keeps serving the previous copy.
+    """
+
+    def __init__(self):
+        self._items = None
+        self._version = None
+        self._loaded_at = 0
+        self._search_index = None
+        self._lock = threading.Lock()
+
+    def _is_current(self, version):
+        if self._items is None or version != self._version:
+            return False
+        return version != '0' or time.time() - self._loaded_at < Config.STOCK_REPLICA_MAX_AGE_SECONDS
+
+    def _load(self):
+        sql = f"""
+            SELECT
+                Product_Name, Barcode, Category, Qty_On_Hand, Reserved_Qty, Available_Qty, Unit_Cost,
+                {stock_column('main_category')} AS main_category,
+                {stock_column('purchase_source')} AS purchase_source,
+                {stock_column('is_service')} AS is_service
+            FROM `{get_project_id()}.{get_dataset_id()}.{STOCK_DATA}`
+        """
+        return [StockItem(*row.values()) for row in run_query(sql)]
+
+    def items(self):
+        """Current rows of stock_data as StockItem tuples."""
+        version = get_version(STOCK_DATA)
+        if self._is_current(version):
+            return self._items
+        with self._lock:
+            if not self._is_current(version):
+                start = time.perf_counter()
+                try:
+                    self._items = self._load()
+                except Exception as e:
+                    if self._items is None:
+                        raise
+                    print(f"⚠️ Could not reload the stock replica, serving the previous copy: {e}")
+                    return self._items
+                self._version = version
+                self._loaded_at = time.time()
+                print(f"✅ Stock replica loaded {len(self._items)} rows in {time.perf_counter() - start:.2f}s")
+        return self._items
+
+    def search_index(self):
+        """SearchIndex of the current rows, rebuilt whenever they are reloaded."""
+        items = self.items()
+        index = self._search_index
+        if index is None or index.items is not items:
+            with self._lock:
+                index = self._search_index
+                if index is None or index.items is not items:
+                    start = time.perf_counter()
+                    index = self._search_index = SearchIndex(items)
+                    print(f"✅ Product search index built in {time.perf_counter() - start:.2f}s")
+        return index
+
+    @property
+    def loaded_at(self):
+        return datetime.fromtimestamp(self._loaded_at, timezone.utc) if self._loaded_at else None
+
+    def status(self):
+        return {
+            'rows': len(self._items) if self._items is not None else None,
+            'version': self._version,
+            'search_index': self._search_index is not None and self._search_index.items is self._items,
+            'age_seconds': round(time.time() - self._loaded_at, 1) if self._loaded_at else None
+        }
+
+stock_replica = StockReplica()
+
+def get_stock_items():
+    return stock_replica.items()
+
+def search_products(query, limit=10):
+    return stock_replica.search_index().search(query, limit)
+
+def find_by_barcode(barcode):
+    return stock_replica.search_index().exact(barcode)
+
+def get_replica_status():
+    return stock_replica.status()
+
+@cache_query(cache_time=3600, stale_time=600, tables=PRODUCT_FACTS_SOURCES)  # Invalidated when the facts or what they are built from change
+def get_recent_sales_quantities():
+    """Units sold per barcode in the last 30 days (the sales velocity of the stock alerts)."""
+    sql = f"""
+        SELECT barcode, units_30d
+        FROM {product_facts_relation()}
+        WHERE units_30d > 0
+    """
+    return {row.barcode: float(row.units_30d) for row in run_query(sql)}
+
+# --- AGGREGATION HELPERS ---
+
+def _sum(values):
+    return sum(value for value in values if value is not None)
+
+def summarize_by(items, key):
+    """
+    Per-group totals of `items` grouped by `key` (an item -> group function),
+    highest stock value first. Groups with an empty key are left out, but
+    still count towards the percentages.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+
+    summaries = []
+    for name, members in groups.items():
+        costs = [item.unit_cost for item in members if item.unit_cost is not None]
+        summaries.append({
+            'name': name,
+            'products_count': len({item.barcode for item in members}),
+            'total_quantity': _sum(item.available_qty for item in members),
+            'total_value': _sum(item_value(item) for item in members),
+            'avg_price': sum(costs) / len(costs) if costs else None
+        })
+
+    grand_total = _sum(summary['total_value'] for summary in summaries)
+    for summary in summaries:
+        summary['percentage'] = round(summary['total_value'] / grand_total * 100, 2) if grand_total else 0
+    summaries = [summary for summary in summaries if summary['name']]
+    summaries.sort(key=lambda summary: summary['total_value'], reverse=True)
+    return summaries
+
+def descending(value):
+    """Sort key putting larger values first and missing ones last."""
+    return (value is None, -(value or 0))
+
+def paginate(rows, page, limit):
+    """(rows of the page, total rows, total pages)."""
+    offset = (page - 1) * limit
+    total_count = len(rows)
+    return rows[offset:offset + limit], total_count, (total_count + limit - 1) // limit
@@ -0,0 +1,88 @@
+# streaming.py
+# Streaming JSON / NDJSON responses for endpoints that return many rows
+
+from flask import Response, current_app, request, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def wants_ndjson():
+    """NDJSON is used for ?format=ndjson or an Accept header asking for it."""
+    return request.args.get('format') == 'ndjson' or NDJSON_MIMETYPE in request.headers.get('Accept', '')
+
+def _dumps(value):
+    return current_app.json.dumps(value, ensure_ascii=False)
+
+def _ndjson_stream(batches, meta):
+    """
+    One JSON document per line:
+        {"type": "meta", ...}            filters and other metadata
+        {"type": "rows", "data": [...]}  repeated, one line per batch of rows
+        {"type": "end", "total_records": N}  or  {"type": "error", "message": ...}
+    """
+    yield _dumps(dict(meta, type='meta')) + '\n'
+    total = 0
+    try:
+        for batch in batches:
+            total += len(batch)
+            yield _dumps({'type': 'rows', 'data': batch}) + '\n'
+    except Exception as e:
+        print(f"❌ Error while streaming {request.path}: {e}")
+        yield _dumps({'type': 'error', 'message': str(e), 'total_records': total}) + '\n'
+        return
+    yield _dumps({'type': 'end', 'total_records': total}) + '\n'
+
+def _json_array_stream(batches, meta):
+    """
+    The usual {"data": [...], "total_records": N, "status": "success", ...}
+    envelope, written incrementally. "status" comes last so a failure part way
+    through can still be reported as "error".
+    """
+    yield '{"data":['
+    total = 0
+    try:
+        for batch in batches:
+            if not batch:
+                continue
+            chunk = ','.join(_dumps(row) for row in batch)
+            yield (',' if total else '') + chunk
+            total += len(batch)
+    except Exception as e:
+        print(f"❌ Error while streaming {request.path}: {e}")
+        yield '],' + _dumps({'total_records': total, 'status': 'error', 'message': str(e)})[1:]
+        return
+    trailer = dict(meta, total_records=total, status='success')
+    yield '],' + _dumps(trailer)[1:]
+
+def _response(batches, meta):
+    meta = meta or {}
+    if wants_ndjson():
+        body, mimetype = _ndjson_stream(batches, meta), NDJSON_MIMETYPE
+    else:
+        body, mimetype = _json_array_stream(batches, meta), 'application/json'
+
+    return _streamed(body, mimetype)
+
+def _streamed(body, mimetype):
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
+
+def stream_column_batches(batches, meta=None):
+    """
+    Stream query results as they are read instead of building one big body.
+
+    `batches` are columnar batches (database.iter_query_batches()) consumed
+    lazily, so worker memory stays flat whatever the result size; each one is
+    converted with its vectorized to_pylist(), avoiding the per-row Row
+    objects of the REST iterator. Returns NDJSON when requested (see
+    wants_ndjson) and a chunked JSON envelope otherwise.
+    """
+    return _response((batch.to_pylist() for batch in batches), meta)
+
+def stream_documents(documents):
+    """
+    Stream an iterable of JSON documents as NDJSON, each line sent as soon as
+    its document is produced (for responses made of independent parts).
+    """
+    return _streamed((_dumps(document) + '\n' for document in documents), NDJSON_MIMETYPE)
@@ -0,0 +1,145 @@
+# tests/test_cache_backends.py
+# Shared cache backends against a local SQLite file and a stand-in RESP server
+
+import fnmatch
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache_backends import RedisBackend, SQLiteBackend  # noqa: E402
+
+class _RESPHandler(socketserver.StreamRequestHandler):
+    """Just the commands RedisBackend sends: GET, SET ... PX, DEL, SCAN, AUTH, SELECT."""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _bulk(self, value):
+        return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            with self.server.lock:
+                now = time.time()
+                for key in [key for key, (_, expires) in store.items() if expires is not None and expires <= now]:
+                    del store[key]
+                if command == b'GET':
+                    entry = store.get(args[1])
+                    reply = self._bulk(entry[0] if entry else None)
+                elif command == b'SET':
+                    expires = now + int(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b'PX' else None
+                    store[args[1]] = (args[2], expires)
+                    reply = b'+OK\r\n'
+                elif command == b'DEL':
+                    reply = b':%d\r\n' % sum(store.pop(key, None) is not None for key in args[1:])
+                elif command == b'SCAN':
+                    pattern = args[args.index(b'MATCH') + 1].decode('utf-8') if b'MATCH' in args else '*'
+                    keys = [key for key in store if fnmatch.fnmatchcase(key.decode('utf-8'), pattern)]
+                    reply = b'*2\r\n' + self._bulk(b'0') + b'*%d\r\n' % len(keys) + b''.join(self._bulk(key) for key in keys)
+                elif command in (b'AUTH', b'SELECT'):
+                    reply = b'+OK\r\n'
+                else:
+                    reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+class _RESPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _RESPHandler)
+        self.store = {}
+        self.lock = threading.Lock()
+
+ROWS = [{'branch': 'A', 'total_sales': Decimal('10.50'), 'business_date': date(2024, 1, 2)}]
+
+class RedisBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _RESPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.cache = RedisBackend(f'redis://{host}:{port}/0', max_entries=100, max_bytes=1024 * 1024)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_set_and_get(self):
+        self.cache.set('k', ROWS, ttl=60, owner='q')
+        self.assertEqual(self.cache.get('k', 'q'), (True, ROWS, True))
+        self.assertEqual(self.cache.peek('k'), (True, ROWS))
+        self.assertEqual(self.cache.get('missing', 'q'), (False, None, False))
+
+    def test_stale_then_expired(self):
+        self.cache.set('k', ROWS, ttl=0.05, owner='q', stale_ttl=0.2)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get('k', 'q'), (True, ROWS, False))
+        self.assertEqual(self.cache.peek('k'), (False, None))
+        time.sleep(0.2)
+        self.assertEqual(self.cache.get('k', 'q'), (False, None, False))
+
+    def test_clear(self):
+        self.cache.set('a', 1, ttl=60, owner='q')
+        self.cache.set('b', 2, ttl=60, owner='q')
+        self.server.store[b'other:c'] = (b'3', None)
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'b'])
+        self.cache.clear()
+        self.assertEqual(self.cache.keys(), [])
+        self.assertIn(b'other:c', self.server.store)
+
+    def test_unserializable_and_corrupt_values_are_misses(self):
+        self.cache.set('k', {('tuple', 'key'): 1}, ttl=60, owner='q')
+        self.assertEqual(self.cache.get('k', 'q'), (False, None, False))
+        self.server.store[b'qc:k'] = (b'{not json', None)
+        self.assertEqual(self.cache.get('k', 'q'), (False, None, False))
+
+    def test_server_down_is_a_miss(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache._local.conn = None
+        self.cache.set('k', ROWS, ttl=60, owner='q')
+        self.assertEqual(self.cache.get('k', 'q'), (False, None, False))
+
+class SQLiteBackendTest(unittest.TestCase):
+
+    def test_set_get_expiry_and_bad_values(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SQLiteBackend(os.path.join(directory, 'cache.sqlite3'), max_entries=100, max_bytes=1024 * 1024)
+            cache.set('k', ROWS, ttl=60, owner='q')
+            self.assertEqual(cache.get('k', 'q'), (True, ROWS, True))
+
+            cache.set('short', 1, ttl=0.05, owner='q')
+            time.sleep(0.1)
+            self.assertEqual(cache.get('short', 'q'), (False, None, False))
+
+            cache.set('bad', {('tuple', 'key'): 1}, ttl=60, owner='q')
+            self.assertEqual(cache.get('bad', 'q'), (False, None, False))
+            cache._connection().execute("UPDATE cache_entries SET value = ? WHERE key = 'k'", (b'{not json',))
+            self.assertEqual(cache.get('k', 'q'), (False, None, False))
+
+            cache.clear()
+            self.assertEqual(cache.keys(), [])
+            cache._connection().close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# tests/test_category_rules.py
+# The shared category rules select the same order lines as the predicates they replaced
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import local_mirror  # noqa: E402
+from category_rules import excluded_product_sql, is_deposit_sql, line_column, non_merchandise_sql  # noqa: E402
+
+CATEGORIES = ['ملابس / محلي', 'خدمات / توصيل', 'خدمات وخصومات', 'خدمات/تغليف', 'خدمات', 'pos', 'عطور', '', None]
+NAMES = ['قميص', 'عربون طلب بضاعة', 'عربون', 'دفع مسبق منتجات البدائع', 'دفع مسبق', 'قسيمة التخفيض 50',
+         'نقاط المكافآت', 'خصم خاص', 'خصومات الموسم', 'خدمة تغليف', 'خدمات توصيل', '', None]
+
+# The predicates as the routes wrote them before the rules were shared
+BASELINE = {
+    'services_kpi': """(product_category LIKE '%خدمات%' AND product_name NOT LIKE '%عربون طلب بضاعة%'
+        AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%'
+        AND product_name NOT LIKE '%نقاط المكافآت%')""",
+    'services_details': """(product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%')
+        AND (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%'
+        AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%')""",
+    'services_pages': """(product_category LIKE '%خدمات%' OR product_category LIKE '%pos%')
+        AND product_name NOT LIKE '%عربون طلب بضاعة%'
+        AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%'
+        AND product_name NOT LIKE '%عربون%'
+        AND product_name NOT LIKE '%دفع مسبق%'""",
+    'top_products': """product_name NOT LIKE '%خدمات%'
+        AND product_name NOT LIKE '%خصومات%'
+        AND product_name NOT LIKE '%خدمة%'
+        AND product_name NOT LIKE '%خصم%'
+        AND SPLIT(product_category, '/')[SAFE_OFFSET(0)] != 'خدمات'""",
+}
+
+CURRENT = {
+    'services_kpi': f"{line_column('is_service')} AND NOT {line_column('is_service_adjustment')}",
+    'services_details': f"{line_column('is_service')} AND NOT {line_column('is_service_adjustment')}",
+    'services_pages': f"{non_merchandise_sql(is_service=line_column('is_service'))} AND NOT {is_deposit_sql()}",
+    'top_products': f"NOT {excluded_product_sql()}",
+}
+
+@unittest.skipUnless(local_mirror.duckdb, "needs duckdb")
+class CategoryRulesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = local_mirror.duckdb.connect()
+        for statement in local_mirror._SETUP_STATEMENTS:
+            cls.connection.execute(statement)
+        cls.connection.execute("CREATE TABLE pos_order_lines (product_category VARCHAR, product_name VARCHAR)")
+        cls.connection.executemany("INSERT INTO pos_order_lines VALUES (?, ?)",
+                                   [(category, name) for category in CATEGORIES for name in NAMES])
+
+    def _selected(self, predicate):
+        sql, _ = local_mirror.translate_sql(
+            f"SELECT product_category, product_name FROM `p.d.pos_order_lines` WHERE {predicate}")
+        return sorted(self.connection.execute(sql).fetchall(), key=repr)
+
+    def test_rules_match_the_baseline_predicates(self):
+        for use, baseline in BASELINE.items():
+            with self.subTest(use=use):
+                expected = self._selected(baseline)
+                self.assertTrue(expected)
+                self.assertEqual(self._selected(CURRENT[use]), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# tests/test_kpi_engine.py
+# The KPI cube gives the main cards and the branch table the numbers of the queries it replaced
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import local_mirror  # noqa: E402
+from config import Config  # noqa: E402
+from kpi_engine import GROUPING_SETS, kpi_cube_sql, total_row  # noqa: E402
+from rollup import get_fact_source  # noqa: E402
+from utils import get_user_filters  # noqa: E402
+
+QUERY_STRING = 'start_date=2024-01-05&end_date=2024-01-20'
+
+# Order lines around the clock (business days start at 21:00), with services, adjustments, returns and NULLs
+ORDER_LINES_SQL = """
+    CREATE TABLE pos_order_lines AS SELECT
+        TIMESTAMP '2024-01-01 08:00:00' + i * INTERVAL 37 MINUTE AS order_date,
+        CASE i % 5 WHEN 0 THEN 'A' WHEN 1 THEN 'B' WHEN 2 THEN 'المتجر الإلكتروني' WHEN 3 THEN 'المتجر الالكتروني' ELSE NULL END AS branch,
+        CASE WHEN i % 13 = 0 THEN NULL ELSE 'e' || (i % 7) END AS employee_name,
+        CASE i % 9 WHEN 0 THEN 'خدمات / توصيل' WHEN 1 THEN 'pos' WHEN 2 THEN 'خدمات وخصومات' WHEN 3 THEN 'ملابس / Online'
+            WHEN 4 THEN 'بضاعة مخفضة / محلي' WHEN 5 THEN NULL WHEN 6 THEN 'عطور / store' ELSE 'ساعات / مستورد' END AS product_category,
+        CASE i % 11 WHEN 0 THEN 'عربون طلب بضاعة' WHEN 1 THEN 'قسيمة التخفيض 5' WHEN 2 THEN 'نقاط المكافآت' WHEN 3 THEN 'خدمة تغليف'
+            WHEN 4 THEN 'عربون' ELSE 'prod ' || (i % 90) END AS product_name,
+        '62' || (i % 900) AS product_barcode,
+        (i % 6) - 1.0 AS quantity,
+        CASE WHEN i % 17 = 0 THEN NULL ELSE ((i % 6) - 1) * (25.0 + i % 31) END AS subtotal_incl,
+        10.0 + i % 5 AS total_cost,
+        'r' || (i // 3) AS receipt_number,
+        CASE WHEN i % 19 = 0 THEN NULL ELSE 'p' || (i % 23) END AS phone_number,
+        CAST(NULL AS DATE) AS business_date
+    FROM range(1500) t(i)
+"""
+
+# /api/data and /api/branch-sales before they read the cube (FilteredData is the same filter)
+BASELINE_TOTALS_SQL = """
+    WITH FilteredData AS (
+        SELECT * FROM `p.d.pos_order_lines` {where_sql}
+    )
+    SELECT
+        CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 0) AS NUMERIC) AS total_sales,
+        CAST(COALESCE(SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, subtotal_incl, 0)), 0) AS NUMERIC) AS sales_without_services,
+        CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL AND total_cost IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) - total_cost ELSE 0 END), 0) AS NUMERIC) AS profit,
+        CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END), 0) AS INT64) AS invoice_count,
+        CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN phone_number ELSE NULL END), 0) AS INT64) AS customer_count,
+        CAST(COALESCE(SUM(IF(branch != 'المتجر الالكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, quantity, 0)), 0) AS INT64) AS store_items_sold,
+        CAST(COALESCE(SUM(IF(quantity < 0 AND branch != 'المتجر الإلكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, ABS(quantity), 0)), 0) AS INT64) AS store_returned_quantity,
+        CAST(COALESCE(SUM(IF(quantity < 0 AND branch != 'المتجر الإلكتروني' AND NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, ABS(subtotal_incl), 0)), 0) AS NUMERIC) AS store_returned_value,
+        CAST(COALESCE(SUM(IF(
+            quantity > 0 AND
+            branch != 'المتجر الالكتروني' AND
+            (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%') AND
+            (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%') AND
+            subtotal_incl IS NOT NULL,
+            subtotal_incl, 0
+        )), 0) AS NUMERIC) AS services_value,
+        CAST(COALESCE(SUM(IF(
+            quantity < 0 AND
+            branch != 'المتجر الالكتروني' AND
+            (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%') AND
+            (product_name NOT LIKE '%عربون طلب بضاعة%' AND product_name NOT LIKE '%دفع مسبق منتجات البدائع%' AND product_name NOT LIKE '%قسيمة التخفيض%' AND product_name NOT LIKE '%نقاط المكافآت%') AND
+            subtotal_incl IS NOT NULL,
+            ABS(subtotal_incl), 0
+        )), 0) AS NUMERIC) AS returned_services_value,
+        CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN ROUND((subtotal_incl / 1.15), 2) ELSE 0 END), 0) AS NUMERIC) AS net_sales,
+        CAST(COALESCE(SUM(IF(total_cost > 0 AND subtotal_incl IS NOT NULL, ROUND((subtotal_incl / 1.15), 2), 0)), 0) AS NUMERIC) AS gross_sales_without_vat
+    FROM FilteredData
+    WHERE subtotal_incl IS NOT NULL
+"""
+
+BASELINE_BRANCHES_SQL = """
+    WITH FilteredData AS (
+        SELECT * FROM `p.d.pos_order_lines` {where_sql}
+    )
+    SELECT
+        COALESCE(branch, 'غير محدد') as branch,
+        CAST(COALESCE(SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END), 0) AS NUMERIC) as total_sales,
+        CAST(COALESCE(SUM(IF(NOT (product_category LIKE '%خدمات%' OR product_category LIKE '%خدمات وخصومات%' OR product_category LIKE '%pos%') AND subtotal_incl IS NOT NULL, quantity, 0)), 0) AS INT64) AS merchandise_quantity,
+        CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN receipt_number ELSE NULL END), 0) AS INT64) AS invoice_count,
+        CAST(COALESCE(COUNT(DISTINCT CASE WHEN subtotal_incl IS NOT NULL THEN phone_number ELSE NULL END), 0) AS INT64) AS customer_count
+    FROM FilteredData
+    GROUP BY COALESCE(branch, 'غير محدد')
+    HAVING SUM(CASE WHEN subtotal_incl IS NOT NULL THEN subtotal_incl ELSE 0 END) > 0
+"""
+
+# Measures the routes round to whole pieces
+WHOLE_MEASURES = ('store_items_sold', 'store_returned_quantity', 'merchandise_quantity')
+
+@unittest.skipUnless(local_mirror.duckdb, "needs duckdb")
+class KpiCubeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = local_mirror.duckdb.connect()
+        for statement in local_mirror._SETUP_STATEMENTS:
+            cls.connection.execute(statement)
+        cls.connection.execute(ORDER_LINES_SQL)
+        cls.app = Flask(__name__)
+
+    def _run_query(self, sql, params=None):
+        local_sql, _ = local_mirror.translate_sql(sql)
+        cursor = self.connection.execute(local_sql, {name: value for name, value in (params or {}).items() if f"${name}" in local_sql})
+        column_names = [column[0] for column in cursor.description]
+        return [dict(zip(column_names, row)) for row in cursor.fetchall()]
+
+    def _values(self, row, names):
+        values = {}
+        for name in names:
+            value = float(row.get(name) or 0)
+            values[name] = round(value) if name in WHOLE_MEASURES else round(value, 2)
+        return values
+
+    def _cube_and_filters(self):
+        with mock.patch.object(Config, 'ROLLUP_ENABLED', False), self.app.test_request_context(f'/api/data?{QUERY_STRING}'):
+            facts = get_fact_source(distinct_keys=True)
+            self.assertFalse(facts.from_rollup)
+            cube = {name: [] for name in GROUPING_SETS}
+            for row in self._run_query(kpi_cube_sql(facts), facts.params):
+                cube[row['grouping_set']].append(row)
+            return cube, get_user_filters()
+
+    def test_totals_match_the_main_kpi_query(self):
+        cube, filters = self._cube_and_filters()
+        expected = self._run_query(BASELINE_TOTALS_SQL.format(where_sql=filters.where_sql), filters.params)[0]
+        self.assertGreater(expected['services_value'], 0)
+        self.assertEqual(self._values(total_row(cube), expected), self._values(expected, expected))
+
+    def test_branches_match_the_branch_sales_query(self):
+        cube, filters = self._cube_and_filters()
+        expected = self._run_query(BASELINE_BRANCHES_SQL.format(where_sql=filters.where_sql), filters.params)
+        names = ('total_sales', 'merchandise_quantity', 'invoice_count', 'customer_count')
+        branches = {row['branch'] or 'غير محدد': self._values(row, names) for row in cube['branch'] if (row['total_sales'] or 0) > 0}
+        self.assertEqual(len(expected), 5)
+        self.assertEqual(branches, {row['branch']: self._values(row, names) for row in expected})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,13 @@
 from flask import request
 from datetime import datetime, date, time, timedelta
 import calendar
+import hashlib
+import json
+from data_versions import POS_ORDER_LINES, partition_field
 
-def get_date_range_strings():
+def get_business_datetime_range():
     """
-    Parses date filters and returns formatted date strings for SQL queries.
+    Parses date filters and returns the (start, end) datetimes of the requested business days.
     Handles all filter types with proper priority and validation.
     Business Day: Starts at 21:00 on the previous calendar day and ends at 20:59 on the current day.
     """
@@ -21,7 +24,7 @@ def get_date_range_strings():
     month_param = request.args.get('month')
     today = date.today()
     
-    start_sql_str, end_sql_str = None, None
+    start_dt, end_dt = None, None
 
     try:
         # Priority 1: Full date range (most specific)
@@ -36,8 +39,7 @@ def get_date_range_strings():
             business_start_dt = datetime.combine(start_date_obj, time(21, 0, 0)) - timedelta(days=1)
             business_end_dt = datetime.combine(end_date_obj, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
         # Priority 2: Month-specific filters
         elif month_param:
@@ -92,8 +94,7 @@ def get_date_range_strings():
                 business_start_dt = datetime.combine(start_date_obj, time(21, 0, 0)) - timedelta(days=1)
                 business_end_dt = datetime.combine(end_date_obj, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
         # Priority 3: Current month day filters
         elif single_day:
@@ -107,8 +108,7 @@ def get_date_range_strings():
             business_start_dt = datetime.combine(target_date, time(21, 0, 0)) - timedelta(days=1)
             business_end_dt = datetime.combine(target_date, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
         elif start_day and end_day:
             start_day_int = int(start_day)
@@ -142,8 +142,7 @@ def get_date_range_strings():
             business_start_dt = datetime.combine(start_date_obj, time(21, 0, 0)) - timedelta(days=1)
             business_end_dt = datetime.combine(end_date_obj, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
         # Priority 4: Quick filters (current month based)
         elif filter_type == 'mid_monthly':
@@ -153,8 +152,7 @@ def get_date_range_strings():
             business_start_dt = datetime.combine(start_date_obj, time(21, 0, 0)) - timedelta(days=1)
             business_end_dt = datetime.combine(end_date_obj, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
         elif filter_type == 'monthly':
             start_date_obj = today.replace(day=1)
@@ -164,57 +162,159 @@ def get_date_range_strings():
             business_start_dt = datetime.combine(start_date_obj, time(21, 0, 0)) - timedelta(days=1)
             business_end_dt = datetime.combine(end_date_obj, time(20, 59, 59))
             
-            start_sql_str = business_start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            end_sql_str = business_end_dt.strftime('%Y-%m-%d %H:%M:%S')
+            start_dt, end_dt = business_start_dt, business_end_dt
 
     except (ValueError, TypeError) as e:
         print(f"Filter parsing error: {e}")
         # Return None to indicate no filtering (show all data)
         return None, None
             
-    return start_sql_str, end_sql_str
+    return start_dt, end_dt
 
-def get_user_filters_string():
-    """Build a centralized WHERE clause string from user-driven filters."""
-    conditions = []
+# pos_order_lines can be partitioned on the business day of each line (see data-push/partition_order_lines.py)
+BUSINESS_DATE_COLUMN = 'business_date'
+
+def business_date_of(moment):
+    """Business day an order placed at `moment` belongs to (21:00 starts the next day)."""
+    return (moment + timedelta(hours=3)).date()
+
+def business_date_partitioned():
+    """True once pos_order_lines is known to be partitioned on business_date."""
+    return partition_field(POS_ORDER_LINES) == BUSINESS_DATE_COLUMN
+
+def add_business_date_range(filters, start_dt, end_dt):
+    """
+    Add the business_date range of an order_date range to `filters`, so
+    BigQuery only reads those partitions. Lines the loader wrote before their
+    business_date was filled in (the NULL partition) are kept; order_date
+    still decides which lines match. Nothing is added while the table isn't
+    partitioned.
+    """
+    if business_date_partitioned():
+        filters.add(f"({BUSINESS_DATE_COLUMN} BETWEEN @start_business_date AND @end_business_date OR {BUSINESS_DATE_COLUMN} IS NULL)",
+                    start_business_date=business_date_of(start_dt), end_business_date=business_date_of(end_dt))
+    return filters
+
+def order_date_days_sql(first_day_sql, last_day_sql=None, alias=''):
+    """
+    Condition for lines ordered on calendar days first_day..last_day (SQL DATE
+    expressions, open-ended without last_day).
+
+    Written as a range on order_date rather than DATE(order_date), which can't
+    use partitioning or clustering, plus the matching business_date bounds
+    when the table is partitioned on it.
+    """
+    column = f"{alias}.order_date" if alias else "order_date"
+    conditions = [f"{column} >= CAST({first_day_sql} AS DATETIME)"]
+    if last_day_sql:
+        conditions.append(f"{column} < CAST(DATE_ADD({last_day_sql}, INTERVAL 1 DAY) AS DATETIME)")
+    if business_date_partitioned():
+        # A line's business day is its calendar day or the day after
+        business_date = f"{alias}.{BUSINESS_DATE_COLUMN}" if alias else BUSINESS_DATE_COLUMN
+        bounds = f"{business_date} >= {first_day_sql}"
+        if last_day_sql:
+            bounds += f" AND {business_date} <= DATE_ADD({last_day_sql}, INTERVAL 1 DAY)"
+        conditions.append(f"({bounds} OR {business_date} IS NULL)")
+    return " AND ".join(conditions)
+
+class QueryFilter:
+    """
+    A WHERE clause compiled to BigQuery named parameters.
+
+    Conditions reference values as @name and the values travel separately in
+    `params`, so the SQL text only depends on which filters are present and not
+    on what the user typed. That keeps the number of distinct query texts small
+    (good for BigQuery's result cache) and makes `cache_key()` canonical.
+    """
+
+    def __init__(self, *conditions):
+        self.conditions = list(conditions)
+        self.params = {}
+
+    def add(self, condition, **params):
+        """Append a condition (AND-ed with the others) and the parameters it uses."""
+        self.conditions.append(condition)
+        self.params.update(params)
+        return self
+
+    @property
+    def where_sql(self):
+        """The compiled 'WHERE ...' clause, or an empty string when there are no conditions."""
+        if self.conditions:
+            return "WHERE " + " AND ".join(self.conditions)
+        return ""
+
+    def cache_key(self):
+        """Stable key for the logical filter, identical across processes and restarts."""
+        payload = json.dumps(
+            {'conditions': self.conditions, 'params': self.params},
+            sort_keys=True, default=str, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return f"QueryFilter({self.cache_key()})"
+
+def has_line_level_filters():
+    """
+    True when the request filters on something finer than the daily rollup's
+    dimensions (a product, an amount range or a named purchase source).
+    """
+    if any((request.args.get(name) or '').strip() for name in ('product', 'min_amount', 'max_amount')):
+        return True
+    purchase_source = (request.args.get('purchase_source') or '').strip().lower()
+    return bool(purchase_source) and purchase_source not in ('online', 'store')
+
+def get_user_filters(include_date=True):
+    """
+    Compile the user-driven filters of the current request into a QueryFilter.
+    
+    With include_date=False the business-day range is left out, for callers
+    that apply it on another column (see rollup.py).
+    """
+    filters = QueryFilter()
     
     try:
         # 1. Add date filter condition
-        start_str, end_str = get_date_range_strings()
-        if start_str and end_str:
-            conditions.append(f"order_date BETWEEN DATETIME('{start_str}') AND DATETIME('{end_str}')")
+        start_dt, end_dt = get_business_datetime_range()
+        if include_date and start_dt and end_dt:
+            filters.add("order_date BETWEEN @start_datetime AND @end_datetime",
+                        start_datetime=start_dt, end_datetime=end_dt)
+            add_business_date_range(filters, start_dt, end_dt)
             
         # 2. Add branch filter condition
         branch = request.args.get('branch')
         if branch and branch.strip():
-            # Escape single quotes in branch name
-            safe_branch = branch.replace("'", "''")
-            conditions.append(f"branch = '{safe_branch}'")
+            filters.add("branch = @branch", branch=branch)
         
         # 3. Add employee filter condition
         employee = request.args.get('employee')
         if employee and employee.strip():
-            safe_employee = employee.replace("'", "''")
-            conditions.append(f"employee_name = '{safe_employee}'")
+            filters.add("employee_name = @employee", employee=employee)
         
         # 4. Add product category filter condition
+        # (category_exact=1 when the value was picked from the /api/suggest list, typed text is a substring match)
         category = request.args.get('category')
         if category and category.strip():
-            safe_category = category.replace("'", "''")
-            conditions.append(f"product_category LIKE '%{safe_category}%'")
+            if request.args.get('category_exact') == '1':
+                filters.add("product_category = @category", category=category)
+            else:
+                filters.add("product_category LIKE @category_pattern", category_pattern=f"%{category}%")
         
         # 5. Add product filter condition
         product = request.args.get('product')
         if product and product.strip():
-            safe_product = product.replace("'", "''")
-            conditions.append(f"(product_name LIKE '%{safe_product}%' OR product_barcode = '{safe_product}')")
+            if request.args.get('product_exact') == '1':
+                filters.add("(product_name = @product OR product_barcode = @product)", product=product)
+            else:
+                filters.add("(product_name LIKE @product_pattern OR product_barcode = @product)",
+                            product_pattern=f"%{product}%", product=product)
         
         # 6. Add minimum amount filter
         min_amount = request.args.get('min_amount')
         if min_amount and min_amount.strip():
             try:
-                min_val = float(min_amount)
-                conditions.append(f"subtotal_incl >= {min_val}")
+                filters.add("subtotal_incl >= @min_amount", min_amount=float(min_amount))
             except ValueError:
                 pass
         
@@ -222,31 +322,28 @@ def get_user_filters_string():
         max_amount = request.args.get('max_amount')
         if max_amount and max_amount.strip():
             try:
-                max_val = float(max_amount)
-                conditions.append(f"subtotal_incl <= {max_val}")
+                filters.add("subtotal_incl <= @max_amount", max_amount=float(max_amount))
             except ValueError:
                 pass
 
         # 8. Add purchase source filter (if applicable)
         purchase_source = request.args.get('purchase_source')
         if purchase_source and purchase_source.strip():
-            safe_source = purchase_source.replace("'", "''")
             if purchase_source.lower() == 'online':
-                conditions.append("branch = 'المتجر الإلكتروني'")
+                filters.add("branch = 'المتجر الإلكتروني'")
             elif purchase_source.lower() == 'store':
-                conditions.append("branch != 'المتجر الإلكتروني'")
+                filters.add("branch != 'المتجر الإلكتروني'")
             else:
-                conditions.append(f"purchase_source = '{safe_source}'")
+                filters.add("purchase_source = @purchase_source", purchase_source=purchase_source)
 
     except Exception as e:
         print(f"Error building filter conditions: {e}")
-        # In case of any error, return basic filter
-        start_str, end_str = get_date_range_strings()
-        if start_str and end_str:
-            return f"WHERE order_date BETWEEN DATETIME('{start_str}') AND DATETIME('{end_str}')"
-        return ""
+        # In case of any error, fall back to the date filter only
+        filters = QueryFilter()
+        start_dt, end_dt = get_business_datetime_range()
+        if include_date and start_dt and end_dt:
+            filters.add("order_date BETWEEN @start_datetime AND @end_datetime",
+                        start_datetime=start_dt, end_datetime=end_dt)
+            add_business_date_range(filters, start_dt, end_dt)
 
-    if conditions:
-        return "WHERE " + " AND ".join(conditions)
-    else:
-        return ""
+    return filters